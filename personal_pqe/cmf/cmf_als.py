@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+'''
+Brief Description:
+    This model solves the same collective matrix factorization as cmf_sgd, but by
+    alternating least squares (ALS): with the other side fixed, each user row of
+    (U, bu), each video row of (V, bv) and each row of P, Q is solved in closed
+    form by a small regularized least squares. ALS does not need a learning rate,
+    and the row solves of a sweep are independent of each other.
+
+@author: jason
+'''
+
+import numpy as np
+from scipy import sparse
+
+import cmf_sgd
+import cmf_trace
+
+g_nBlockSize = 4096 # #rows solved together, bounds the memory of stacked gram matrices
+
+def solveRegularizedRows(lsTerms, arrReg, nStart=0, nEnd=None, nBlockSize=g_nBlockSize):
+    '''
+        This function solves each row x_i (nStart <= i < nEnd) of
+
+            min  sum_t dAlpha_t/2 * sum_j W_t[i,j] * (Y_t[i,j] - x_i·X_t[j])^2
+                 + 1/2 * sum_k arrReg[k] * x_i[k]^2
+
+        in closed form, i.e., (sum_t dAlpha_t * X_t^T·diag(W_t[i])·X_t + diag(arrReg)) x_i
+                              = sum_t dAlpha_t * X_t^T·(W_t∘Y_t)[i]
+
+        params:
+            lsTerms - list of (dAlpha, W, WY, X), where W is the weight matrix (dense
+                      or CSR), WY = W∘Y has the same type as W, X is dense
+            arrReg  - regularization of each column of x
+
+        return:
+            solved rows, (nEnd-nStart)-by-len(arrReg) matrix, in the dtype of X
+    '''
+    if (nEnd is None):
+        nEnd = lsTerms[0][1].shape[0]
+    nDim = len(arrReg)
+
+    # outer products of rows of X, flattened, so that the gram matrices of
+    # all rows can be computed by one product: W·vec(X_j·X_j^T)
+    lsOuters = [np.einsum('ji,jk->jik', X, X).reshape(X.shape[0], nDim*nDim) \
+                for (dAlpha, W, WY, X) in lsTerms]
+
+    dtype = lsTerms[0][3].dtype
+    mtSolved = np.empty((nEnd-nStart, nDim), dtype=dtype)
+    for nBlockStart in xrange(nStart, nEnd, nBlockSize):
+        nBlockEnd = min(nBlockStart+nBlockSize, nEnd)
+
+        mtGram = np.zeros((nBlockEnd-nBlockStart, nDim*nDim), dtype=dtype)
+        mtRHS = np.zeros((nBlockEnd-nBlockStart, nDim), dtype=dtype)
+        for (dAlpha, W, WY, X), mtOuter in zip(lsTerms, lsOuters):
+            mtGram += dAlpha * W[nBlockStart:nBlockEnd].dot(mtOuter)
+            mtRHS += dAlpha * WY[nBlockStart:nBlockEnd].dot(X)
+
+        mtGram = mtGram.reshape(-1, nDim, nDim)
+        mtGram[:, np.arange(nDim), np.arange(nDim)] += arrReg
+
+        mtSolved[nBlockStart-nStart:nBlockEnd-nStart] = np.linalg.solve(mtGram, mtRHS[:, :, np.newaxis])[:, :, 0]
+
+    return mtSolved
+
+def getResidualTargets(R_train, Bias, mu):
+    '''
+        This function returns the weight matrix W (1 for observed entries) and 
+        W∘Y, where Y = R - bias of the other side - mu, both are CSR matrices.
+        
+        Note: R_train is a sparse matrix whose rows are the rows to solve (e.g.,
+              users for [U, bu], videos for [V, bv]), it is not modified; W and
+              W∘Y are in the dtype of Bias.
+    '''
+    R_csr = R_train.tocsr()
+    W = sparse.csr_matrix((np.ones(R_csr.nnz, dtype=Bias.dtype), R_csr.indices, R_csr.indptr), shape=R_csr.shape)
+    WY = sparse.csr_matrix(((R_csr.data - Bias[R_csr.indices, 0] - mu).astype(Bias.dtype, copy=False), \
+                            R_csr.indices, R_csr.indptr), shape=R_csr.shape)
+    return W, WY
+
+def getUserTerms(R_train, D, weightD_train, V, P, Bv, mu, arrAlphas):
+    '''
+        This function returns the least squares terms (see solveRegularizedRows)
+        for rows of [U, bu], given V, bv and P
+    '''
+    Va = np.hstack([V, np.ones((V.shape[0], 1), dtype=V.dtype)])
+    Pa = np.hstack([P, np.zeros((P.shape[0], 1), dtype=P.dtype)])
+    W, WY = getResidualTargets(R_train, Bv, mu)
+
+    return [(arrAlphas[0], W, WY, Va), \
+            (arrAlphas[1], weightD_train, np.multiply(weightD_train, D), Pa)]
+
+def getVideoTerms(R_train, S, weightS_train, U, Q, Bu, mu, arrAlphas):
+    '''
+        This function returns the least squares terms (see solveRegularizedRows)
+        for rows of [V, bv], given U, bu and Q
+        
+        Note: R_train is the transposed (video-user) matrix
+    '''
+    Ua = np.hstack([U, np.ones((U.shape[0], 1), dtype=U.dtype)])
+    Qa = np.hstack([Q, np.zeros((Q.shape[0], 1), dtype=Q.dtype)])
+    W, WY = getResidualTargets(R_train, Bu, mu)
+
+    return [(arrAlphas[0], W, WY, Ua), \
+            (arrAlphas[2], weightS_train, np.multiply(weightS_train, S), Qa)]
+
+def fit(R, D, S, weightR_train, weightR_test, weightD_train, weightS_train, \
+        f, arrAlphas, arrLambdas, nMaxStep, \
+        lsTrainingTrace, bDebugInfo=True, dtype=np.float64, dcInitModel=None):
+    '''
+        This function train CMF by alternating least squares, params and returns
+        are the same as cmf_sgd.fit(), a step here is a sweep over U, V, P and Q.
+
+        Note: R and the weights of R can be either dense or scipy sparse matrices,
+              R is only accessed on its observed entries; dcInitModel warm-starts
+              the training (see cmf_sgd.initLowRankMatrices).
+    '''
+    #===========================================================================
+    # init low rank matrices
+    #===========================================================================
+    U, P, V, Q, Bu, Bv, Jm, Jn = cmf_sgd.initLowRankMatrices(R, D, S, f, dtype, dcInitModel)
+
+    R_train = cmf_sgd.getObservedEntries(R, weightR_train, dtype)
+    R_test = cmf_sgd.getObservedEntries(R, weightR_test, dtype)
+    mu = R_train.data.mean()
+
+    # regularization of [U, bu], [V, bv], P, Q
+    arrRegU = np.array([arrLambdas[0]]*f + [arrLambdas[3]])
+    arrRegV = np.array([arrLambdas[0]]*f + [arrLambdas[4]])
+    arrRegP = np.array([arrLambdas[1]]*f)
+    arrRegQ = np.array([arrLambdas[2]]*f)
+
+    #===========================================================================
+    # sweep until converge or max steps
+    #===========================================================================
+    dLastLoss = None
+    dcLogger = cmf_trace.createLogger()
+    for nStep in xrange(nMaxStep):
+        # U, bu
+        mtUa = solveRegularizedRows(getUserTerms(R_train, D, weightD_train, V, P, Bv, mu, arrAlphas), arrRegU)
+        U, Bu = mtUa[:, :f], mtUa[:, f:]
+
+        # V, bv
+        mtVa = solveRegularizedRows(getVideoTerms(R_train.T, S, weightS_train, U, Q, Bu, mu, arrAlphas), arrRegV)
+        V, Bv = mtVa[:, :f], mtVa[:, f:]
+
+        # P, Q
+        P = solveRegularizedRows([(arrAlphas[1], weightD_train.T, np.multiply(weightD_train, D).T, U)], arrRegP)
+        Q = solveRegularizedRows([(arrAlphas[2], weightS_train.T, np.multiply(weightS_train, S).T, V)], arrRegQ)
+
+        #=======================================================================
+        # evaluate
+        #=======================================================================
+        dummy, dummy, dummy, \
+        dRmseR_train, dRmseR_test, dRmseD, dRmseS, \
+        dLoss = cmf_sgd.computeResidualError_sparse(R_train, R_test, D, S, U, V, P, Q, Bu, Bv, mu, \
+                                                    weightD_train, weightS_train, arrAlphas, arrLambdas)
+
+        # save RMSE
+        dcRMSE = {}
+        dcRMSE['rmseR'] = dRmseR_train
+        dcRMSE['rmseR_test'] = dRmseR_test
+        dcRMSE['rmseD'] = dRmseD
+        dcRMSE['rmseS'] = dRmseS
+        dcRMSE['loss'] = dLoss
+        cmf_trace.recordTrace(lsTrainingTrace, nStep, dcRMSE)
+
+        # output
+        if (bDebugInfo):
+            cmf_trace.logProgress(dcLogger, "sweep %d" % nStep, dcRMSE)
+
+        #=======================================================================
+        # check convergence
+        #=======================================================================
+        if (dLastLoss is not None and abs(dLastLoss-dLoss) <= cmf_sgd.g_dConvergenceThresold):
+            print("converged @ sweep %d: change:%f, loss=%f, rmseR_test=%f" % \
+                  (nStep, dLastLoss-dLoss, dLoss, dRmseR_test) )
+            break
+        dLastLoss = dLoss
+    #END sweep
+
+    return U, V, P, Q, Bu, Bv, mu, Jm, Jn
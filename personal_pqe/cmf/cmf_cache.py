@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+'''
+Brief Description:
+    This model provides a bounded in-memory cache of predictions for hot keys,
+    e.g., scores of (user row, video row/cluster) pairs of heavy users and the
+    folded-in factors of repeated video features (see cmf_server).
+
+    An entry is evicted when it is the least recently used one of a full cache,
+    or when it is older than the TTL. Every entry belongs to a model version,
+    the whole cache is invalidated as soon as it is accessed with another
+    version, so a reloaded model never serves stale predictions.
+
+    All functions are thread-safe.
+
+@author: jason
+'''
+
+import time
+import threading
+from collections import OrderedDict
+
+g_nMaxEntries = 100000
+g_dTTL = 600.0 # seconds an entry lives
+
+def createCache(nMaxEntries=g_nMaxEntries, dTTL=g_dTTL):
+    '''
+        This function creates a cache.
+
+        params:
+            nMaxEntries - max #entries, 0 disables the cache
+            dTTL        - seconds an entry lives, None for no expiration
+    '''
+    dcCache = {}
+    dcCache['entries'] = OrderedDict() # key -> (value, expiration), least recently used first
+    dcCache['max_entries'] = nMaxEntries
+    dcCache['ttl'] = dTTL
+    dcCache['version'] = None
+    dcCache['hits'] = 0
+    dcCache['misses'] = 0
+    dcCache['evictions'] = 0
+    dcCache['expirations'] = 0
+    dcCache['invalidations'] = 0
+    dcCache['lock'] = threading.Lock()
+    return dcCache
+
+def checkVersion(dcCache, strVersion):
+    '''
+        This function invalidates the cache if the model version has changed,
+        the lock must be held.
+    '''
+    if (strVersion != dcCache['version']):
+        if (len(dcCache['entries']) > 0):
+            dcCache['invalidations'] += 1
+        dcCache['entries'].clear()
+        dcCache['version'] = strVersion
+
+def getCached(dcCache, lsKeys, strVersion):
+    '''
+        This function looks up keys.
+
+        return:
+            lsValues - cached values, None for misses
+    '''
+    dNow = time.time()
+    lsValues = [None]*len(lsKeys)
+    with dcCache['lock']:
+        checkVersion(dcCache, strVersion)
+        dcEntries = dcCache['entries']
+        for i, key in enumerate(lsKeys):
+            tpEntry = dcEntries.pop(key, None)
+            if (tpEntry is None):
+                dcCache['misses'] += 1
+            elif (tpEntry[1] is not None and tpEntry[1] < dNow):
+                dcCache['misses'] += 1
+                dcCache['expirations'] += 1
+            else:
+                dcEntries[key] = tpEntry # most recently used
+                lsValues[i] = tpEntry[0]
+                dcCache['hits'] += 1
+    return lsValues
+
+def putCached(dcCache, lsKeys, lsValues, strVersion):
+    '''
+        This function caches values, the least recently used entries are
+        evicted if the cache is full.
+    '''
+    if (dcCache['max_entries'] <= 0):
+        return
+    dExpiration = time.time() + dcCache['ttl'] if dcCache['ttl'] is not None else None
+    with dcCache['lock']:
+        checkVersion(dcCache, strVersion)
+        dcEntries = dcCache['entries']
+        for key, value in zip(lsKeys, lsValues):
+            dcEntries.pop(key, None)
+            dcEntries[key] = (value, dExpiration)
+        while (len(dcEntries) > dcCache['max_entries']):
+            dcEntries.popitem(last=False)
+            dcCache['evictions'] += 1
+
+def invalidateCache(dcCache, strVersion=None):
+    '''
+        This function drops all entries, e.g., when a new model is loaded.
+    '''
+    with dcCache['lock']:
+        checkVersion(dcCache, strVersion)
+        dcCache['entries'].clear()
+
+def getCacheStats(dcCache):
+    '''
+        This function returns the counters of a cache.
+
+        return:
+            {'size', 'hits', 'misses', 'hit_ratio', 'evictions', 'expirations',
+             'invalidations', 'version'}
+    '''
+    with dcCache['lock']:
+        dcStats = dict( (strKey, dcCache[strKey]) for strKey in \
+                        ['hits', 'misses', 'evictions', 'expirations', 'invalidations', 'version'] )
+        dcStats['size'] = len(dcCache['entries'])
+    nLookups = dcStats['hits'] + dcStats['misses']
+    dcStats['hit_ratio'] = float(dcStats['hits']) / nLookups if nLookups > 0 else None
+    return dcStats
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+'''
+Brief Description:
+    This model implements a fused kernel of the CMF objective: the weighted
+    residuals, RMSEs, total loss and all six gradients are computed in one pass
+    over the observed entries of R (and one over D, S), instead of a residual
+    pass (cmf_sgd.computeResidualError_sparse) followed by a gradient pass
+    (cmf_sgd.computeParitialGraident) which rereads the error matrices.
+
+    The loop over observed entries is JIT-compiled by numba if it is installed.
+    Otherwise a vectorized numpy version is used, which is NOT fused: it gathers
+    the residuals of R by one pass and the gradients by further passes over them,
+    i.e., it only saves the rereads of the dense m-by-n error matrix.
+
+    The squared norms of the regularization are recomputed (np.vdot) in every
+    call, they are not updated incrementally along a line search.
+
+    Trial points of a line search only need the loss, so the kernel also has a
+    loss-only mode (bGradient=False), and the gradients of the accepted point
+    are accumulated afterwards from its residuals (see computeGradient), without
+    another residual pass.
+
+@author: jason
+'''
+
+import numpy as np
+from scipy import sparse
+
+try:
+    import numba
+    g_bNumba = True
+except ImportError:
+    g_bNumba = False
+
+def sortObservedEntries(R_obs):
+    '''
+        This function keeps the observed entries of R (see
+        cmf_sgd.getObservedEntries) in CSR order, so that the residuals computed
+        by the kernel can be wrapped into a CSR matrix without sorting.
+
+        return:
+            {'rows', 'cols', 'values', 'indptr', 'shape'}
+    '''
+    R_csr = sparse.csr_matrix(R_obs)
+    dcObserved = {}
+    dcObserved['rows'] = np.repeat(np.arange(R_csr.shape[0]), np.diff(R_csr.indptr))
+    dcObserved['cols'] = R_csr.indices
+    dcObserved['values'] = R_csr.data
+    dcObserved['indptr'] = R_csr.indptr
+    dcObserved['shape'] = R_csr.shape
+    return dcObserved
+
+def accumulateObservedGradient(arrRows, arrCols, arrValues, U, V, Bu, Bv, mu, dAlpha, \
+                               arrError, gradU, gradV, gradBu, gradBv):
+    '''
+        This function loops over observed entries once, writes the residual of
+        each entry into arrError, accumulates its gradient into gradU, gradV,
+        gradBu, gradBv and returns the sum of squared residuals.
+
+        Note: it is JIT-compiled (see accumulateObservedGradient_jit) if numba is
+              available, don't call it directly in python, which is slow.
+    '''
+    nFactors = U.shape[1]
+    dSquared = 0.0
+    for k in range(arrRows.shape[0]):
+        i = arrRows[k]
+        j = arrCols[k]
+        e = arrValues[k] - mu - Bu[i, 0] - Bv[j, 0]
+        for t in range(nFactors):
+            e -= U[i, t] * V[j, t]
+        arrError[k] = e
+        dSquared += e * e
+
+        dWeightedError = dAlpha * e
+        for t in range(nFactors):
+            dU = U[i, t]
+            gradU[i, t] -= dWeightedError * V[j, t]
+            gradV[j, t] -= dWeightedError * dU
+        gradBu[i, 0] -= dWeightedError
+        gradBv[j, 0] -= dWeightedError
+    return dSquared
+
+def accumulateObservedError(arrRows, arrCols, arrValues, U, V, Bu, Bv, mu, arrError):
+    '''
+        This function is the loss-only version of accumulateObservedGradient,
+        it writes the residuals into arrError and returns the sum of their squares.
+    '''
+    nFactors = U.shape[1]
+    dSquared = 0.0
+    for k in range(arrRows.shape[0]):
+        i = arrRows[k]
+        j = arrCols[k]
+        e = arrValues[k] - mu - Bu[i, 0] - Bv[j, 0]
+        for t in range(nFactors):
+            e -= U[i, t] * V[j, t]
+        arrError[k] = e
+        dSquared += e * e
+    return dSquared
+
+def accumulateErrorGradient(arrRows, arrCols, arrError, U, V, dAlpha, gradU, gradV, gradBu, gradBv):
+    '''
+        This function accumulates the gradients of given residuals of observed
+        entries (e.g., of accumulateObservedError) into gradU, gradV, gradBu, gradBv.
+    '''
+    nFactors = U.shape[1]
+    for k in range(arrRows.shape[0]):
+        i = arrRows[k]
+        j = arrCols[k]
+        dWeightedError = dAlpha * arrError[k]
+        for t in range(nFactors):
+            dU = U[i, t]
+            gradU[i, t] -= dWeightedError * V[j, t]
+            gradV[j, t] -= dWeightedError * dU
+        gradBu[i, 0] -= dWeightedError
+        gradBv[j, 0] -= dWeightedError
+
+if (g_bNumba):
+    accumulateObservedGradient_jit = numba.njit(nogil=True)(accumulateObservedGradient)
+    accumulateObservedError_jit = numba.njit(nogil=True)(accumulateObservedError)
+    accumulateErrorGradient_jit = numba.njit(nogil=True)(accumulateErrorGradient)
+
+def computeObservedGradient(dcTrain, U, V, Bu, Bv, mu, dAlpha, gradU, gradV, gradBu, gradBv):
+    '''
+        This function computes the residuals of the observed entries and
+        accumulates their gradients, in one pass.
+
+        return:
+            errorR (CSR), sum of squared residuals
+    '''
+    arrRows = dcTrain['rows']
+    arrCols = dcTrain['cols']
+
+    if (g_bNumba):
+        arrError = np.empty(len(arrRows), dtype=U.dtype)
+        dSquared = accumulateObservedGradient_jit(arrRows, arrCols, dcTrain['values'], U, V, Bu, Bv, mu, dAlpha, \
+                                                  arrError, gradU, gradV, gradBu, gradBv)
+        errorR = sparse.csr_matrix((arrError, arrCols, dcTrain['indptr']), shape=dcTrain['shape'])
+        return errorR, dSquared
+
+    # numpy version
+    arrError = dcTrain['values'] - ( np.einsum('ij,ij->i', U[arrRows], V[arrCols]) \
+                                     + Bu[arrRows, 0] + Bv[arrCols, 0] + mu )
+    errorR = sparse.csr_matrix((arrError, arrCols, dcTrain['indptr']), shape=dcTrain['shape'])
+    gradU -= dAlpha * errorR.dot(V)
+    gradV -= dAlpha * errorR.T.dot(U)
+    gradBu[:, 0] -= dAlpha * np.bincount(arrRows, weights=arrError, minlength=U.shape[0])
+    gradBv[:, 0] -= dAlpha * np.bincount(arrCols, weights=arrError, minlength=V.shape[0])
+    return errorR, np.dot(arrError, arrError)
+
+def computeObservedError(dcTrain, U, V, Bu, Bv, mu):
+    '''
+        This function computes the residuals of the observed entries only.
+
+        return:
+            errorR (CSR), sum of squared residuals
+    '''
+    arrRows = dcTrain['rows']
+    arrCols = dcTrain['cols']
+
+    if (g_bNumba):
+        arrError = np.empty(len(arrRows), dtype=U.dtype)
+        dSquared = accumulateObservedError_jit(arrRows, arrCols, dcTrain['values'], U, V, Bu, Bv, mu, arrError)
+    else:
+        arrError = dcTrain['values'] - ( np.einsum('ij,ij->i', U[arrRows], V[arrCols]) \
+                                         + Bu[arrRows, 0] + Bv[arrCols, 0] + mu )
+        dSquared = np.dot(arrError, arrError)
+    return sparse.csr_matrix((arrError, arrCols, dcTrain['indptr']), shape=dcTrain['shape']), dSquared
+
+def computeGradient(dcTrain, errorR_train, errorD_train, errorS_train, U, V, P, Q, Bu, Bv, \
+                    arrAlphas, arrLambdas):
+    '''
+        This function computes the gradients from the residuals of a loss-only
+        pass (see computeLossAndGradient with bGradient=False), e.g., once a
+        trial step of line search is accepted.
+
+        return:
+            gradU, gradV, gradP, gradQ, gradBu, gradBv
+    '''
+    gradU = arrLambdas[0] * U
+    gradV = arrLambdas[0] * V
+    gradP = arrLambdas[1] * P
+    gradQ = arrLambdas[2] * Q
+    gradBu = arrLambdas[3] * Bu
+    gradBv = arrLambdas[4] * Bv
+
+    # R, errorR_train is in the order of dcTrain (CSR order)
+    if (g_bNumba):
+        accumulateErrorGradient_jit(dcTrain['rows'], dcTrain['cols'], errorR_train.data, U, V, arrAlphas[0], \
+                                    gradU, gradV, gradBu, gradBv)
+    else:
+        gradU -= arrAlphas[0] * errorR_train.dot(V)
+        gradV -= arrAlphas[0] * errorR_train.T.dot(U)
+        gradBu[:, 0] -= arrAlphas[0] * np.bincount(dcTrain['rows'], weights=errorR_train.data, minlength=U.shape[0])
+        gradBv[:, 0] -= arrAlphas[0] * np.bincount(dcTrain['cols'], weights=errorR_train.data, minlength=V.shape[0])
+
+    # D, S
+    gradU -= arrAlphas[1] * np.dot(errorD_train, P)
+    gradP -= arrAlphas[1] * np.dot(errorD_train.T, U)
+    gradV -= arrAlphas[2] * np.dot(errorS_train, Q)
+    gradQ -= arrAlphas[2] * np.dot(errorS_train.T, V)
+    return gradU, gradV, gradP, gradQ, gradBu, gradBv
+
+def computeLossAndGradient(dcTrain, R_test, D, S, U, V, P, Q, Bu, Bv, mu, \
+                           weightD_train, weightS_train, arrAlphas, arrLambdas, bGradient=True):
+    '''
+        This function fuses cmf_sgd.computeResidualError_sparse and
+        cmf_sgd.computeParitialGraident (the pass over R is only fused with numba,
+        see module description).
+
+        params:
+            dcTrain   - observed training entries of R, see sortObservedEntries
+            R_test    - observed test entries of R, COO matrix
+            bGradient - if False, only the residuals, rmses and loss are computed
+                        (e.g., for trial steps), and the gradients are None
+
+        return:
+            errorR_train (CSR), errorD_train, errorS_train,
+            rmseR_train, rmseR_test, rmseD_train, rmseS_train, dTotalLost,
+            gradU, gradV, gradP, gradQ, gradBu, gradBv
+    '''
+    # gradients start from the regularization
+    gradU, gradV, gradP, gradQ, gradBu, gradBv = None, None, None, None, None, None
+    if (bGradient):
+        gradU = arrLambdas[0] * U
+        gradV = arrLambdas[0] * V
+        gradP = arrLambdas[1] * P
+        gradQ = arrLambdas[2] * Q
+        gradBu = arrLambdas[3] * Bu
+        gradBv = arrLambdas[4] * Bv
+
+    #===========================================================================
+    # R
+    #===========================================================================
+    if (bGradient):
+        errorR_train, dSquaredErrorR_train = computeObservedGradient(dcTrain, U, V, Bu, Bv, mu, arrAlphas[0], \
+                                                                     gradU, gradV, gradBu, gradBv)
+    else:
+        errorR_train, dSquaredErrorR_train = computeObservedError(dcTrain, U, V, Bu, Bv, mu)
+
+    arrErrorR_test = R_test.data - ( np.einsum('ij,ij->i', U[R_test.row], V[R_test.col]) \
+                                     + Bu[R_test.row, 0] + Bv[R_test.col, 0] + mu )
+
+    #===========================================================================
+    # D, S
+    #===========================================================================
+    errorD_train = np.multiply(weightD_train, D - np.dot(U, P.T))
+    errorS_train = np.multiply(weightS_train, S - np.dot(V, Q.T))
+    if (bGradient):
+        gradU -= arrAlphas[1] * np.dot(errorD_train, P)
+        gradP -= arrAlphas[1] * np.dot(errorD_train.T, U)
+        gradV -= arrAlphas[2] * np.dot(errorS_train, Q)
+        gradQ -= arrAlphas[2] * np.dot(errorS_train.T, V)
+
+    #===========================================================================
+    # rmse and loss
+    #===========================================================================
+    dSquaredErrorD_train = np.vdot(errorD_train, errorD_train)
+    dSquaredErrorS_train = np.vdot(errorS_train, errorS_train)
+    rmseR_train = np.sqrt( dSquaredErrorR_train / len(dcTrain['rows']) )
+    rmseD_train = np.sqrt( dSquaredErrorD_train / weightD_train.sum() )
+    rmseS_train = np.sqrt( dSquaredErrorS_train / weightS_train.sum() )
+    rmseR_test = np.sqrt( np.dot(arrErrorR_test, arrErrorR_test) / R_test.nnz )
+
+    dTotalLost = (arrAlphas[0]/2.0) * dSquaredErrorR_train \
+            + (arrAlphas[1]/2.0) * dSquaredErrorD_train \
+            + (arrAlphas[2]/2.0) * dSquaredErrorS_train \
+            + (arrLambdas[0]/2.0) * ( np.vdot(U, U) + np.vdot(V, V) ) \
+            + (arrLambdas[1]/2.0) * np.vdot(P, P) \
+            + (arrLambdas[2]/2.0) * np.vdot(Q, Q) \
+            + (arrLambdas[3]/2.0) * np.vdot(Bu, Bu) \
+            + (arrLambdas[4]/2.0) * np.vdot(Bv, Bv)
+
+    return errorR_train, errorD_train, errorS_train, \
+           rmseR_train, rmseR_test, rmseD_train, rmseS_train, dTotalLost, \
+           gradU, gradV, gradP, gradQ, gradBu, gradBv
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+'''
+Brief Description:
+    This model keeps a fitted CMF model as a dict, so that it can be reused to
+    warm-start the training on new data (see cmf_sgd.initLowRankMatrices).
+
+    A model is {'U', 'V', 'P', 'Q', 'Bu', 'Bv', 'mu'}, and optionally 'users'/'videos',
+    i.e., the ids of rows of U/V (e.g., lsUserOrder_R/lsVideoOrder_R of
+    data2matrix.transform2mt).
+
+    A model can be saved as a directory (see saveModel):
+        <name>.npy    - one raw .npy file per factor, whose data is aligned, so
+                        that loadModel maps it with mmap_mode in milliseconds and
+                        serving processes share one copy through the page cache
+        model.json    - manifest: format version, model version (hash of the
+                        factors), mu, shapes, ids of rows, preprocessing
+                        parameters (see cmf_sgd.init) and training parameters
+                        (e.g., alphas, lambdas, which fold-in needs)
+
+@author: jason
+'''
+
+import os
+import json
+import shutil
+import tempfile
+import numpy as np
+
+import cmf_als
+
+g_lsFactors = ['U', 'V', 'P', 'Q', 'Bu', 'Bv']
+g_nFormatVersion = 1 # version of the saved model format, bumped on incompatible changes
+g_strManifest = 'model.json'
+
+def packModel(U, V, P, Q, Bu, Bv, mu, lsUserOrder=None, lsVideoOrder=None):
+    '''
+        This function packs the output of fit() into a model
+    '''
+    dcModel = {}
+    dcModel['U'] = U
+    dcModel['V'] = V
+    dcModel['P'] = P
+    dcModel['Q'] = Q
+    dcModel['Bu'] = Bu
+    dcModel['Bv'] = Bv
+    dcModel['mu'] = mu
+    if (lsUserOrder is not None):
+        dcModel['users'] = list(lsUserOrder)
+    if (lsVideoOrder is not None):
+        dcModel['videos'] = list(lsVideoOrder)
+    return dcModel
+
+def solveNewRows(X, Y, weightY, dAlpha, dLambda):
+    '''
+        This function initializes the factors of new rows (users or videos) by
+        ridge regression on their side information, i.e., for each row i
+
+            min  dAlpha/2 * ||weightY[i]∘(Y[i] - x_i·X^T)||^2 + dLambda/2 * ||x_i||^2
+
+        params:
+            X       - P for new users (D = U·P^T), Q for new videos (S = V·Q^T)
+            Y       - rows of D or S of new rows
+            weightY - weight of Y
+    '''
+    return cmf_als.solveRegularizedRows([(dAlpha, weightY, np.multiply(weightY, Y), X)], \
+                                        np.array([dLambda]*X.shape[1]) )
+
+def alignRows(lsOldOrder, lsNewOrder, mtFactors, mtBias, X, Y, weightY, dAlpha, dLambda):
+    '''
+        This function aligns the rows of a factor matrix to a new order: rows of
+        kept ids are copied, rows of removed ids are dropped and rows of new ids
+        are initialized by solveNewRows with zero bias.
+
+        return:
+            mtAligned, mtAlignedBias, #new rows
+    '''
+    dcOldIndex = dict( (oid, i) for i, oid in enumerate(lsOldOrder) )
+    arrNewIndex = np.array([dcOldIndex.get(oid, -1) for oid in lsNewOrder], dtype=np.int64)
+    arrKept = arrNewIndex >= 0
+
+    mtAligned = np.zeros((len(lsNewOrder), mtFactors.shape[1]), dtype=mtFactors.dtype)
+    mtAlignedBias = np.zeros((len(lsNewOrder), 1), dtype=mtBias.dtype)
+    mtAligned[arrKept] = mtFactors[arrNewIndex[arrKept]]
+    mtAlignedBias[arrKept] = mtBias[arrNewIndex[arrKept]]
+
+    arrNew = np.where(~arrKept)[0]
+    if (len(arrNew) > 0):
+        mtAligned[arrNew] = solveNewRows(X, Y[arrNew], weightY[arrNew], dAlpha, dLambda)
+
+    return mtAligned, mtAlignedBias, len(arrNew)
+
+def alignModel(dcModel, lsUserOrder, lsVideoOrder, D, S, weightD, weightS, arrAlphas, arrLambdas):
+    '''
+        This function aligns a model fitted on old data to the users/videos of
+        new data, so that it can be used to warm-start fit().
+
+        params:
+            dcModel      - model with 'users' and 'videos' (see packModel)
+            lsUserOrder  - user ids of rows of new R, D
+            lsVideoOrder - video ids of columns of new R, rows of new S
+            D, S, weightD, weightS - new D, S and their weights, used to initialize
+                           new users/videos
+            arrAlphas, arrLambdas - same as fit()
+
+        return:
+            aligned model
+
+        Note: the columns of D, S (user/video features) must be the same as the
+              ones the model was fitted on.
+    '''
+    U, Bu, nNewUsers = alignRows(dcModel['users'], lsUserOrder, dcModel['U'], dcModel['Bu'], \
+                                 dcModel['P'], D, weightD, arrAlphas[1], arrLambdas[0])
+    V, Bv, nNewVideos = alignRows(dcModel['videos'], lsVideoOrder, dcModel['V'], dcModel['Bv'], \
+                                  dcModel['Q'], S, weightS, arrAlphas[2], arrLambdas[0])
+
+    print("model aligned: %d new users, %d new videos" % (nNewUsers, nNewVideos) )
+
+    return packModel(U, V, dcModel['P'], dcModel['Q'], Bu, Bv, dcModel['mu'], \
+                     lsUserOrder, lsVideoOrder)
+
+def toJson(obj):
+    '''
+        This function converts numpy arrays/scalars (recursively) to json types
+    '''
+    if (isinstance(obj, dict)):
+        return dict( (str(key), toJson(value)) for key, value in obj.items() )
+    if (isinstance(obj, (list, tuple))):
+        return [toJson(item) for item in obj]
+    if (isinstance(obj, np.ndarray)):
+        return obj.tolist()
+    if (isinstance(obj, np.generic)):
+        return obj.item()
+    if (isinstance(obj, (np.dtype, type))):
+        return np.dtype(obj).str
+    return obj
+
+def getModelVersion(dcModel):
+    '''
+        This function returns the hash of the factors and mu of a model, which
+        changes whenever the model is retrained
+    '''
+    from tools import result_cache
+    return result_cache.getCacheKey([np.asarray(dcModel[strName]) for strName in g_lsFactors], \
+                                    float(dcModel['mu']) )
+
+def saveModel(dcModel, strPath, dcPreprocess=None, dcParams=None):
+    '''
+        This function saves a model as a directory (see the module description).
+        The model is written to a temp directory and renamed, so that a reader
+        never sees a partial model.
+
+        params:
+            dcModel      - model (see packModel)
+            strPath      - directory of the model, replaced if it exists
+            dcPreprocess - preprocessing parameters (see cmf_sgd.init)
+            dcParams     - training parameters, e.g., {'alphas', 'lambdas', 'f'}
+
+        return:
+            version of the model
+    '''
+    strPath = os.path.abspath(strPath)
+    strTempPath = tempfile.mkdtemp(suffix='.tmp', dir=os.path.dirname(strPath))
+    try:
+        dcShapes = {}
+        for strName in g_lsFactors:
+            mt = np.ascontiguousarray(dcModel[strName])
+            np.save(os.path.join(strTempPath, strName + '.npy'), mt)
+            dcShapes[strName] = list(mt.shape)
+
+        dcManifest = {}
+        dcManifest['format_version'] = g_nFormatVersion
+        dcManifest['version'] = getModelVersion(dcModel)
+        dcManifest['mu'] = float(dcModel['mu'])
+        dcManifest['dtype'] = np.asarray(dcModel['U']).dtype.str
+        dcManifest['shapes'] = dcShapes
+        dcManifest['users'] = toJson(dcModel.get('users'))
+        dcManifest['videos'] = toJson(dcModel.get('videos'))
+        dcManifest['preprocess'] = toJson(dcPreprocess if dcPreprocess is not None else dcModel.get('preprocess'))
+        dcManifest['params'] = toJson(dcParams if dcParams is not None else dcModel.get('params'))
+        with open(os.path.join(strTempPath, g_strManifest), 'w') as hFile:
+            json.dump(dcManifest, hFile)
+
+        if (os.path.isdir(strPath)):
+            shutil.rmtree(strPath) # mapped files stay valid for running readers
+        os.rename(strTempPath, strPath)
+    except:
+        shutil.rmtree(strTempPath, ignore_errors=True)
+        raise
+
+    return dcManifest['version']
+
+def loadModel(strPath, strMmapMode='r'):
+    '''
+        This function loads a model saved by saveModel.
+
+        params:
+            strMmapMode - mmap_mode of np.load, 'r' maps the factors read-only,
+                          None reads them into memory
+
+        return:
+            model (see packModel) with 'version', 'preprocess' and 'params', in
+            which lists of numbers are converted back to arrays
+    '''
+    with open(os.path.join(strPath, g_strManifest), 'r') as hFile:
+        dcManifest = json.load(hFile)
+
+    nFormatVersion = dcManifest.get('format_version')
+    if (nFormatVersion is None or nFormatVersion > g_nFormatVersion):
+        raise ValueError("unsupported model format version: %s (supported: <=%d)" \
+                         % (nFormatVersion, g_nFormatVersion) )
+
+    dcFactors = {}
+    for strName in g_lsFactors:
+        mt = np.load(os.path.join(strPath, strName + '.npy'), mmap_mode=strMmapMode)
+        if (list(mt.shape) != dcManifest['shapes'][strName]):
+            raise ValueError("corrupted model: %s.shape=%s, expected %s" \
+                             % (strName, mt.shape, dcManifest['shapes'][strName]) )
+        dcFactors[strName] = mt
+
+    dcModel = packModel(dcFactors['U'], dcFactors['V'], dcFactors['P'], dcFactors['Q'], \
+                        dcFactors['Bu'], dcFactors['Bv'], \
+                        np.dtype(dcManifest['dtype']).type(dcManifest['mu']), \
+                        dcManifest['users'], dcManifest['videos'])
+    dcModel['version'] = dcManifest['version']
+
+    for strKey in ['preprocess', 'params']:
+        dcValues = dcManifest.get(strKey)
+        if (dcValues is not None):
+            dcValues = dict( (key, np.array(value) if isinstance(value, list) else value) \
+                             for key, value in dcValues.items() )
+        dcModel[strKey] = dcValues
+    return dcModel
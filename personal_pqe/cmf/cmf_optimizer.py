@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+'''
+Brief Description:
+    This model implements adaptive per-parameter optimizers for the gradient
+    descent of CMF (see cmf_sgd.fit). Each optimizer keeps its own state (e.g.,
+    accumulated squared gradients) for every low rank matrix, and updates the
+    matrices in place, so that badly scaled blocks (e.g., D, S) get their own
+    effective step sizes.
+
+    Supported optimizers:
+        'sgd'     - p -= gamma*g
+        'adagrad' - p -= gamma*g / (sqrt(sum of g^2) + eps)
+        'rmsprop' - p -= gamma*g / (sqrt(moving average of g^2) + eps)
+        'adam'    - p -= gamma*m_hat / (sqrt(v_hat) + eps)
+
+    The adaptive optimizers normalize the gradients, i.e., gamma is (about) the
+    change of each entry per step, while the step of 'sgd' is proportional to
+    the gradient, so each of them has its own default learning rate (see
+    g_dcDefaultRates).
+
+@author: jason
+'''
+
+import numpy as np
+
+g_lsOptimizers = ['sgd', 'adagrad', 'rmsprop', 'adam']
+g_dEpsilon = 1e-8
+g_dRho = 0.9 # decay of rmsprop
+g_dBeta1 = 0.9 # decay of 1st moment of adam
+g_dBeta2 = 0.999 # decay of 2nd moment of adam
+
+# default learning rates, tuned on the scaled features (see cmf_sgd.init) with
+# a random init in [0, 1), a step which increases the loss is rejected by
+# cmf_sgd.fit, so the rates are on the large side
+g_dcDefaultRates = {'sgd':0.03, 'adagrad':0.3, 'rmsprop':0.1, 'adam':0.3}
+
+def getDefaultRate(strOptimizer):
+    '''
+        This function returns the default learning rate of an optimizer
+    '''
+    if (strOptimizer not in g_lsOptimizers):
+        raise ValueError("unknown optimizer: %s" % strOptimizer)
+    return g_dcDefaultRates[strOptimizer]
+
+def createOptimizerState(strOptimizer, lsParams):
+    '''
+        This function allocates the state of an optimizer for the given params.
+
+        params:
+            strOptimizer - name of optimizer, one of g_lsOptimizers
+            lsParams     - list of matrices to optimize, e.g., [U, V, P, Q, Bu, Bv]
+
+        return:
+            dcState - {'name', 'step', 'cache' (squared gradients), 'moment' (adam)}
+    '''
+    if (strOptimizer not in g_lsOptimizers):
+        raise ValueError("unknown optimizer: %s" % strOptimizer)
+
+    dcState = {}
+    dcState['name'] = strOptimizer
+    dcState['step'] = 0
+    dcState['cache'] = [np.zeros_like(param) for param in lsParams] \
+                       if strOptimizer != 'sgd' else None
+    dcState['moment'] = [np.zeros_like(param) for param in lsParams] \
+                        if strOptimizer == 'adam' else None
+    return dcState
+
+def updateParams(dcState, lsParams, lsGrads, gamma):
+    '''
+        This function takes one optimizer step, params and optimizer state are
+        updated in place.
+
+        params:
+            dcState  - state created by createOptimizerState
+            lsParams - matrices to update, in the same order as in createOptimizerState
+            lsGrads  - gradients of lsParams
+            gamma    - learning rate
+    '''
+    strOptimizer = dcState['name']
+    dcState['step'] += 1
+    nStep = dcState['step']
+
+    for i, (param, grad) in enumerate(zip(lsParams, lsGrads)):
+        if (strOptimizer == 'sgd'):
+            param -= gamma*grad
+            continue
+
+        cache = dcState['cache'][i]
+        if (strOptimizer == 'adagrad'):
+            cache += np.square(grad)
+            param -= gamma*grad / (np.sqrt(cache) + g_dEpsilon)
+
+        elif (strOptimizer == 'rmsprop'):
+            cache *= g_dRho
+            cache += (1.0-g_dRho)*np.square(grad)
+            param -= gamma*grad / (np.sqrt(cache) + g_dEpsilon)
+
+        elif (strOptimizer == 'adam'):
+            moment = dcState['moment'][i]
+            moment *= g_dBeta1
+            moment += (1.0-g_dBeta1)*grad
+            cache *= g_dBeta2
+            cache += (1.0-g_dBeta2)*np.square(grad)
+
+            # bias correction is folded into the step size
+            gammaCorrected = gamma * np.sqrt(1.0-g_dBeta2**nStep) / (1.0-g_dBeta1**nStep)
+            param -= gammaCorrected*moment / (np.sqrt(cache) + g_dEpsilon)
@@ -0,0 +1,431 @@
+# -*- coding: utf-8 -*-
+'''
+Brief Description:
+    This model trains CMF on multiple cores. R, D, S and the factors live in
+    shared memory, so that worker processes read and write them without pickling.
+    In each sweep of the alternating least squares (see cmf_als), rows of [U, bu]
+    and [V, bv] are partitioned across a pool of workers, while the coordinator
+    solves P, Q (they are small), synchronizes the sweeps and checks convergence.
+    
+    fitHogwild() is a lock-free asynchronous alternative: workers run mini-batch
+    SGD on disjoint shards of the observed entries and update the shared factors
+    without any lock or barrier within an epoch (Hogwild!).
+    
+    runFolds() runs the folds of cross validation (see cmf_sgd.crossValidate) in
+    a pool of workers which share R, D, S.
+
+@author: jason
+'''
+
+import multiprocessing as mp
+import time
+import numpy as np
+from scipy import sparse
+
+import cmf_sgd
+import cmf_als
+import cmf_trace
+
+g_nBlocksPerWorker = 4 # more blocks than workers for load balance
+g_nHogwildBatchSize = 64 # small batches keep collisions between workers rare
+
+# shared arrays of the current process, name -> numpy view
+g_dcShared = {}
+
+def createSharedArray(tpShape, dtype=np.float64):
+    '''
+        This function allocates an uninitialized array in shared memory.
+
+        return:
+            raw - the underlying shared memory, pass it to workers (see attachSharedArrays)
+            arr - numpy view of raw
+    '''
+    nSize = int(np.prod(tpShape))
+    raw = mp.RawArray('c', max(nSize*np.dtype(dtype).itemsize, 1))
+    arr = np.frombuffer(raw, dtype=dtype, count=nSize).reshape(tpShape)
+    return raw, arr
+
+def shareArrays(dcArrays):
+    '''
+        This function copies the given arrays into shared memory.
+
+        params:
+            dcArrays - name -> numpy array
+
+        return:
+            dcHandles - name -> (raw, dtype, shape), to be passed to attachSharedArrays
+            dcViews   - name -> numpy view of the shared copy
+    '''
+    dcHandles = {}
+    dcViews = {}
+    for strName, arr in dcArrays.items():
+        arr = np.asarray(arr)
+        raw, arrShared = createSharedArray(arr.shape, arr.dtype)
+        arrShared[...] = arr
+        dcHandles[strName] = (raw, arr.dtype, arr.shape)
+        dcViews[strName] = arrShared
+    return dcHandles, dcViews
+
+def attachSharedArrays(dcHandles):
+    '''
+        Pool initializer: makes the shared arrays available to a worker as g_dcShared
+    '''
+    g_dcShared.clear()
+    for strName, (raw, dtype, tpShape) in dcHandles.items():
+        g_dcShared[strName] = np.frombuffer(raw, dtype=dtype, count=int(np.prod(tpShape))).reshape(tpShape)
+
+def getSharedRows(strPrefix, nStart, nEnd, nCols):
+    '''
+        This function returns rows [nStart, nEnd) of a CSR matrix whose data,
+        indices and indptr are shared as strPrefix_data/_indices/_indptr
+    '''
+    arrIndptr = g_dcShared[strPrefix+'_indptr']
+    nLo, nHi = arrIndptr[nStart], arrIndptr[nEnd]
+    return sparse.csr_matrix((g_dcShared[strPrefix+'_data'][nLo:nHi], \
+                              g_dcShared[strPrefix+'_indices'][nLo:nHi], \
+                              arrIndptr[nStart:nEnd+1] - nLo), \
+                             shape=(nEnd-nStart, nCols))
+
+def solveUserBlock(tpTask):
+    '''
+        Worker: solves rows [nStart, nEnd) of [U, bu] and writes them into shared U, Bu
+    '''
+    nStart, nEnd, mu, arrAlphas, arrReg = tpTask
+    V, P, Bv = g_dcShared['V'], g_dcShared['P'], g_dcShared['Bv']
+    f = V.shape[1]
+
+    R_block = getSharedRows('R', nStart, nEnd, V.shape[0])
+    lsTerms = cmf_als.getUserTerms(R_block, g_dcShared['D'][nStart:nEnd], \
+                                   g_dcShared['weightD'][nStart:nEnd], V, P, Bv, mu, arrAlphas)
+    mtUa = cmf_als.solveRegularizedRows(lsTerms, arrReg)
+
+    g_dcShared['U'][nStart:nEnd] = mtUa[:, :f]
+    g_dcShared['Bu'][nStart:nEnd] = mtUa[:, f:]
+    return nEnd - nStart
+
+def solveVideoBlock(tpTask):
+    '''
+        Worker: solves rows [nStart, nEnd) of [V, bv] and writes them into shared V, Bv
+    '''
+    nStart, nEnd, mu, arrAlphas, arrReg = tpTask
+    U, Q, Bu = g_dcShared['U'], g_dcShared['Q'], g_dcShared['Bu']
+    f = U.shape[1]
+
+    R_block = getSharedRows('RT', nStart, nEnd, U.shape[0])
+    lsTerms = cmf_als.getVideoTerms(R_block, g_dcShared['S'][nStart:nEnd], \
+                                    g_dcShared['weightS'][nStart:nEnd], U, Q, Bu, mu, arrAlphas)
+    mtVa = cmf_als.solveRegularizedRows(lsTerms, arrReg)
+
+    g_dcShared['V'][nStart:nEnd] = mtVa[:, :f]
+    g_dcShared['Bv'][nStart:nEnd] = mtVa[:, f:]
+    return nEnd - nStart
+
+def runHogwildShard(tpTask):
+    '''
+        Worker: runs SGD on entries arrPermutation[nStart:nEnd] of R, and updates
+        the shared factors in place without locking.
+    '''
+    nStart, nEnd, nBatchSize, gamma, mu, arrAlphas, arrLambdas = tpTask
+    arrPermutation = g_dcShared['permutation']
+    arrRows, arrCols, arrValues = g_dcShared['R_row'], g_dcShared['R_col'], g_dcShared['R_data']
+    
+    for nBatchStart in xrange(nStart, nEnd, nBatchSize):
+        arrBatch = arrPermutation[nBatchStart:min(nBatchStart+nBatchSize, nEnd)]
+        cmf_sgd.updateMiniBatch(arrRows[arrBatch], arrCols[arrBatch], arrValues[arrBatch], \
+                                g_dcShared['D'], g_dcShared['S'], g_dcShared['weightD'], g_dcShared['weightS'], \
+                                g_dcShared['U'], g_dcShared['V'], g_dcShared['P'], g_dcShared['Q'], \
+                                g_dcShared['Bu'], g_dcShared['Bv'], mu, \
+                                g_dcShared['user_count'], g_dcShared['video_count'], len(arrPermutation), \
+                                arrAlphas, arrLambdas, gamma, bUpdatePQ=False)
+    return nEnd - nStart
+
+def updateFeatureFactors(D, S, weightD, weightS, U, V, P, Q, arrUserCount, arrVideoCount, \
+                         arrAlphas, arrLambdas, gamma):
+    '''
+        This function takes one full gradient step on P, Q in place, i.e., the sum 
+        of their steps in the batches of an epoch of cmf_sgd.updateMiniBatch() 
+        (rows of users/videos without training entries aren't in any batch).
+    '''
+    errorD = np.multiply(weightD, D - np.dot(U, P.T)) * (arrUserCount > 0).reshape(-1, 1)
+    errorS = np.multiply(weightS, S - np.dot(V, Q.T)) * (arrVideoCount > 0).reshape(-1, 1)
+    P -= gamma*( -1.0*arrAlphas[1]*np.dot(errorD.T, U) + arrLambdas[1]*P )
+    Q -= gamma*( -1.0*arrAlphas[2]*np.dot(errorS.T, V) + arrLambdas[2]*Q )
+
+def getBlocks(nRows, nBlocks):
+    '''
+        This function cuts [0, nRows) into at most nBlocks contiguous ranges
+    '''
+    arrBounds = np.unique(np.linspace(0, nRows, nBlocks+1).astype(int))
+    return zip(arrBounds[:-1], arrBounds[1:])
+
+def fit(R, D, S, weightR_train, weightR_test, weightD_train, weightS_train, \
+        f, arrAlphas, arrLambdas, nMaxStep, \
+        lsTrainingTrace, bDebugInfo=True, nWorkers=None, dtype=np.float64, dcInitModel=None):
+    '''
+        This function train CMF by parallel alternating least squares, params and
+        returns are the same as cmf_als.fit().
+
+        params:
+            nWorkers - #worker processes, use all cores if None
+            dtype    - dtype of low rank matrices
+            dcInitModel - warm start from this model, see cmf_sgd.initLowRankMatrices
+    '''
+    if (nWorkers is None):
+        nWorkers = mp.cpu_count()
+
+    #===========================================================================
+    # prepare shared data
+    #===========================================================================
+    R_train = cmf_sgd.getObservedEntries(R, weightR_train, dtype)
+    R_test = cmf_sgd.getObservedEntries(R, weightR_test, dtype)
+    mu = R_train.data.mean()
+    U, P, V, Q, Bu, Bv, Jm, Jn = cmf_sgd.initLowRankMatrices(R, D, S, f, dtype, dcInitModel)
+
+    R_csr = R_train.tocsr()
+    RT_csr = R_train.T.tocsr()
+
+    dcHandles, dcShared = shareArrays({'R_data':R_csr.data, 'R_indices':R_csr.indices, 'R_indptr':R_csr.indptr, \
+                                       'RT_data':RT_csr.data, 'RT_indices':RT_csr.indices, 'RT_indptr':RT_csr.indptr, \
+                                       'D':D, 'S':S, 'weightD':weightD_train, 'weightS':weightS_train, \
+                                       'U':U, 'V':V, 'P':P, 'Q':Q, 'Bu':Bu, 'Bv':Bv})
+    del R_csr, RT_csr
+    U, V, P, Q, Bu, Bv = [dcShared[strName] for strName in ['U', 'V', 'P', 'Q', 'Bu', 'Bv']]
+    D_shared, S_shared = dcShared['D'], dcShared['S']
+    weightD_shared, weightS_shared = dcShared['weightD'], dcShared['weightS']
+
+    # regularization of [U, bu], [V, bv], P, Q
+    arrRegU = np.array([arrLambdas[0]]*f + [arrLambdas[3]])
+    arrRegV = np.array([arrLambdas[0]]*f + [arrLambdas[4]])
+    arrRegP = np.array([arrLambdas[1]]*f)
+    arrRegQ = np.array([arrLambdas[2]]*f)
+
+    lsUserTasks = [(nStart, nEnd, mu, arrAlphas, arrRegU) \
+                   for (nStart, nEnd) in getBlocks(R.shape[0], nWorkers*g_nBlocksPerWorker)]
+    lsVideoTasks = [(nStart, nEnd, mu, arrAlphas, arrRegV) \
+                    for (nStart, nEnd) in getBlocks(R.shape[1], nWorkers*g_nBlocksPerWorker)]
+
+    #===========================================================================
+    # sweep until converge or max steps
+    #===========================================================================
+    pool = mp.Pool(nWorkers, initializer=attachSharedArrays, initargs=(dcHandles,))
+    try:
+        dLastLoss = None
+        dcLogger = cmf_trace.createLogger()
+        for nStep in xrange(nMaxStep):
+            # U, bu and V, bv by workers, map() returns after all blocks are written
+            pool.map(solveUserBlock, lsUserTasks)
+            pool.map(solveVideoBlock, lsVideoTasks)
+
+            # P, Q by coordinator
+            P[...] = cmf_als.solveRegularizedRows([(arrAlphas[1], weightD_shared.T, \
+                                                    np.multiply(weightD_shared, D_shared).T, U)], arrRegP)
+            Q[...] = cmf_als.solveRegularizedRows([(arrAlphas[2], weightS_shared.T, \
+                                                    np.multiply(weightS_shared, S_shared).T, V)], arrRegQ)
+
+            #===================================================================
+            # evaluate
+            #===================================================================
+            dummy, dummy, dummy, \
+            dRmseR_train, dRmseR_test, dRmseD, dRmseS, \
+            dLoss = cmf_sgd.computeResidualError_sparse(R_train, R_test, D_shared, S_shared, \
+                                                        U, V, P, Q, Bu, Bv, mu, \
+                                                        weightD_shared, weightS_shared, \
+                                                        arrAlphas, arrLambdas)
+
+            # save RMSE
+            dcRMSE = {}
+            dcRMSE['rmseR'] = dRmseR_train
+            dcRMSE['rmseR_test'] = dRmseR_test
+            dcRMSE['rmseD'] = dRmseD
+            dcRMSE['rmseS'] = dRmseS
+            dcRMSE['loss'] = dLoss
+            cmf_trace.recordTrace(lsTrainingTrace, nStep, dcRMSE)
+
+            # output
+            if (bDebugInfo):
+                cmf_trace.logProgress(dcLogger, "sweep %d (%d workers)" % (nStep, nWorkers), dcRMSE)
+
+            #===================================================================
+            # check convergence
+            #===================================================================
+            if (dLastLoss is not None and abs(dLastLoss-dLoss) <= cmf_sgd.g_dConvergenceThresold):
+                print("converged @ sweep %d: change:%f, loss=%f, rmseR_test=%f" % \
+                      (nStep, dLastLoss-dLoss, dLoss, dRmseR_test) )
+                break
+            dLastLoss = dLoss
+        #END sweep
+    finally:
+        pool.terminate()
+        pool.join()
+
+    # copy factors out of shared memory
+    return np.array(U), np.array(V), np.array(P), np.array(Q), \
+           np.array(Bu), np.array(Bv), mu, Jm, Jn
+
+def fitHogwild(R, D, S, weightR_train, weightR_test, weightD_train, weightS_train, \
+               f, arrAlphas, arrLambdas, nMaxEpoch, \
+               lsTrainingTrace, bDebugInfo=True, nWorkers=None, \
+               nBatchSize=g_nHogwildBatchSize, dLearningRate=0.01, strSchedule='invscaling', \
+               dtype=np.float64, dcInitModel=None):
+    '''
+        This function train CMF by lock-free asynchronous SGD (Hogwild!). 
+        
+        In each epoch the observed entries of R are shuffled and cut into one 
+        disjoint shard per worker; each worker runs cmf_sgd.updateMiniBatch() on 
+        its shard (with the matching rows of D and S) directly on the shared 
+        factors. Workers are processes, so their numpy kernels never contend for 
+        the GIL, and as R is very sparse, two workers rarely touch the same row.
+        P and Q are dense (every batch touches all of their rows), so workers
+        don't update them; the coordinator takes one full gradient step on them
+        at the end of an epoch (see updateFeatureFactors), then evaluates.
+        
+        params and returns are the same as cmf_sgd.fitMiniBatch(), besides:
+            nWorkers - #worker processes, use all cores if None
+            
+        Note: the throughput (updated entries of R per second) of each epoch is 
+              saved as 'updates_per_sec' in lsTrainingTrace.
+    '''
+    if (nWorkers is None):
+        nWorkers = mp.cpu_count()
+        
+    #===========================================================================
+    # prepare shared data
+    #===========================================================================
+    R_train = cmf_sgd.getObservedEntries(R, weightR_train, dtype)
+    R_test = cmf_sgd.getObservedEntries(R, weightR_test, dtype)
+    mu = R_train.data.mean()
+    U, P, V, Q, Bu, Bv, Jm, Jn = cmf_sgd.initLowRankMatrices(R, D, S, f, dtype, dcInitModel)
+    nEntries = R_train.nnz
+    
+    dcHandles, dcShared = shareArrays({'R_row':R_train.row, 'R_col':R_train.col, 'R_data':R_train.data, \
+                                       'permutation':np.arange(nEntries), \
+                                       'user_count':np.bincount(R_train.row, minlength=R.shape[0]).astype(np.float64), \
+                                       'video_count':np.bincount(R_train.col, minlength=R.shape[1]).astype(np.float64), \
+                                       'D':D, 'S':S, 'weightD':weightD_train, 'weightS':weightS_train, \
+                                       'U':U, 'V':V, 'P':P, 'Q':Q, 'Bu':Bu, 'Bv':Bv})
+    U, V, P, Q, Bu, Bv = [dcShared[strName] for strName in ['U', 'V', 'P', 'Q', 'Bu', 'Bv']]
+    arrPermutation = dcShared['permutation']
+    
+    #===========================================================================
+    # iterate over epochs
+    #===========================================================================
+    pool = mp.Pool(nWorkers, initializer=attachSharedArrays, initargs=(dcHandles,))
+    try:
+        dLastLoss = None
+        dcLogger = cmf_trace.createLogger()
+        for nEpoch in xrange(nMaxEpoch):
+            gamma = cmf_sgd.getLearningRate(dLearningRate, nEpoch, strSchedule)
+            
+            # disjoint shards of a new shuffle
+            arrPermutation[...] = np.random.permutation(nEntries)
+            lsTasks = [(nStart, nEnd, nBatchSize, gamma, mu, arrAlphas, arrLambdas) \
+                       for (nStart, nEnd) in getBlocks(nEntries, nWorkers)]
+            
+            dStartTime = time.time()
+            nUpdates = sum(pool.map(runHogwildShard, lsTasks))
+            dUpdatesPerSec = nUpdates / max(time.time()-dStartTime, 1e-9)
+            
+            # P, Q by coordinator, after all shards are finished
+            updateFeatureFactors(dcShared['D'], dcShared['S'], dcShared['weightD'], dcShared['weightS'], \
+                                 U, V, P, Q, dcShared['user_count'], dcShared['video_count'], \
+                                 arrAlphas, arrLambdas, gamma)
+            
+            #===================================================================
+            # evaluate
+            #===================================================================
+            dummy, dummy, dummy, \
+            dRmseR_train, dRmseR_test, dRmseD, dRmseS, \
+            dLoss = cmf_sgd.computeResidualError_sparse(R_train, R_test, dcShared['D'], dcShared['S'], \
+                                                        U, V, P, Q, Bu, Bv, mu, \
+                                                        dcShared['weightD'], dcShared['weightS'], \
+                                                        arrAlphas, arrLambdas)
+            
+            # save RMSE
+            dcRMSE = {}
+            dcRMSE['rmseR'] = dRmseR_train
+            dcRMSE['rmseR_test'] = dRmseR_test
+            dcRMSE['rmseD'] = dRmseD
+            dcRMSE['rmseS'] = dRmseS
+            dcRMSE['loss'] = dLoss
+            dcRMSE['updates_per_sec'] = dUpdatesPerSec
+            cmf_trace.recordTrace(lsTrainingTrace, nEpoch, dcRMSE)
+            
+            # output
+            if (bDebugInfo):
+                cmf_trace.logProgress(dcLogger, "epoch %d (%d workers, gamma=%f)" % (nEpoch, nWorkers, gamma), dcRMSE)
+            
+            #===================================================================
+            # check convergence
+            #===================================================================
+            if (dLastLoss is not None and abs(dLastLoss-dLoss) <= cmf_sgd.g_dConvergenceThresold):
+                print("converged @ epoch %d: change:%f, loss=%f, rmseR_test=%f, %.0f updates/s" % \
+                      (nEpoch, dLastLoss-dLoss, dLoss, dRmseR_test, dUpdatesPerSec) )
+                break
+            dLastLoss = dLoss
+        #END epoch
+    finally:
+        pool.terminate()
+        pool.join()
+    
+    # copy factors out of shared memory
+    return np.array(U), np.array(V), np.array(P), np.array(Q), \
+           np.array(Bu), np.array(Bv), mu, Jm, Jn
+
+def runSharedFold(tpTask):
+    '''
+        Worker: trains and tests one fold of cross validation (see cmf_sgd.runFold)
+        on the shared R, D, S
+    '''
+    arrTrainRows, arrTrainCols, arrTestRows, arrTestCols, tpShape, nSeed, dcFoldParams = tpTask
+
+    if ('R' in g_dcShared):
+        R = g_dcShared['R']
+    else:
+        R = getSharedRows('R', 0, tpShape[0], tpShape[1])
+    weightR_train = sparse.coo_matrix((np.ones(len(arrTrainRows), dtype=bool), (arrTrainRows, arrTrainCols)), \
+                                      shape=tpShape)
+    weightR_test = sparse.coo_matrix((np.ones(len(arrTestRows), dtype=bool), (arrTestRows, arrTestCols)), \
+                                     shape=tpShape)
+
+    return cmf_sgd.runFold(R, g_dcShared['D'], g_dcShared['S'], weightR_train, weightR_test, \
+                           g_dcShared['weightD'], g_dcShared['weightS'], nSeed=nSeed, **dcFoldParams)
+
+def runFolds(R, D, S, weightD, weightS, lsFolds, nWorkers, dcFoldParams, lsSeeds=None):
+    '''
+        This function runs the folds of cmf_sgd.crossValidate() in a pool of
+        processes. R (dense, or CSR), D, S and their weights are copied into
+        shared memory once, only the index masks of each fold are sent to workers.
+
+        params:
+            lsFolds      - list of (weightR_train, weightR_test) index-based masks
+            nWorkers     - #worker processes
+            dcFoldParams - keyword params of cmf_sgd.runFold()
+            lsSeeds      - seed of each fold (see 'nSeed' of cmf_sgd.runFold), 
+                           otherwise workers share the random state of this process
+
+        return:
+            list of the results of cmf_sgd.runFold() in the order of lsFolds
+    '''
+    dcArrays = {'D':D, 'S':S, 'weightD':weightD, 'weightS':weightS}
+    if (sparse.issparse(R)):
+        R_csr = R.tocsr()
+        dcArrays.update({'R_data':R_csr.data, 'R_indices':R_csr.indices, 'R_indptr':R_csr.indptr})
+    else:
+        dcArrays['R'] = R
+    dcHandles, dcShared = shareArrays(dcArrays)
+
+    lsTasks = []
+    for i, (weightR_train, weightR_test) in enumerate(lsFolds):
+        W_train = weightR_train.tocoo()
+        W_test = weightR_test.tocoo()
+        nSeed = lsSeeds[i] if lsSeeds is not None else None
+        lsTasks.append((W_train.row, W_train.col, W_test.row, W_test.col, R.shape, nSeed, dcFoldParams))
+
+    pool = mp.Pool(min(nWorkers, len(lsTasks)), initializer=attachSharedArrays, initargs=(dcHandles,))
+    try:
+        lsResults = pool.map(runSharedFold, lsTasks, chunksize=1)
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return lsResults
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+'''
+Brief Description:
+    This model scores new users and videos with a trained CMF model (see
+    cmf_model.packModel) without retraining. The factors of a new user (video)
+    are folded in, i.e., with V, Bv, P (U, Bu, Q) of the model fixed, only the
+    row of U, bu (V, bv) is solved by a small regularized least squares on its
+    D-row (S-row) and its known ratios, the same problem cmf_als solves in a sweep.
+
+    predictPairs() scores (user, video) pairs of a model in chunks, without
+    building the m-by-n prediction matrix.
+
+@author: jason
+'''
+
+import numpy as np
+from scipy import sparse
+
+import cmf_sgd
+import cmf_als
+
+g_nChunkSize = 65536 # #pairs scored at once by predictPairs
+
+def predictPairs(dcModel, arrUsers, arrVideos, nChunkSize=g_nChunkSize):
+    '''
+        This function predicts the ratios of (user, video) pairs, i.e.,
+        U[i]·V[j]^T + bu[i] + bv[j] + mu, chunk by chunk, so that only 
+        nChunkSize rows of U and V are gathered at a time.
+
+        params:
+            dcModel    - trained model (see cmf_model.packModel)
+            arrUsers   - row indices of users in U
+            arrVideos  - row indices of videos in V, the same length as arrUsers
+            nChunkSize - #pairs scored at once
+
+        return:
+            predicted ratios of the pairs, in the dtype of the model
+    '''
+    arrUsers = np.asarray(arrUsers, dtype=np.int64).ravel()
+    arrVideos = np.asarray(arrVideos, dtype=np.int64).ravel()
+    if (len(arrUsers) != len(arrVideos)):
+        raise ValueError("#users (%d) and #videos (%d) don't match" % (len(arrUsers), len(arrVideos)) )
+
+    U, V, Bu, Bv, mu = dcModel['U'], dcModel['V'], dcModel['Bu'], dcModel['Bv'], dcModel['mu']
+    arrPred = np.empty(len(arrUsers), dtype=U.dtype)
+    for nStart in xrange(0, len(arrUsers), nChunkSize):
+        nEnd = nStart + nChunkSize
+        arrPred[nStart:nEnd] = cmf_sgd.computeObservedPrediction(U, V, Bu, Bv, mu, \
+                                                                 arrUsers[nStart:nEnd], arrVideos[nStart:nEnd])
+    return arrPred
+
+def getKnownRatios(R_new, weightR_new, nRows):
+    '''
+        This function returns the known ratios of new rows as a COO matrix,
+        an empty matrix if R_new is None.
+    '''
+    if (R_new is None):
+        return sparse.coo_matrix((nRows, 0))
+    return cmf_sgd.getObservedEntries(R_new, weightR_new if weightR_new is not None else R_new != 0)
+
+def compressColumns(R_obs, X, Bias):
+    '''
+        This function drops the columns without any known ratio, so that the cost
+        of fold-in doesn't depend on the total #users (#videos).
+
+        return:
+            R_obs, X, Bias restricted to the observed columns
+    '''
+    arrCols, arrColIndex = np.unique(R_obs.col, return_inverse=True)
+    R_compressed = sparse.coo_matrix((R_obs.data, (R_obs.row, arrColIndex)), \
+                                     shape=(R_obs.shape[0], len(arrCols)) )
+    return R_compressed, X[arrCols], Bias[arrCols]
+
+def foldInUsers(dcModel, D_new, weightD_new, arrAlphas, arrLambdas, R_new=None, weightR_new=None):
+    '''
+        This function solves U rows and biases of new users.
+
+        params:
+            dcModel     - trained model
+            D_new       - k-by-l, D-rows of the new users
+            weightD_new - weights of D_new
+            arrAlphas, arrLambdas - same as training
+            R_new       - k-by-n (dense or sparse), known ratios of the new users
+                          over the videos of the model, optional
+            weightR_new - weights of R_new, non-zero entries of R_new are used if None
+
+        return:
+            U_new, Bu_new
+    '''
+    U = dcModel['U']
+    f = U.shape[1]
+    D_new = np.atleast_2d(D_new)
+    weightD_new = np.atleast_2d(weightD_new)
+
+    R_obs, V, Bv = compressColumns(getKnownRatios(R_new, weightR_new, D_new.shape[0]), \
+                                   dcModel['V'], dcModel['Bv'])
+    lsTerms = cmf_als.getUserTerms(R_obs, D_new, weightD_new, V, dcModel['P'], Bv, dcModel['mu'], arrAlphas)
+    mtUa = cmf_als.solveRegularizedRows(lsTerms, np.array([arrLambdas[0]]*f + [arrLambdas[3]]) )
+
+    return mtUa[:, :f].astype(U.dtype), mtUa[:, f:].astype(U.dtype)
+
+def foldInVideos(dcModel, S_new, weightS_new, arrAlphas, arrLambdas, R_new=None, weightR_new=None):
+    '''
+        This function solves V rows and biases of new videos, it is symmetric to
+        foldInUsers.
+
+        params:
+            S_new       - k-by-h, S-rows of the new videos
+            R_new       - m-by-k (dense or sparse), known ratios of the new videos
+                          from the users of the model (i.e., new columns of R), optional
+
+        return:
+            V_new, Bv_new
+    '''
+    V = dcModel['V']
+    f = V.shape[1]
+    S_new = np.atleast_2d(S_new)
+    weightS_new = np.atleast_2d(weightS_new)
+
+    if (R_new is not None):
+        R_new = R_new.T
+        weightR_new = weightR_new.T if weightR_new is not None else None
+    R_obs, U, Bu = compressColumns(getKnownRatios(R_new, weightR_new, S_new.shape[0]), \
+                                   dcModel['U'], dcModel['Bu'])
+    lsTerms = cmf_als.getVideoTerms(R_obs, S_new, weightS_new, U, dcModel['Q'], Bu, dcModel['mu'], arrAlphas)
+    mtVa = cmf_als.solveRegularizedRows(lsTerms, np.array([arrLambdas[0]]*f + [arrLambdas[4]]) )
+
+    return mtVa[:, :f].astype(V.dtype), mtVa[:, f:].astype(V.dtype)
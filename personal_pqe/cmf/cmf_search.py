@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+'''
+Brief Description:
+    This model searches hyperparameters of CMF (f, alphas, lambdas and video
+    reduction ratio) by grid, random or Latin hypercube sampling. Trials are run
+    by a bounded pool of worker processes, and each finished trial is appended
+    to a csv results table immediately, so that a long search can be watched
+    (or killed) without losing the finished trials.
+
+    searchSuccessiveHalving() saves the budget of bad trials: every trial starts
+    with a few steps on a few folds, and only the best ones (ranked on the test
+    RMSE recorded in the training trace) are promoted to larger budgets.
+
+    A search space is a dict: parameter name -> spec, where
+        name - 'f', 'c' (video reduction ratio), 'alpha_k' (k-th alpha, 1-based),
+               'lambda' (all lambdas) or 'lambda_k' (k-th lambda, 1-based)
+        spec - a list of candidate values, or
+               (low, high) for a uniform range, or
+               (low, high, 'log') for a log-uniform range
+    e.g., {'f':[5, 10, 20], 'alpha_2':(0.001, 10.0, 'log'), 'c':(0.1, 0.9)}
+
+@author: jason
+'''
+
+import os
+import csv
+import time
+import itertools
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+
+import cmf_sgd
+
+g_lsMethods = ['grid', 'random', 'lhs']
+g_lsMetrics = ['rmse_mean', 'rmse_std', 'mae_mean', 'mae_std']
+g_strTraceMetric = 'rmseR_test' # field of the training trace which ranks the rungs
+
+def getGridValues(spec, nGridPoints):
+    '''
+        This function returns the grid values of a spec
+    '''
+    if (isinstance(spec, list)):
+        return spec
+    if (len(spec) == 3 and spec[2] == 'log'):
+        return list(np.logspace(np.log10(spec[0]), np.log10(spec[1]), nGridPoints))
+    return list(np.linspace(spec[0], spec[1], nGridPoints))
+
+def getQuantileValue(spec, dQuantile):
+    '''
+        This function maps a quantile in [0, 1) to a value of a spec
+    '''
+    if (isinstance(spec, list)):
+        return spec[min(int(dQuantile*len(spec)), len(spec)-1)]
+    if (len(spec) == 3 and spec[2] == 'log'):
+        return float(np.exp(np.log(spec[0]) + dQuantile*(np.log(spec[1])-np.log(spec[0])) ))
+    return float(spec[0] + dQuantile*(spec[1]-spec[0]))
+
+def getTrials(dcSpace, strMethod, nTrials=20, nGridPoints=5, nSeed=None):
+    '''
+        This function samples the trials of a search space.
+
+        params:
+            dcSpace     - search space, see module description
+            strMethod   - 'grid': all combinations of grid values (nTrials is not used);
+                          'random': nTrials independent samples;
+                          'lhs': nTrials Latin hypercube samples, i.e., the range of
+                                 each parameter is cut into nTrials strata, and each
+                                 stratum is sampled exactly once
+            nGridPoints - #grid values of a range in grid search
+            nSeed       - seed of sampling
+
+        return:
+            list of trials, each is a dict: parameter name -> value
+    '''
+    lsNames = sorted(dcSpace.keys())
+
+    if (strMethod == 'grid'):
+        lsGrids = [getGridValues(dcSpace[strName], nGridPoints) for strName in lsNames]
+        return [dict(zip(lsNames, tpValues)) for tpValues in itertools.product(*lsGrids)]
+
+    rng = np.random.RandomState(nSeed)
+    if (strMethod == 'random'):
+        mtQuantiles = rng.rand(nTrials, len(lsNames))
+    elif (strMethod == 'lhs'):
+        mtQuantiles = np.empty((nTrials, len(lsNames)))
+        for j in xrange(len(lsNames)):
+            mtQuantiles[:, j] = (rng.permutation(nTrials) + rng.rand(nTrials)) / nTrials
+    else:
+        raise ValueError("unknown search method: %s" % strMethod)
+
+    return [dict( (strName, getQuantileValue(dcSpace[strName], mtQuantiles[i, j])) \
+                  for j, strName in enumerate(lsNames) ) \
+            for i in xrange(nTrials)]
+
+def getTrialParams(dcBaseParams, dcTrial):
+    '''
+        This function applies a trial on the base params of testCMF()
+    '''
+    dcParams = dict(dcBaseParams)
+    dcParams['alphas'] = np.array(dcBaseParams['alphas'], dtype=np.float64)
+    dcParams['lambdas'] = np.array(dcBaseParams['lambdas'], dtype=np.float64)
+
+    for strName, value in dcTrial.items():
+        if (strName == 'f'):
+            dcParams['f'] = int(value)
+        elif (strName == 'c'):
+            dcParams['video_reduction_ratio'] = value
+        elif (strName == 'lambda'):
+            dcParams['lambdas'][:] = value
+        elif (strName.startswith('alpha_')):
+            dcParams['alphas'][int(strName[len('alpha_'):])-1] = value
+        elif (strName.startswith('lambda_')):
+            dcParams['lambdas'][int(strName[len('lambda_'):])-1] = value
+        else:
+            raise ValueError("unknown parameter: %s" % strName)
+    return dcParams
+
+def getTraceMetric(lsTraces, nMaxStep, strMetric=g_strTraceMetric):
+    '''
+        This function returns the mean over folds of a metric of the training
+        traces at the budget, i.e., the last recorded step before nMaxStep.
+
+        params:
+            lsTraces  - training trace of each fold, a structured array (see
+                        cmf_trace) or a list of dicts, None if unknown
+            nMaxStep  - budget of steps
+
+        return:
+            the mean, nan if any trace is unknown or has no such record
+    '''
+    lsValues = []
+    for trace in lsTraces:
+        if (trace is None or len(trace) == 0):
+            return np.nan
+        if (isinstance(trace, np.ndarray)):
+            arrSteps = trace['step']
+            arrValues = trace[strMetric].astype(np.float64)
+        else:
+            arrSteps = np.array([dcRecord['step'] for dcRecord in trace])
+            arrValues = np.array([dcRecord.get(strMetric, np.nan) for dcRecord in trace], dtype=np.float64)
+        arrValid = (arrSteps < nMaxStep) & ~np.isnan(arrValues)
+        if (not arrValid.any()):
+            return np.nan
+        lsValues.append(arrValues[arrValid][np.argmax(arrSteps[arrValid])])
+    return np.mean(lsValues) if len(lsValues) > 0 else np.nan
+
+def runTrial(tpTask):
+    '''
+        Worker: runs one trial
+
+        return:
+            a row of results table, with 'rmse_trace' (see getTraceMetric) if
+            fnObjective returns the training traces as well
+    '''
+    nTrial, dcTrial, dcBaseParams, fnObjective = tpTask
+    dStart = time.time()
+    dcParams = getTrialParams(dcBaseParams, dcTrial)
+    tpResult = fnObjective(**dcParams)
+
+    dcRow = {'trial':nTrial, 'seconds':time.time()-dStart}
+    dcRow.update(dcTrial)
+    dcRow.update(dict(zip(g_lsMetrics, tpResult[:len(g_lsMetrics)])))
+    if (len(tpResult) > len(g_lsMetrics)):
+        dcRow['rmse_trace'] = getTraceMetric(tpResult[len(g_lsMetrics)], dcParams['max_step'])
+    return dcRow
+
+def getRankMetric(dcRow):
+    '''
+        This function returns the metric which ranks a trial in successive
+        halving, i.e., rmse_trace, or rmse_mean if the trace is unknown, inf if
+        both are nan (e.g., a diverged trial), so that it is ranked last
+    '''
+    dValue = dcRow.get('rmse_trace', np.nan)
+    if (np.isnan(dValue)):
+        dValue = dcRow['rmse_mean']
+    return np.inf if np.isnan(dValue) else dValue
+
+def runTrials(lsTasks, lsTrials, nWorkers, writer=None, fileResult=None, dcExtra=None):
+    '''
+        This function runs trials on a bounded pool and writes each finished
+        one into the results table.
+
+        params:
+            lsTasks    - tasks of runTrial
+            lsTrials   - all trials, for output
+            nWorkers   - #trials run at the same time, run in this process if None or 1
+            writer     - csv.DictWriter of the results table, optional
+            fileResult - file of writer
+            dcExtra    - extra columns of each row, e.g., rung of successive halving
+
+        return:
+            list of rows in the order they finished
+    '''
+    pool = None
+    lsResults = []
+    try:
+        if (nWorkers is None or nWorkers <= 1):
+            iterResults = itertools.imap(runTrial, lsTasks)
+        else:
+            # a fresh process per trial, so that memory of a trial is released
+            pool = mp.Pool(min(nWorkers, len(lsTasks)), maxtasksperchild=1)
+            iterResults = pool.imap_unordered(runTrial, lsTasks, chunksize=1)
+
+        for dcRow in iterResults:
+            dcRow.update(dcExtra or {})
+            lsResults.append(dcRow)
+            if (writer is not None):
+                writer.writerow(dcRow)
+                fileResult.flush()
+            print("trial %d (%d/%d): %s, rmse=%f" % (dcRow['trial'], len(lsResults), len(lsTasks), \
+                                                     lsTrials[dcRow['trial']], dcRow['rmse_mean']) )
+    finally:
+        if (pool is not None):
+            pool.terminate()
+            pool.join()
+    return lsResults
+
+def openResultTable(strResultPath, lsColumns):
+    '''
+        This function opens a csv results table to append, the header is written
+        if it is a new table.
+
+        return:
+            file, csv.DictWriter; (None, None) if strResultPath is None
+    '''
+    if (strResultPath is None):
+        return None, None
+    bNewFile = not os.path.exists(strResultPath) or os.path.getsize(strResultPath) == 0
+    fileResult = open(strResultPath, 'ab')
+    writer = csv.DictWriter(fileResult, fieldnames=lsColumns, extrasaction='ignore')
+    if (bNewFile):
+        writer.writeheader()
+    return fileResult, writer
+
+def searchParameters(dcSpace, dcBaseParams, strMethod='random', nTrials=20, nWorkers=None, \
+                     strResultPath=None, nGridPoints=5, nSeed=None, fnObjective=cmf_sgd.testCMF):
+    '''
+        This function searches hyperparameters.
+
+        params:
+            dcSpace       - search space, see module description
+            dcBaseParams  - params of fnObjective, the searched ones are overwritten by trials
+            strMethod     - 'grid', 'random' or 'lhs', see getTrials
+            nTrials       - #trials of random and lhs
+            nWorkers      - #trials run at the same time, run in this process if None or 1
+            strResultPath - csv results table, each finished trial is appended to it
+            nGridPoints   - see getTrials
+            nSeed         - see getTrials
+            fnObjective   - a module level function (it is sent to workers), which
+                            takes the params and returns (rmse_mean, rmse_std,
+                            mae_mean, mae_std), testCMF() by default
+
+        return:
+            results table, a DataFrame sorted by rmse_mean
+
+        Note: as trials run in daemonic worker processes, fnObjective can't start
+              its own pool (e.g., 'parallel' engine, parallel folds).
+    '''
+    lsTrials = getTrials(dcSpace, strMethod, nTrials, nGridPoints, nSeed)
+    lsTasks = [(i, dcTrial, dcBaseParams, fnObjective) for i, dcTrial in enumerate(lsTrials)]
+    lsColumns = ['trial'] + sorted(dcSpace.keys()) + g_lsMetrics + ['seconds']
+    print("searching %d trials by %s..." % (len(lsTasks), strMethod) )
+
+    fileResult, writer = openResultTable(strResultPath, lsColumns)
+    try:
+        lsResults = runTrials(lsTasks, lsTrials, nWorkers, writer, fileResult)
+    finally:
+        if (fileResult is not None):
+            fileResult.close()
+
+    df = pd.DataFrame(lsResults, columns=lsColumns)
+    df.sort_values('rmse_mean', inplace=True)
+    print("search finished, best: %s" % df.iloc[0].to_dict() )
+    return df
+
+def searchSuccessiveHalving(dcSpace, dcBaseParams, strMethod='random', nTrials=27, \
+                            nMinStep=10, nMinFolds=1, nEta=3, nWorkers=None, \
+                            strResultPath=None, nGridPoints=5, nSeed=None, fnObjective=cmf_sgd.testCMF):
+    '''
+        This function searches hyperparameters by successive halving: all trials
+        first run with a small budget, i.e., nMinStep steps on nMinFolds folds, 
+        then only the best 1/nEta of them are promoted to the next rung, whose
+        budget is nEta times larger, until the full budget (dcBaseParams['max_step']
+        steps on dcBaseParams['folds'] folds) is reached.
+
+        Trials are ranked by rmse_trace, the rmseR_test of the training trace at
+        the last recorded step of the budget, averaged over folds (see
+        getTraceMetric), fnObjective is called with return_traces=True for it.
+        If fnObjective doesn't return the traces, rmse_mean is used instead.
+        A promoted trial is rerun from scratch with the larger budget, as the
+        models of folds are not kept between rungs.
+
+        params:
+            nMinStep  - #steps of the first rung
+            nMinFolds - #folds of the first rung (see 'max_folds' of testCMF)
+            nEta      - reduction factor
+            the others are the same as searchParameters()
+
+        return:
+            results table of all rungs, a DataFrame sorted by rung (descending)
+            and rank metric, i.e., the first row is the best of the last rung
+    '''
+    lsTrials = getTrials(dcSpace, strMethod, nTrials, nGridPoints, nSeed)
+    lsColumns = ['trial', 'rung', 'max_step', 'max_folds'] + sorted(dcSpace.keys()) + g_lsMetrics \
+                + ['rmse_trace', 'seconds']
+    nMaxStep = dcBaseParams['max_step']
+    nFold = dcBaseParams['folds']
+
+    fileResult, writer = openResultTable(strResultPath, lsColumns)
+    lsResults = []
+    try:
+        lsCandidates = range(len(lsTrials))
+        nRung = 0
+        while (True):
+            # budget of this rung
+            dcRungParams = dict(dcBaseParams)
+            dcRungParams['max_step'] = min(nMaxStep, nMinStep * nEta**nRung)
+            dcRungParams['max_folds'] = min(nFold, nMinFolds * nEta**nRung)
+            dcRungParams['return_traces'] = True
+            print("rung %d: %d trials, %d steps on %d folds..." % \
+                  (nRung, len(lsCandidates), dcRungParams['max_step'], dcRungParams['max_folds']) )
+
+            lsTasks = [(i, lsTrials[i], dcRungParams, fnObjective) for i in lsCandidates]
+            lsRungResults = runTrials(lsTasks, lsTrials, nWorkers, writer, fileResult, \
+                                      {'rung':nRung, 'max_step':dcRungParams['max_step'], \
+                                       'max_folds':dcRungParams['max_folds']})
+            lsResults.extend(lsRungResults)
+
+            # promote
+            if (len(lsCandidates) <= 1 or \
+                (dcRungParams['max_step'] == nMaxStep and dcRungParams['max_folds'] == nFold)):
+                break
+            lsRungResults.sort(key=getRankMetric)
+            lsCandidates = [dcRow['trial'] for dcRow in lsRungResults[:max(1, len(lsRungResults)/nEta)] ]
+            nRung += 1
+    finally:
+        if (fileResult is not None):
+            fileResult.close()
+
+    df = pd.DataFrame(lsResults, columns=lsColumns)
+    df['rank_metric'] = [getRankMetric(dcRow) for dcRow in lsResults]
+    df.sort_values(['rung', 'rank_metric'], ascending=[False, True], inplace=True)
+    del df['rank_metric']
+    print("search finished, best: %s" % df.iloc[0].to_dict() )
+    return df
@@ -0,0 +1,464 @@
+# -*- coding: utf-8 -*-
+'''
+Brief Description:
+    This model serves a trained CMF model (see cmf_model.saveModel) as a local
+    HTTP scoring daemon, the model is loaded once (memory-mapped) and shared by
+    all requests.
+
+    POST /score with a json body
+        {"requests": [{"msisdn": <user id>, "video": <video id>},
+                      {"msisdn": <user id>, "features": [<S-row of a video, null if missing>]}, ...]}
+    or a single request without "requests". A user is mapped to its row by the
+    user ids of the model, a video is either a known video (i.e., a row of V,
+    a video cluster if videos were reduced) or an unseen video, whose raw
+    features are preprocessed as in training (see cmf_sgd.init) and folded in
+    (see cmf_predict.foldInVideos). Returns
+        {"scores": [...], "version": <model version>}
+    where the score of an unknown user/video is null.
+
+    GET /stats returns #requests, p50/p99 latency (ms), throughput and the
+    counters of the prediction caches. POST /reload loads the served model
+    directory again, e.g., after it is replaced by a retrained model.
+
+    Requests of concurrent connections are coalesced by a batcher thread into
+    micro-batches (up to g_nMaxBatch pairs, or what arrives within g_dMaxWait
+    seconds), so that fold-in and scoring are vectorized over the batch. Scores
+    of (user row, video row) pairs and folded-in factors of video features are
+    cached (see cmf_cache), the caches are dropped when the model version
+    changes.
+
+@author: jason
+'''
+
+import sys
+import json
+import time
+import Queue
+import threading
+import SocketServer
+import BaseHTTPServer
+import numpy as np
+
+import cmf_model
+import cmf_predict
+import cmf_cache
+
+g_nMaxBatch = 256 # max #pairs of a micro-batch
+g_dMaxWait = 0.002 # max seconds the batcher waits for more requests
+g_nLatencyWindow = 10000 # #latest requests kept for percentiles
+
+def preprocessVideos(dcPreprocess, mtFeatures):
+    '''
+        This function applies the preprocessing of training to raw S-rows, i.e.,
+        missing values are filled with the means, then features are scaled.
+    '''
+    mtFeatures = np.array(mtFeatures, dtype=np.float64, ndmin=2)
+    if (dcPreprocess is None):
+        return mtFeatures
+    mtMissing = np.isnan(mtFeatures)
+    mtFeatures[mtMissing] = np.take(dcPreprocess['S_mean'], np.where(mtMissing)[1])
+    return mtFeatures * dcPreprocess['S_scale'] + dcPreprocess['S_min']
+
+def createScorer(dcModel, arrAlphas=None, arrLambdas=None):
+    '''
+        This function prepares a model for scoring.
+
+        params:
+            arrAlphas, arrLambdas - same as training, for fold-in, taken from
+                                    the params of the model by default
+
+        return:
+            dcScorer - {'model', 'users', 'videos', 'alphas', 'lambdas', 'version'},
+                       where users/videos map ids to rows, alphas/lambdas are
+                       None if unknown (then requests of features are refused)
+
+        Note: the model must have 'users' and 'videos' (cluster indices if
+              videos were reduced, see cmf_sgd.testCMF), otherwise ValueError
+              is raised, since positional ids would silently miss every msisdn.
+    '''
+    for strKey, strFactor in [('users', 'U'), ('videos', 'V')]:
+        if (dcModel.get(strKey) is None):
+            raise ValueError("model has no %s, save it with the ids of rows (see cmf_model.packModel)" % strKey)
+        if (len(dcModel[strKey]) != dcModel[strFactor].shape[0]):
+            raise ValueError("#%s (%d) doesn't match %s.shape=%s" \
+                             % (strKey, len(dcModel[strKey]), strFactor, dcModel[strFactor].shape) )
+
+    dcParams = dcModel.get('params') or {}
+    dcScorer = {}
+    dcScorer['model'] = dcModel
+    dcScorer['users'] = dict( (uid, i) for i, uid in enumerate(dcModel['users']) )
+    dcScorer['videos'] = dict( (vid, j) for j, vid in enumerate(dcModel['videos']) )
+    for strName, arr in [('alphas', arrAlphas), ('lambdas', arrLambdas)]:
+        arr = arr if arr is not None else dcParams.get(strName)
+        dcScorer[strName] = np.asarray(arr, dtype=np.float64) if arr is not None else None
+    dcScorer['version'] = dcModel.get('version')
+    return dcScorer
+
+def foldInFeatures(dcScorer, mtFeatures):
+    '''
+        This function folds in unseen videos from their raw S-rows.
+
+        return:
+            V_new, Bv_new
+    '''
+    dcModel = dcScorer['model']
+    S_new = preprocessVideos(dcModel.get('preprocess'), mtFeatures)
+    return cmf_predict.foldInVideos(dcModel, S_new, np.ones_like(S_new), \
+                                    dcScorer['alphas'], dcScorer['lambdas'])
+
+def parseRequests(obj):
+    '''
+        This function returns the requests of a json body, i.e., its 'requests'
+        or the body itself as a single request.
+    '''
+    if (not isinstance(obj, dict)):
+        raise ValueError("body must be a json object")
+    lsRequests = obj['requests'] if 'requests' in obj else [obj]
+    if (not isinstance(lsRequests, list) or len(lsRequests) == 0):
+        raise ValueError("requests must be a non-empty list")
+    return lsRequests
+
+def checkRequests(dcScorer, lsRequests):
+    '''
+        This function validates requests before they are batched, so that a bad
+        request fails alone instead of its whole batch.
+    '''
+    nFeatures = dcScorer['model']['Q'].shape[0]
+    for dcRequest in lsRequests:
+        if (not isinstance(dcRequest, dict) or 'msisdn' not in dcRequest):
+            raise ValueError("request must be a dict with msisdn: %r" % (dcRequest,) )
+        if ('features' in dcRequest):
+            if (not isinstance(dcRequest['features'], list) or len(dcRequest['features']) != nFeatures \
+                or not all(value is None or (isinstance(value, (int, long, float)) and not isinstance(value, bool)) \
+                           for value in dcRequest['features']) ):
+                raise ValueError("features must be a list of %d numbers" % nFeatures)
+            if (dcScorer['alphas'] is None or dcScorer['lambdas'] is None):
+                raise ValueError("model has no params (alphas, lambdas) to fold in features")
+        elif (isinstance(dcRequest.get('video'), (list, dict))):
+            raise ValueError("video must be an id: %r" % (dcRequest['video'],) )
+        if (isinstance(dcRequest['msisdn'], (list, dict))):
+            raise ValueError("msisdn must be an id: %r" % (dcRequest['msisdn'],) )
+
+def createCaches(nCacheSize=cmf_cache.g_nMaxEntries, dCacheTTL=cmf_cache.g_dTTL):
+    '''
+        This function creates the prediction caches of scoreBatch, i.e.,
+        'scores' of (user row, video row) pairs and 'foldin' factors of video
+        features.
+    '''
+    return {'scores':cmf_cache.createCache(nCacheSize, dCacheTTL), \
+            'foldin':cmf_cache.createCache(nCacheSize, dCacheTTL)}
+
+def scoreBatch(dcScorer, lsRequests, dcCaches=None):
+    '''
+        This function scores a batch of requests (see the module description).
+
+        params:
+            dcCaches - prediction caches (see createCaches), optional
+
+        return:
+            predicted ratios, nan for unknown users/videos
+    '''
+    dcModel = dcScorer['model']
+    U, V, Bu, Bv, mu = dcModel['U'], dcModel['V'], dcModel['Bu'], dcModel['Bv'], dcModel['mu']
+    strVersion = dcScorer['version']
+    nRequests = len(lsRequests)
+
+    arrUsers = np.array([dcScorer['users'].get(dcRequest.get('msisdn'), -1) for dcRequest in lsRequests], \
+                        dtype=np.int64)
+    arrVideos = np.array([dcScorer['videos'].get(dcRequest.get('video'), -1) if 'features' not in dcRequest \
+                          else -1 for dcRequest in lsRequests], dtype=np.int64)
+    arrFoldIn = np.array([i for i, dcRequest in enumerate(lsRequests) if 'features' in dcRequest], \
+                         dtype=np.int64)
+
+    # gather the video factors of the batch, fold in unseen videos at once
+    mtVideos = np.zeros((nRequests, V.shape[1]), dtype=V.dtype)
+    arrVideoBias = np.zeros(nRequests, dtype=V.dtype)
+    arrKnown = arrVideos >= 0
+    mtVideos[arrKnown] = V[arrVideos[arrKnown]]
+    arrVideoBias[arrKnown] = Bv[arrVideos[arrKnown], 0]
+    if (len(arrFoldIn) > 0):
+        lsFeatureKeys = [tuple(lsRequests[i]['features']) for i in arrFoldIn]
+        lsFolded = cmf_cache.getCached(dcCaches['foldin'], lsFeatureKeys, strVersion) if dcCaches is not None \
+                   else [None]*len(arrFoldIn)
+        lsMissing = [n for n, tpFolded in enumerate(lsFolded) if tpFolded is None]
+        if (len(lsMissing) > 0):
+            V_new, Bv_new = foldInFeatures(dcScorer, [lsFeatureKeys[n] for n in lsMissing])
+            for nNew, n in enumerate(lsMissing):
+                lsFolded[n] = (V_new[nNew], Bv_new[nNew, 0])
+            if (dcCaches is not None):
+                cmf_cache.putCached(dcCaches['foldin'], [lsFeatureKeys[n] for n in lsMissing], \
+                                    [lsFolded[n] for n in lsMissing], strVersion)
+        mtVideos[arrFoldIn] = np.array([tpFolded[0] for tpFolded in lsFolded])
+        arrVideoBias[arrFoldIn] = [tpFolded[1] for tpFolded in lsFolded]
+        arrKnown[arrFoldIn] = True
+
+    arrValid = np.logical_and(arrUsers >= 0, arrKnown)
+    arrScores = np.full(nRequests, np.nan)
+
+    # cached scores of known pairs
+    arrPairs = np.where(np.logical_and(arrValid, arrVideos >= 0))[0]
+    lsPairKeys = zip(arrUsers[arrPairs].tolist(), arrVideos[arrPairs].tolist())
+    if (dcCaches is not None and len(arrPairs) > 0):
+        lsCached = cmf_cache.getCached(dcCaches['scores'], lsPairKeys, strVersion)
+        arrHits = np.array([dScore is not None for dScore in lsCached])
+        arrScores[arrPairs[arrHits]] = [dScore for dScore in lsCached if dScore is not None]
+        arrValid[arrPairs[arrHits]] = False
+
+    arrValidUsers = arrUsers[arrValid]
+    arrScores[arrValid] = np.einsum('ij,ij->i', U[arrValidUsers], mtVideos[arrValid]) \
+                          + Bu[arrValidUsers, 0] + arrVideoBias[arrValid] + mu
+
+    if (dcCaches is not None and len(arrPairs) > 0 and not arrHits.all()):
+        arrComputed = np.where(~arrHits)[0]
+        cmf_cache.putCached(dcCaches['scores'], [lsPairKeys[n] for n in arrComputed], \
+                            arrScores[arrPairs[arrComputed]].tolist(), strVersion)
+    return arrScores
+
+#===========================================================================
+# latency statistics
+#===========================================================================
+def createStats(nWindow=g_nLatencyWindow):
+    '''
+        This function creates the request statistics, latencies of the latest
+        nWindow requests are kept in a ring buffer.
+    '''
+    dcStats = {}
+    dcStats['latency'] = np.zeros(nWindow)
+    dcStats['requests'] = 0
+    dcStats['pairs'] = 0
+    dcStats['batches'] = 0
+    dcStats['start'] = time.time()
+    dcStats['lock'] = threading.Lock()
+    return dcStats
+
+def recordRequest(dcStats, dLatency, nPairs):
+    with dcStats['lock']:
+        arrLatency = dcStats['latency']
+        arrLatency[dcStats['requests'] % len(arrLatency)] = dLatency
+        dcStats['requests'] += 1
+        dcStats['pairs'] += nPairs
+
+def getStats(dcStats):
+    '''
+        This function summarizes the statistics.
+
+        return:
+            {'requests', 'pairs', 'batches', 'mean_batch', 'p50_ms', 'p99_ms',
+             'throughput'}, throughput is #pairs per second since start
+    '''
+    with dcStats['lock']:
+        nRequests = dcStats['requests']
+        arrLatency = dcStats['latency'][:min(nRequests, len(dcStats['latency']))].copy()
+        dcSummary = {'requests':nRequests, 'pairs':dcStats['pairs'], 'batches':dcStats['batches']}
+    dcSummary['mean_batch'] = float(dcSummary['pairs']) / max(dcSummary['batches'], 1)
+    dcSummary['p50_ms'] = float(np.percentile(arrLatency, 50))*1000.0 if len(arrLatency) > 0 else None
+    dcSummary['p99_ms'] = float(np.percentile(arrLatency, 99))*1000.0 if len(arrLatency) > 0 else None
+    dcSummary['throughput'] = dcSummary['pairs'] / max(time.time() - dcStats['start'], 1e-9)
+    return dcSummary
+
+#===========================================================================
+# micro-batching
+#===========================================================================
+def createBatcher(dcScorer, dcStats, nMaxBatch=g_nMaxBatch, dMaxWait=g_dMaxWait, dcCaches=None):
+    '''
+        This function starts the batcher thread, requests are submitted by
+        submitRequests.
+    '''
+    dcBatcher = {}
+    dcBatcher['scorer'] = dcScorer
+    dcBatcher['lock'] = threading.Lock() # guards 'scorer'
+    dcBatcher['stats'] = dcStats
+    dcBatcher['caches'] = dcCaches
+    dcBatcher['queue'] = Queue.Queue()
+    dcBatcher['max_batch'] = nMaxBatch
+    dcBatcher['max_wait'] = dMaxWait
+    thread = threading.Thread(target=runBatcher, args=(dcBatcher,))
+    thread.daemon = True
+    thread.start()
+    dcBatcher['thread'] = thread
+    return dcBatcher
+
+def runBatcher(dcBatcher):
+    '''
+        This function is the loop of the batcher thread: it takes the first
+        pending submission, collects more until the batch is full or the wait
+        is over, then scores them together. A submission is a dict
+        {'requests', 'done', 'scores', 'version', 'error'}, where version is
+        the one of the scorer which scored it.
+    '''
+    queue = dcBatcher['queue']
+    while True:
+        lsSubmissions = [queue.get()]
+        nPairs = len(lsSubmissions[0]['requests'])
+        dDeadline = time.time() + dcBatcher['max_wait']
+        while (nPairs < dcBatcher['max_batch']):
+            dRemaining = dDeadline - time.time()
+            try:
+                dcSubmission = queue.get(True, dRemaining) if dRemaining > 0 else queue.get_nowait()
+            except Queue.Empty:
+                break
+            lsSubmissions.append(dcSubmission)
+            nPairs += len(dcSubmission['requests'])
+
+        lsRequests = [dcRequest for dcSubmission in lsSubmissions for dcRequest in dcSubmission['requests']]
+        with dcBatcher['lock']:
+            dcScorer = dcBatcher['scorer'] # a reload swaps it, the batch finishes with this one
+        try:
+            arrScores = scoreBatch(dcScorer, lsRequests, dcBatcher['caches'])
+            strError = None
+        except Exception as e:
+            arrScores = None
+            strError = '%s: %s' % (type(e).__name__, e)
+
+        with dcBatcher['stats']['lock']:
+            dcBatcher['stats']['batches'] += 1
+
+        nStart = 0
+        for dcSubmission in lsSubmissions:
+            nEnd = nStart + len(dcSubmission['requests'])
+            dcSubmission['scores'] = arrScores[nStart:nEnd] if arrScores is not None else None
+            dcSubmission['version'] = dcScorer['version']
+            dcSubmission['error'] = strError
+            dcSubmission['done'].set()
+            nStart = nEnd
+
+def submitRequests(dcBatcher, lsRequests):
+    '''
+        This function submits requests to the batcher and waits for the scores.
+
+        return:
+            scores, version of the model which scored them
+    '''
+    dcSubmission = {'requests':lsRequests, 'done':threading.Event(), 'scores':None, 'version':None, \
+                    'error':None}
+    dcBatcher['queue'].put(dcSubmission)
+    dcSubmission['done'].wait()
+    if (dcSubmission['error'] is not None):
+        raise RuntimeError(dcSubmission['error'])
+    return dcSubmission['scores'], dcSubmission['version']
+
+def reloadModel(dcBatcher, strModelPath):
+    '''
+        This function loads a model and swaps it in, the batch being scored
+        finishes with the old model, and the caches are dropped if the version
+        has changed.
+
+        return:
+            version of the loaded model
+    '''
+    dcScorer = createScorer(cmf_model.loadModel(strModelPath))
+    with dcBatcher['lock']:
+        dcBatcher['scorer'] = dcScorer
+        if (dcBatcher['caches'] is not None):
+            for dcCache in dcBatcher['caches'].values():
+                cmf_cache.invalidateCache(dcCache, dcScorer['version'])
+    return dcScorer['version']
+
+def getScorer(dcBatcher):
+    '''
+        This function returns the scorer being served
+    '''
+    with dcBatcher['lock']:
+        return dcBatcher['scorer']
+
+#===========================================================================
+# http server
+#===========================================================================
+class ScoringHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive
+
+    def sendJson(self, nCode, obj):
+        strBody = json.dumps(obj)
+        self.send_response(nCode)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(strBody)))
+        self.end_headers()
+        self.wfile.write(strBody)
+
+    def do_GET(self):
+        if (self.path == '/stats'):
+            dcSummary = getStats(self.server.stats)
+            dcSummary['version'] = getScorer(self.server.batcher)['version']
+            if (self.server.batcher['caches'] is not None):
+                for strName, dcCache in self.server.batcher['caches'].items():
+                    dcSummary['cache_' + strName] = cmf_cache.getCacheStats(dcCache)
+            self.sendJson(200, dcSummary)
+        else:
+            self.sendJson(404, {'error':'unknown path %s' % self.path})
+
+    def do_POST(self):
+        dStart = time.time()
+        if (self.path == '/reload' and self.server.model_path is not None):
+            try:
+                strVersion = reloadModel(self.server.batcher, self.server.model_path)
+            except (IOError, ValueError) as e:
+                self.sendJson(500, {'error':'failed to reload: %s' % e})
+                return
+            self.sendJson(200, {'version':strVersion})
+            return
+        if (self.path != '/score'):
+            self.sendJson(404, {'error':'unknown path %s' % self.path})
+            return
+        try:
+            obj = json.loads(self.rfile.read(int(self.headers.getheader('Content-Length', 0))))
+            lsRequests = parseRequests(obj)
+            checkRequests(getScorer(self.server.batcher), lsRequests)
+        except (ValueError, KeyError, TypeError) as e:
+            self.sendJson(400, {'error':'bad request: %s' % e})
+            return
+
+        try:
+            arrScores, strVersion = submitRequests(self.server.batcher, lsRequests)
+        except RuntimeError as e:
+            self.sendJson(500, {'error':str(e)})
+            return
+        lsScores = [None if np.isnan(dScore) else float(dScore) for dScore in arrScores]
+        self.sendJson(200, {'scores':lsScores, 'version':strVersion})
+        recordRequest(self.server.stats, time.time() - dStart, len(lsRequests))
+
+    def log_message(self, format, *args):
+        pass # one line per request is too much for a daemon
+
+class ScoringServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def createServer(dcScorer, strHost='127.0.0.1', nPort=0, nMaxBatch=g_nMaxBatch, dMaxWait=g_dMaxWait, \
+                 nCacheSize=cmf_cache.g_nMaxEntries, dCacheTTL=cmf_cache.g_dTTL, strModelPath=None):
+    '''
+        This function creates the scoring server, call serve_forever() on it,
+        or run it in a thread for tests.
+
+        params:
+            nPort        - 0 to pick a free port, see server.server_address
+            nCacheSize   - max #entries of each prediction cache, 0 disables caching
+            dCacheTTL    - seconds a cached prediction lives
+            strModelPath - model directory reloaded by POST /reload
+    '''
+    server = ScoringServer((strHost, nPort), ScoringHandler)
+    server.stats = createStats()
+    server.model_path = strModelPath
+    server.batcher = createBatcher(dcScorer, server.stats, nMaxBatch, dMaxWait, \
+                                   createCaches(nCacheSize, dCacheTTL) if nCacheSize > 0 else None)
+    return server
+
+def serveModel(strModelPath, strHost='127.0.0.1', nPort=8080, nMaxBatch=g_nMaxBatch, dMaxWait=g_dMaxWait, \
+               nCacheSize=cmf_cache.g_nMaxEntries, dCacheTTL=cmf_cache.g_dTTL):
+    '''
+        This function loads a saved model and serves it until interrupted.
+    '''
+    dcModel = cmf_model.loadModel(strModelPath)
+    server = createServer(createScorer(dcModel), strHost, nPort, nMaxBatch, dMaxWait, \
+                          nCacheSize, dCacheTTL, strModelPath)
+    print("serving model %s (version=%s) on %s:%d" % ((strModelPath, dcModel['version']) + server.server_address) )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(getStats(server.stats))
+        server.server_close()
+
+if __name__ == '__main__':
+    # usage: python cmf_server.py <model dir> [port]
+    serveModel(sys.argv[1], nPort=int(sys.argv[2]) if len(sys.argv) > 2 else 8080)
@@ -4,12 +4,15 @@ Brief Description:
     This model implement Collective Matrix factorization (http://dl.acm.org/citation.cfm?id=1401969).
     Insteading using stochastic-optimized newton's method solution, we solve the minimization of the
     loss function by a stochastic gradient descent
+    (fit() runs full-batch gradient descent with line search, fitMiniBatch() runs
+    mini-batch stochastic gradient descent)
 
 @author: jason
 '''
 
 import numpy as np
 import pandas as pd
+from scipy import sparse
 import sklearn.preprocessing as prepro
 from sklearn import cross_validation
 from sklearn.cluster.hierarchical import AgglomerativeClustering
@@ -17,36 +20,69 @@ from sklearn.cluster.hierarchical import AgglomerativeClustering
 
 import matplotlib.pyplot as plt
 
+import cmf_optimizer
+import cmf_kernel
+import cmf_trace
+
 g_dConvergenceThresold = 0.01
 g_gamma0 = 0.1
 g_power_t = 0.25
+g_dMinGamma = 1e-10 # smallest step size tried by the polynomial line search
+g_nMissingRatio = 255 # missing value of uint8 R (see data2matrix.transform2mt)
+g_dRatioScale = 0.01 # uint8 R stores ratio*100 (see data2matrix.transform2mt)
+g_dcMonitorIndex = {'rmseR':3, 'rmseR_test':4, 'rmseD':5, 'rmseS':6, 'loss':7} # metrics in residual errors
 
 
-def getLearningRate(gamma, nIter):
+def getLearningRate(gamma, nIter, strSchedule='constant'):
     '''
-        dynamically change learning rate w.r.t #iteration (using sklearn default: eta = eta0 / pow(t, g_power_t) )
+        dynamically change learning rate w.r.t #iteration
+        
+        strSchedule:
+            'constant'   - use gamma all the time
+            'invscaling' - sklearn default: eta = gamma / pow(t, g_power_t)
+            'log'        - eta = gamma * log(t) / t
     '''
+    if (strSchedule == 'invscaling'):
+        return gamma / pow(nIter+1, g_power_t)
+    
+    elif (strSchedule == 'log'):
+        return gamma * np.log2(nIter+2) / (nIter+2.0)
+    
     return gamma # use constant learning rate for demo
 
-#     newGamma = g_gamma0 / pow(nIter+1, g_power_t)
-#     return newGamma
-
-#     return np.log2(nIter+1) / (nIter+1.0) # set to log(n)/n
+def maskError(weightR, errorR):
+    '''
+        This function returns weightR∘errorR as a dense matrix.
+        
+        weightR can be either a dense matrix or an index-based mask, i.e., a
+        scipy sparse matrix whose entries are the masked positions, in the latter
+        case errorR is only gathered at those positions.
+    '''
+    if (sparse.issparse(weightR)):
+        W = weightR.tocoo()
+        mtMasked = np.zeros_like(errorR)
+        mtMasked[W.row, W.col] = W.data * errorR[W.row, W.col]
+        return mtMasked
+    
+    return np.multiply(weightR, errorR)
 
 def computeResidualError(R, D, S, U, V, P, Q, Bu, Bv, mu, Jm, Jn,\
                          weightR_train, weightR_test, weightD_train, weightS_train, \
-                         arrAlphas, arrLambdas):
+                         arrAlphas, arrLambdas, bMetrics=True):
+    '''
+        Note: weightR_train and weightR_test can also be index-based masks (see maskError);
+              if bMetrics=False, only the residual errors are computed, and the
+              rmses and loss are returned as None.
+    '''
     #===========================================================================
     # compute initial error
     #===========================================================================
     # compute error in R (R = bu + U·V^T )
-    predR =  np.dot(U, V.T) + np.dot(Bu, Jn.T)  + np.dot(Jm, Bv.T) + mu
+    # biases are broadcast, instead of Bu·Jn^T and Jm·Bv^T
+    predR =  np.dot(U, V.T) + Bu + Bv.T + mu
 #     predR =  np.dot(U, V.T)
     _errorR = np.subtract(R, predR)
-    errorR_train = np.multiply(weightR_train, _errorR)
-    
-    # compute test error in R
-    errorR_test = np.multiply(weightR_test, _errorR)
+    errorR_train = maskError(weightR_train, _errorR)
     
     # compute error in D
     predD = np.dot(U, P.T)
@@ -58,6 +94,16 @@ def computeResidualError(R, D, S, U, V, P, Q, Bu, Bv, mu, Jm, Jn,\
     _errorS = np.subtract(S, predS)
     errorS_train = np.multiply(weightS_train, _errorS)
     
+    if (not bMetrics):
+        return errorR_train, errorD_train, errorS_train, None, None, None, None, None
+    
+    # compute test error in R, only gather test entries for index-based mask
+    if (sparse.issparse(weightR_test)):
+        W = weightR_test.tocoo()
+        errorR_test = W.data * _errorR[W.row, W.col]
+    else:
+        errorR_test = np.multiply(weightR_test, _errorR)
+    
     # compute rmse
     rmseR_train = np.sqrt( np.power(errorR_train, 2.0).sum() / weightR_train.sum() )
     rmseD_train = np.sqrt( np.power(errorD_train, 2.0).sum() / weightD_train.sum() )
@@ -76,28 +122,580 @@ def computeResidualError(R, D, S, U, V, P, Q, Bu, Bv, mu, Jm, Jn,\
             
     return errorR_train, errorD_train, errorS_train, rmseR_train, rmseR_test, rmseD_train, rmseS_train, dTotalLost
 
+def getMaskIndex(weightR):
+    '''
+        This function returns the linear indices and weights of the entries of
+        an index-based mask (see maskError)
+    '''
+    W = weightR.tocoo()
+    arrMask = (W.data != 0)
+    return W.row[arrMask].astype(np.int64) * W.shape[1] + W.col[arrMask], W.data[arrMask]
+
+def createWorkspace(R, D, S, U, V, P, Q, Bu, Bv, weightR_train, weightR_test, bPolynomial=False):
+    '''
+        This function preallocates the buffers used by fit() in workspace mode,
+        i.e., the residual errors, gradients and trial steps, which are then
+        updated in place (see computeResidualError_inplace, 
+        computeParitialGraident_inplace and computeNextStep).
+        
+        params:
+            bPolynomial - also allocate the buffers of computeLossPolynomial, i.e.,
+                          the terms of R (m-by-n for a dense mask, or one entry
+                          per training entry for an index-based mask), D and S
+    '''
+    dtype = U.dtype
+    dcWorkspace = {}
+    dcWorkspace['errorR'] = np.empty(R.shape, dtype=dtype)
+    dcWorkspace['errorD'] = np.empty(D.shape, dtype=dtype)
+    dcWorkspace['errorS'] = np.empty(S.shape, dtype=dtype)
+    
+    # train mask
+    dcWorkspace['weightR_train_sum'] = weightR_train.sum()
+    if (sparse.issparse(weightR_train)):
+        arrIndex, arrWeight = getMaskIndex(weightR_train)
+        dcWorkspace['train_index'] = arrIndex
+        dcWorkspace['train_weight'] = arrWeight
+        dcWorkspace['train_buffer'] = np.empty(len(arrIndex), dtype=dtype)
+    
+    # test mask
+    dcWorkspace['weightR_test_sum'] = weightR_test.sum()
+    if (sparse.issparse(weightR_test)):
+        arrIndex, arrWeight = getMaskIndex(weightR_test)
+        dcWorkspace['test_index'] = arrIndex
+        dcWorkspace['test_weight'] = arrWeight
+        dcWorkspace['test_buffer'] = np.empty(len(arrIndex), dtype=dtype)
+    else:
+        dcWorkspace['errorR_test'] = np.empty(R.shape, dtype=dtype)
+    
+    # gradients, trial steps and temporaries of each low rank matrix
+    for strName, mt in zip(['U', 'V', 'P', 'Q', 'Bu', 'Bv'], [U, V, P, Q, Bu, Bv]):
+        dcWorkspace['grad'+strName] = np.empty_like(mt)
+        dcWorkspace['next'+strName] = np.empty_like(mt)
+        dcWorkspace['tmp'+strName] = np.empty_like(mt)
+    
+    if (bPolynomial):
+        if ('train_index' in dcWorkspace):
+            # terms of R only at the training entries, and the gathered rows of factors
+            nObserved = len(dcWorkspace['train_index'])
+            dcWorkspace['poly_rows'], dcWorkspace['poly_cols'] = np.divmod(dcWorkspace['train_index'], R.shape[1])
+            for strName in ['polyE_R', 'polyA_R', 'polyC_R', 'polyTmp_R']:
+                dcWorkspace[strName] = np.empty(nObserved, dtype=dtype)
+            dcWorkspace['polyRows_R'] = np.empty((nObserved, U.shape[1]), dtype=dtype)
+            dcWorkspace['polyCols_R'] = np.empty((nObserved, V.shape[1]), dtype=dtype)
+        else:
+            dcWorkspace['polyA_R'] = np.empty(R.shape, dtype=dtype)
+            dcWorkspace['polyC_R'] = np.empty(R.shape, dtype=dtype)
+        for strName, mt in [('D', D), ('S', S)]:
+            dcWorkspace['polyA_'+strName] = np.empty(mt.shape, dtype=dtype)
+            dcWorkspace['polyC_'+strName] = np.empty(mt.shape, dtype=dtype)
+        
+    return dcWorkspace
+
+def computeResidualError_inplace(R, D, S, U, V, P, Q, Bu, Bv, mu, \
+                                 weightR_train, weightR_test, weightD_train, weightS_train, \
+                                 arrAlphas, arrLambdas, dcWorkspace, bMetrics=True):
+    '''
+        This function is the same as computeResidualError(), but writes the
+        residual errors into the buffers of dcWorkspace (see createWorkspace)
+        instead of allocating them.
+        
+        Note: the returned error matrices are overwritten by the next call.
+    '''
+    #===========================================================================
+    # R
+    #===========================================================================
+    errorR = dcWorkspace['errorR']
+    np.dot(U, V.T, out=errorR)
+    errorR += Bu
+    errorR += Bv.T
+    errorR += mu
+    np.subtract(R, errorR, out=errorR)
+    
+    # test error, gathered before errorR is masked in place
+    if (not bMetrics):
+        pass
+    elif ('test_index' in dcWorkspace):
+        arrErrorR_test = dcWorkspace['test_buffer']
+        np.take(errorR.ravel(), dcWorkspace['test_index'], out=arrErrorR_test)
+        np.multiply(arrErrorR_test, dcWorkspace['test_weight'], out=arrErrorR_test)
+    else:
+        arrErrorR_test = dcWorkspace['errorR_test']
+        np.multiply(weightR_test, errorR, out=arrErrorR_test)
+    
+    # train error
+    if ('train_index' in dcWorkspace):
+        arrErrorR_train = dcWorkspace['train_buffer']
+        np.take(errorR.ravel(), dcWorkspace['train_index'], out=arrErrorR_train)
+        np.multiply(arrErrorR_train, dcWorkspace['train_weight'], out=arrErrorR_train)
+        errorR.fill(0.0)
+        errorR.ravel()[dcWorkspace['train_index']] = arrErrorR_train
+    else:
+        np.multiply(weightR_train, errorR, out=errorR)
+    
+    #===========================================================================
+    # D, S
+    #===========================================================================
+    errorD = dcWorkspace['errorD']
+    np.dot(U, P.T, out=errorD)
+    np.subtract(D, errorD, out=errorD)
+    np.multiply(weightD_train, errorD, out=errorD)
+    
+    errorS = dcWorkspace['errorS']
+    np.dot(V, Q.T, out=errorS)
+    np.subtract(S, errorS, out=errorS)
+    np.multiply(weightS_train, errorS, out=errorS)
+    
+    if (not bMetrics):
+        return errorR, errorD, errorS, None, None, None, None, None
+    
+    #===========================================================================
+    # rmse and loss, np.vdot doesn't allocate squared matrices
+    #===========================================================================
+    dSquaredR = np.vdot(errorR, errorR)
+    dSquaredD = np.vdot(errorD, errorD)
+    dSquaredS = np.vdot(errorS, errorS)
+    rmseR_train = np.sqrt( dSquaredR / dcWorkspace['weightR_train_sum'] )
+    rmseD_train = np.sqrt( dSquaredD / weightD_train.sum() )
+    rmseS_train = np.sqrt( dSquaredS / weightS_train.sum() )
+    rmseR_test = np.sqrt( np.vdot(arrErrorR_test, arrErrorR_test) / dcWorkspace['weightR_test_sum'] )
+    
+    dTotalLost = (arrAlphas[0]/2.0) * dSquaredR \
+            + (arrAlphas[1]/2.0) * dSquaredD \
+            + (arrAlphas[2]/2.0) * dSquaredS \
+            + (arrLambdas[0]/2.0) * ( np.vdot(U, U) + np.vdot(V, V) ) \
+            + (arrLambdas[1]/2.0) * np.vdot(P, P) \
+            + (arrLambdas[2]/2.0) * np.vdot(Q, Q) \
+            + (arrLambdas[3]/2.0) * np.vdot(Bu, Bu) \
+            + (arrLambdas[4]/2.0) * np.vdot(Bv, Bv)
+    
+    return errorR, errorD, errorS, rmseR_train, rmseR_test, rmseD_train, rmseS_train, dTotalLost
+
+def isCompact(dtype):
+    '''
+        dtype policy: any dtype other than float64 (e.g., np.float32) turns on the
+        compact mode, in which factors and features are stored in dtype and 
+        weight matrices are boolean masks.
+    '''
+    return np.dtype(dtype) != np.float64
+
+def getObservedEntries(R, weightR, dtype=np.float64):
+    '''
+        This function collects the observed entries of R (i.e., entries with
+        non-zero weight) into a COO sparse matrix.
+        
+        params:
+            R       - user-video matrix, dense or scipy sparse (e.g., uint8,
+                      whose ratios are scaled back to 0.0~1.0)
+            weightR - weight matrix of R, dense or scipy sparse
+            dtype   - dtype of the returned values
+            
+        return:
+            m-by-n COO matrix which only holds the observed entries
+    '''
+    if (sparse.issparse(weightR)):
+        W = weightR.tocoo()
+        arrMask = (W.data != 0)
+        arrRows = W.row[arrMask]
+        arrCols = W.col[arrMask]
+    else:
+        arrRows, arrCols = np.nonzero(weightR)
+        
+    if (sparse.issparse(R)):
+        arrValues = np.asarray(R.tocsr()[arrRows, arrCols], dtype=dtype).ravel()
+    else:
+        arrValues = np.asarray(R[arrRows, arrCols], dtype=dtype)
+    if (R.dtype == np.uint8):
+        arrValues *= g_dRatioScale
+        
+    return sparse.coo_matrix((arrValues, (arrRows, arrCols)), shape=R.shape)
+
+def computeObservedPrediction(U, V, Bu, Bv, mu, arrRows, arrCols):
+    '''
+        This function predicts R only at the given (user, video) pairs,
+        i.e., predR[i,j] = U[i]·V[j]^T + bu[i] + bv[j] + mu
+    '''
+    return np.einsum('ij,ij->i', U[arrRows], V[arrCols]) \
+            + Bu[arrRows, 0] + Bv[arrCols, 0] + mu
+
+def computeResidualError_sparse(R_train, R_test, D, S, U, V, P, Q, Bu, Bv, mu, \
+                                weightD_train, weightS_train, arrAlphas, arrLambdas, bMetrics=True):
+    '''
+        Sparse version of computeResidualError: R_train and R_test are COO matrices
+        (see getObservedEntries), and the error of R is only computed on their 
+        observed entries, so the cost scales with nnz instead of m×n.
+        
+        The returned errorR_train is a CSR matrix which can be directly fed to
+        computeParitialGraident; bMetrics is the same as computeResidualError.
+    '''
+    # compute error in R on observed entries only
+    arrErrorR_train = R_train.data - computeObservedPrediction(U, V, Bu, Bv, mu, R_train.row, R_train.col)
+    errorR_train = sparse.csr_matrix((arrErrorR_train, (R_train.row, R_train.col)), shape=R_train.shape)
+    
+    # compute error in D
+    predD = np.dot(U, P.T)
+    _errorD = np.subtract(D, predD)
+    errorD_train = np.multiply(weightD_train, _errorD)
+    
+    # compute error in S
+    predS = np.dot(V, Q.T)
+    _errorS = np.subtract(S, predS)
+    errorS_train = np.multiply(weightS_train, _errorS)
+    
+    if (not bMetrics):
+        return errorR_train, errorD_train, errorS_train, None, None, None, None, None
+    
+    # compute test error in R
+    arrErrorR_test = R_test.data - computeObservedPrediction(U, V, Bu, Bv, mu, R_test.row, R_test.col)
+    
+    # compute rmse
+    dSquaredErrorR_train = np.dot(arrErrorR_train, arrErrorR_train)
+    dSquaredErrorD_train = np.power(errorD_train, 2.0).sum()
+    dSquaredErrorS_train = np.power(errorS_train, 2.0).sum()
+    rmseR_train = np.sqrt( dSquaredErrorR_train / R_train.nnz )
+    rmseD_train = np.sqrt( dSquaredErrorD_train / weightD_train.sum() )
+    rmseS_train = np.sqrt( dSquaredErrorS_train / weightS_train.sum() )
+    rmseR_test = np.sqrt( np.dot(arrErrorR_test, arrErrorR_test) / R_test.nnz )
+    
+    dTotalLost = (arrAlphas[0]/2.0) * dSquaredErrorR_train \
+            + (arrAlphas[1]/2.0) * dSquaredErrorD_train \
+            + (arrAlphas[2]/2.0) * dSquaredErrorS_train \
+            + (arrLambdas[0]/2.0) * ( np.power(np.linalg.norm(U, ord='fro'), 2.0) + np.power(np.linalg.norm(V, ord='fro'), 2.0) ) \
+            + (arrLambdas[1]/2.0) * np.power(np.linalg.norm(P, ord='fro'), 2.0) \
+            + (arrLambdas[2]/2.0) * np.power(np.linalg.norm(Q, ord='fro'), 2.0) \
+            + (arrLambdas[3]/2.0) * np.power(np.linalg.norm(Bu, ord='fro'), 2.0) \
+            + (arrLambdas[4]/2.0) * np.power(np.linalg.norm(Bv, ord='fro'), 2.0)
+    
+    return errorR_train, errorD_train, errorS_train, rmseR_train, rmseR_test, rmseD_train, rmseS_train, dTotalLost
+
 def computeParitialGraident(errorR, errorD, errorS, U, V, P, Q, Bu, Bv, Jm, Jn, arrAlphas, arrLambdas):
+    '''
+        Note: errorR can be either a dense matrix or a scipy sparse matrix
+    '''
     # U
-    gradU = ( -1.0*arrAlphas[0]*np.dot(errorR, V) - arrAlphas[1]*np.dot(errorD, P) \
+    gradU = ( -1.0*arrAlphas[0]*errorR.dot(V) - arrAlphas[1]*np.dot(errorD, P) \
                       + arrLambdas[0]*U )
     # P
     gradP = ( -1.0*arrAlphas[1]*np.dot(errorD.T, U) + arrLambdas[1]*P )
     
     # V
-    gradV = ( -1.0*arrAlphas[0]*np.dot(errorR.T, U) - arrAlphas[2]*np.dot(errorS, Q) \
+    gradV = ( -1.0*arrAlphas[0]*errorR.T.dot(U) - arrAlphas[2]*np.dot(errorS, Q) \
                       + arrLambdas[0]*V )
     # Q
     gradQ = ( -1.0 * arrAlphas[2]*np.dot(errorS.T, V) + arrLambdas[2]*Q )
     
     # bu
-    gradBu = ( -1.0 * arrAlphas[0] * np.dot(errorR, Jn) + arrLambdas[3]*Bu)
+    gradBu = ( -1.0 * arrAlphas[0] * errorR.dot(Jn) + arrLambdas[3]*Bu)
+    
+    # bv
+    gradBv = ( -1.0 * arrAlphas[0] * errorR.T.dot(Jm) + arrLambdas[4]*Bv)
+    
+    return gradU, gradV, gradP, gradQ, gradBu, gradBv
+
+def computeParitialGraident_inplace(errorR, errorD, errorS, U, V, P, Q, Bu, Bv, \
+                                    arrAlphas, arrLambdas, dcWorkspace):
+    '''
+        This function is the same as computeParitialGraident(), but writes the
+        gradients into the buffers of dcWorkspace (see createWorkspace).
+        
+        Note: errorR must be dense
+    '''
+    gradU, gradV, gradP, gradQ, gradBu, gradBv = \
+        [dcWorkspace['grad'+strName] for strName in ['U', 'V', 'P', 'Q', 'Bu', 'Bv'] ]
+    tmpU, tmpV, tmpP, tmpQ, tmpBu, tmpBv = \
+        [dcWorkspace['tmp'+strName] for strName in ['U', 'V', 'P', 'Q', 'Bu', 'Bv'] ]
+    
+    # U
+    np.dot(errorR, V, out=gradU)
+    gradU *= -1.0*arrAlphas[0]
+    np.dot(errorD, P, out=tmpU)
+    tmpU *= arrAlphas[1]
+    gradU -= tmpU
+    np.multiply(U, arrLambdas[0], out=tmpU)
+    gradU += tmpU
+    
+    # P
+    np.dot(errorD.T, U, out=gradP)
+    gradP *= -1.0*arrAlphas[1]
+    np.multiply(P, arrLambdas[1], out=tmpP)
+    gradP += tmpP
+    
+    # V
+    np.dot(errorR.T, U, out=gradV)
+    gradV *= -1.0*arrAlphas[0]
+    np.dot(errorS, Q, out=tmpV)
+    tmpV *= arrAlphas[2]
+    gradV -= tmpV
+    np.multiply(V, arrLambdas[0], out=tmpV)
+    gradV += tmpV
+    
+    # Q
+    np.dot(errorS.T, V, out=gradQ)
+    gradQ *= -1.0*arrAlphas[2]
+    np.multiply(Q, arrLambdas[2], out=tmpQ)
+    gradQ += tmpQ
+    
+    # bu
+    np.sum(errorR, axis=1, keepdims=True, out=gradBu)
+    gradBu *= -1.0*arrAlphas[0]
+    np.multiply(Bu, arrLambdas[3], out=tmpBu)
+    gradBu += tmpBu
     
     # bv
-    gradBv = ( -1.0 * arrAlphas[0] * np.dot(errorR.T, Jm) + arrLambdas[4]*Bv)
+    np.sum(errorR.T, axis=1, keepdims=True, out=gradBv)
+    gradBv *= -1.0*arrAlphas[0]
+    np.multiply(Bv, arrLambdas[4], out=tmpBv)
+    gradBv += tmpBv
     
     return gradU, gradV, gradP, gradQ, gradBu, gradBv
 
-def init(mtR, mtD, mtS, inplace, dReductionRatio=0.7):
+def computeNextStep(lsCurrent, lsGrads, gamma, lsNext=None):
+    '''
+        This function returns current - gamma*grad of each low rank matrix, the
+        results are written into lsNext if it is given.
+    '''
+    if (lsNext is None):
+        return [current - gamma*grad for current, grad in zip(lsCurrent, lsGrads)]
+    
+    for current, grad, nextMatrix in zip(lsCurrent, lsGrads, lsNext):
+        np.multiply(grad, gamma, out=nextMatrix)
+        np.subtract(current, nextMatrix, out=nextMatrix)
+    return lsNext
+
+def getSquaredNormPolynomial(E0, A, C=None):
+    '''
+        This function returns the coefficients of ||E0 + gamma*A - gamma^2*C||^2 
+        as a polynomial of gamma (highest order first, see np.polyval).
+    '''
+    if (C is None):
+        return np.array([0.0, 0.0, np.vdot(A, A), 2.0*np.vdot(E0, A), np.vdot(E0, E0)])
+    
+    return np.array([np.vdot(C, C), -2.0*np.vdot(A, C), \
+                     np.vdot(A, A) - 2.0*np.vdot(E0, C), \
+                     2.0*np.vdot(E0, A), np.vdot(E0, E0)])
+
+def computeLossPolynomial(errorR, errorD, errorS, U, V, P, Q, Bu, Bv, \
+                          gradU, gradV, gradP, gradQ, gradBu, gradBv, \
+                          weightR_train, weightD_train, weightS_train, \
+                          arrAlphas, arrLambdas, dcWorkspace=None):
+    '''
+        This function expresses the loss at a trial step, i.e., the loss at 
+        (U-gamma*gradU, V-gamma*gradV, ...), as a quartic polynomial of gamma.
+        Once the coefficients are computed from the current residuals and the
+        cached products (U·gradV^T, gradU·V^T, gradU·gradV^T, ...), the loss of 
+        any step size can be evaluated without another residual pass.
+        
+        Note: errorR can be either a dense matrix or a CSR matrix (sparse engine),
+              in the latter case weightR_train is not used; weightR_train can
+              also be an index-based mask (see maskError); if dcWorkspace is
+              given, the terms of R, D, S are computed in its buffers (see
+              createWorkspace).
+        
+        return:
+            coefficients of the polynomial (highest order first, see np.polyval)
+    '''
+    #===========================================================================
+    # error terms: error(gamma) = error + gamma*A - gamma^2*C
+    #===========================================================================
+    # R
+    if (dcWorkspace is not None and 'poly_rows' in dcWorkspace):
+        # index-based mask, gather the training entries into buffers
+        arrRows, arrCols = dcWorkspace['poly_rows'], dcWorkspace['poly_cols']
+        mtRows, mtCols, arrTmp = dcWorkspace['polyRows_R'], dcWorkspace['polyCols_R'], dcWorkspace['polyTmp_R']
+        arrErrorR = dcWorkspace['polyE_R']
+        arrA_R = dcWorkspace['polyA_R']
+        arrC_R = dcWorkspace['polyC_R']
+        np.take(errorR.ravel(), dcWorkspace['train_index'], out=arrErrorR)
+        np.take(U, arrRows, axis=0, out=mtRows)
+        np.take(gradV, arrCols, axis=0, out=mtCols)
+        np.einsum('ij,ij->i', mtRows, mtCols, out=arrA_R)
+        np.take(gradU, arrRows, axis=0, out=mtRows)
+        np.einsum('ij,ij->i', mtRows, mtCols, out=arrC_R)
+        np.take(V, arrCols, axis=0, out=mtCols)
+        np.einsum('ij,ij->i', mtRows, mtCols, out=arrTmp)
+        arrA_R += arrTmp
+        np.take(gradBu[:, 0], arrRows, out=arrTmp)
+        arrA_R += arrTmp
+        np.take(gradBv[:, 0], arrCols, out=arrTmp)
+        arrA_R += arrTmp
+        np.multiply(arrA_R, dcWorkspace['train_weight'], out=arrA_R)
+        np.multiply(arrC_R, dcWorkspace['train_weight'], out=arrC_R)
+    elif (sparse.issparse(errorR) or sparse.issparse(weightR_train)):
+        # only the observed entries contribute
+        if (sparse.issparse(errorR)):
+            E = errorR.tocoo()
+            arrRows, arrCols, arrErrorR = E.row, E.col, E.data
+            arrWeight = 1.0
+        else:
+            W = weightR_train.tocoo()
+            arrRows, arrCols, arrWeight = W.row, W.col, W.data
+            arrErrorR = errorR[arrRows, arrCols]
+        arrA_R = arrWeight * ( computeObservedPrediction(U, gradV, gradBu, gradBv, 0.0, arrRows, arrCols) \
+                               + np.einsum('ij,ij->i', gradU[arrRows], V[arrCols]) )
+        arrC_R = arrWeight * np.einsum('ij,ij->i', gradU[arrRows], gradV[arrCols])
+    elif (dcWorkspace is not None):
+        arrErrorR = errorR
+        arrA_R = dcWorkspace['polyA_R']
+        arrC_R = dcWorkspace['polyC_R']
+        np.dot(U, gradV.T, out=arrA_R)
+        np.dot(gradU, V.T, out=arrC_R)
+        arrA_R += arrC_R
+        arrA_R += gradBu
+        arrA_R += gradBv.T
+        np.multiply(weightR_train, arrA_R, out=arrA_R)
+        np.dot(gradU, gradV.T, out=arrC_R)
+        np.multiply(weightR_train, arrC_R, out=arrC_R)
+    else:
+        arrErrorR = errorR
+        arrA_R = np.multiply(weightR_train, np.dot(np.hstack([U, gradU]), np.hstack([gradV, V]).T) \
+                                            + gradBu + gradBv.T)
+        arrC_R = np.multiply(weightR_train, np.dot(gradU, gradV.T))
+    
+    # D, S
+    if (dcWorkspace is not None):
+        lsTerms = []
+        for X, gradX, Y, gradY, weight, strName in [(U, gradU, P, gradP, weightD_train, 'D'), \
+                                                     (V, gradV, Q, gradQ, weightS_train, 'S')]:
+            arrA = dcWorkspace['polyA_'+strName]
+            arrC = dcWorkspace['polyC_'+strName]
+            np.dot(X, gradY.T, out=arrA)
+            np.dot(gradX, Y.T, out=arrC)
+            arrA += arrC
+            np.multiply(weight, arrA, out=arrA)
+            np.dot(gradX, gradY.T, out=arrC)
+            np.multiply(weight, arrC, out=arrC)
+            lsTerms.append((arrA, arrC))
+        (arrA_D, arrC_D), (arrA_S, arrC_S) = lsTerms
+    else:
+        arrA_D = np.multiply(weightD_train, np.dot(np.hstack([U, gradU]), np.hstack([gradP, P]).T))
+        arrC_D = np.multiply(weightD_train, np.dot(gradU, gradP.T))
+        
+        arrA_S = np.multiply(weightS_train, np.dot(np.hstack([V, gradV]), np.hstack([gradQ, Q]).T))
+        arrC_S = np.multiply(weightS_train, np.dot(gradV, gradQ.T))
+    
+    #===========================================================================
+    # loss(gamma)
+    #===========================================================================
+    arrCoef = (arrAlphas[0]/2.0) * getSquaredNormPolynomial(arrErrorR, arrA_R, arrC_R) \
+            + (arrAlphas[1]/2.0) * getSquaredNormPolynomial(errorD, arrA_D, arrC_D) \
+            + (arrAlphas[2]/2.0) * getSquaredNormPolynomial(errorS, arrA_S, arrC_S) \
+            + (arrLambdas[0]/2.0) * ( getSquaredNormPolynomial(U, -gradU) + getSquaredNormPolynomial(V, -gradV) ) \
+            + (arrLambdas[1]/2.0) * getSquaredNormPolynomial(P, -gradP) \
+            + (arrLambdas[2]/2.0) * getSquaredNormPolynomial(Q, -gradQ) \
+            + (arrLambdas[3]/2.0) * getSquaredNormPolynomial(Bu, -gradBu) \
+            + (arrLambdas[4]/2.0) * getSquaredNormPolynomial(Bv, -gradBv)
+            
+    return arrCoef
+
+def createLossSample(R, weightR_train, D, S, weightD_train, weightS_train, nSamples, \
+                     dtype=np.float64, nSeed=None):
+    '''
+        This function draws a fixed random sample to estimate the loss of fit()
+        between two full evaluations (see estimateLoss): nSamples observed 
+        training entries of R, and the same fraction of rows of D and S.
+        
+        params:
+            nSeed - seed of the sample, it is drawn from np.random if None, i.e.,
+                    it follows the seed of the fold (see runFold)
+        
+        return:
+            dcSample - {'rows', 'cols', 'values', 'nnz', 'users', 'D', 'weightD',
+                        'nUsers', 'videos', 'S', 'weightS', 'nVideos'}
+    '''
+    rng = np.random.RandomState(nSeed) if nSeed is not None else np.random
+    R_train = getObservedEntries(R, weightR_train, dtype)
+    nSamples = min(nSamples, R_train.nnz)
+    dFraction = nSamples * 1.0 / R_train.nnz
+    arrIndex = np.sort(rng.choice(R_train.nnz, nSamples, replace=False))
+    arrUsers = np.sort(rng.choice(D.shape[0], max(1, int(round(dFraction*D.shape[0]))), replace=False))
+    arrVideos = np.sort(rng.choice(S.shape[0], max(1, int(round(dFraction*S.shape[0]))), replace=False))
+    
+    dcSample = {}
+    dcSample['rows'] = R_train.row[arrIndex]
+    dcSample['cols'] = R_train.col[arrIndex]
+    dcSample['values'] = R_train.data[arrIndex]
+    dcSample['nnz'] = R_train.nnz
+    dcSample['users'] = arrUsers
+    dcSample['D'] = D[arrUsers]
+    dcSample['weightD'] = weightD_train[arrUsers]
+    dcSample['nUsers'] = D.shape[0]
+    dcSample['videos'] = arrVideos
+    dcSample['S'] = S[arrVideos]
+    dcSample['weightS'] = weightS_train[arrVideos]
+    dcSample['nVideos'] = S.shape[0]
+    return dcSample
+
+def estimateLoss(dcSample, U, V, P, Q, Bu, Bv, mu, arrAlphas, arrLambdas):
+    '''
+        This function estimates the loss of fit() on a sample (see 
+        createLossSample): the squared errors of R, D, S are scaled up from the
+        sampled entries (rows), which is unbiased as the sample is drawn 
+        uniformly without replacement; the regularization is exact.
+        
+        return:
+            estimated loss, its standard error
+    '''
+    arrSquaredR = np.square(dcSample['values'] - computeObservedPrediction(U, V, Bu, Bv, mu, \
+                                                                           dcSample['rows'], dcSample['cols']) )
+    arrSquaredD = np.square(np.multiply(dcSample['weightD'], \
+                                        dcSample['D'] - np.dot(U[dcSample['users']], P.T)) ).sum(axis=1)
+    arrSquaredS = np.square(np.multiply(dcSample['weightS'], \
+                                        dcSample['S'] - np.dot(V[dcSample['videos']], Q.T)) ).sum(axis=1)
+    
+    dLoss = (arrLambdas[0]/2.0) * ( np.vdot(U, U) + np.vdot(V, V) ) \
+            + (arrLambdas[1]/2.0) * np.vdot(P, P) \
+            + (arrLambdas[2]/2.0) * np.vdot(Q, Q) \
+            + (arrLambdas[3]/2.0) * np.vdot(Bu, Bu) \
+            + (arrLambdas[4]/2.0) * np.vdot(Bv, Bv)
+    dVariance = 0.0
+    for dAlpha, arrSquared, nTotal in [(arrAlphas[0], arrSquaredR, dcSample['nnz']), \
+                                       (arrAlphas[1], arrSquaredD, dcSample['nUsers']), \
+                                       (arrAlphas[2], arrSquaredS, dcSample['nVideos'])]:
+        nSamples = len(arrSquared)
+        dLoss += (dAlpha/2.0) * nTotal * arrSquared.mean()
+        # variance of the scaled sum, with finite population correction
+        dVariance += (dAlpha/2.0)**2 * nTotal**2 * (1.0 - nSamples*1.0/nTotal) * arrSquared.var() / nSamples
+    
+    return dLoss, np.sqrt(dVariance)
+
+def initLowRankMatrices(R, D, S, f, dtype=np.float64, dcInitModel=None):
+    '''
+        This function randomly initializes the low rank matrices in dtype, or
+        copies them from dcInitModel (warm start) if it is given.
+        
+        params:
+            dcInitModel - a fitted model (see cmf_model.packModel), whose rows must
+                          match R, D, S (see cmf_model.alignModel)
+        
+        return:
+            U, P, V, Q, Bu, Bv, Jm, Jn
+    '''
+    # D = U·P^T
+    U = np.random.rand(D.shape[0], f).astype(dtype)
+    P = np.random.rand(D.shape[1], f).astype(dtype)
+    
+    # S = V·Q^T
+    V = np.random.rand(S.shape[0], f).astype(dtype)
+    Q = np.random.rand(S.shape[1], f).astype(dtype)
+    
+    # bu, bv
+    Bu = np.random.rand(R.shape[0], 1).astype(dtype)
+    Bv = np.random.rand(R.shape[1], 1).astype(dtype)
+    
+    # warm start, copy so that the model is not updated in place by training
+    if (dcInitModel is not None):
+        lsInit = [np.array(dcInitModel[strName], dtype=dtype) for strName in ['U', 'P', 'V', 'Q', 'Bu', 'Bv']]
+        for mtRandom, mtInit in zip([U, P, V, Q, Bu, Bv], lsInit):
+            if (mtRandom.shape != mtInit.shape):
+                raise ValueError("init model doesn't match data: %s vs %s" % (mtInit.shape, mtRandom.shape) )
+        U, P, V, Q, Bu, Bv = lsInit
+    
+    # Jm, Jn
+    Jm = np.ones((R.shape[0], 1), dtype=dtype)
+    Jn = np.ones((R.shape[1], 1), dtype=dtype)
+    
+    return U, P, V, Q, Bu, Bv, Jm, Jn
+
+def init(mtR, mtD, mtS, inplace, dReductionRatio=0.7, dtype=np.float64, dcPreprocess=None):
     '''
         This function:
         1. return the weight matrices for R,D,S;
@@ -112,6 +710,17 @@ def init(mtR, mtD, mtS, inplace, dReductionRatio=0.7):
                 be modified (e.g., fill missing value with 0).
                 2. in the returns of this function, zero is used for missing
                 value, no more Nan
+                3. mtR can be either a float matrix (Nan for missing value), 
+                or a uint8 matrix (ratio*100, g_nMissingRatio for missing
+                value), the latter is kept as uint8 unless video dimension is
+                reduced, and its ratios are scaled back to 0.0~1.0 where they
+                are used (see getObservedEntries, fit).
+                4. D and S are returned in dtype, if dtype is compact (see 
+                isCompact), the weight matrices are returned as boolean masks.
+                5. if dcPreprocess is given, it is filled with the preprocessing
+                parameters, so that they can be saved with the model (see
+                cmf_model.saveModel): the column means of D, S (missing values)
+                and min/scale of them (x*scale + min), reduction ratio and dtype.
                 
     '''
     
@@ -144,7 +753,11 @@ def init(mtR, mtD, mtS, inplace, dReductionRatio=0.7):
     #===========================================================================
     imp = prepro.Imputer(missing_values='NaN', strategy='mean', axis=0, copy=False)
     D = imp.fit_transform(D)
+    if (dcPreprocess is not None):
+        dcPreprocess['D_mean'] = imp.statistics_.copy()
     S = imp.fit_transform(S)
+    if (dcPreprocess is not None):
+        dcPreprocess['S_mean'] = imp.statistics_.copy()
 
     #===========================================================================
     # feature scaling
@@ -153,58 +766,152 @@ def init(mtR, mtD, mtS, inplace, dReductionRatio=0.7):
     # scaling features of D and S to [0,1]
     scaler = prepro.MinMaxScaler(copy=False)
     D = scaler.fit_transform(D)
+    if (dcPreprocess is not None):
+        dcPreprocess['D_min'] = scaler.min_.copy()
+        dcPreprocess['D_scale'] = scaler.scale_.copy()
     S = scaler.fit_transform(S)
+    if (dcPreprocess is not None):
+        dcPreprocess['S_min'] = scaler.min_.copy()
+        dcPreprocess['S_scale'] = scaler.scale_.copy()
+        dcPreprocess['reduction_ratio'] = dReductionRatio
+        dcPreprocess['dtype'] = np.dtype(dtype).str
     
     #===========================================================================
     # reduce video dimension
     #===========================================================================
     if (dReductionRatio < 1.0 ):
         print('start to reduce video dimension...')
+        if (R.dtype == np.uint8):
+            R = np.where(R == g_nMissingRatio, np.nan, R*g_dRatioScale).astype(dtype)
         R, S = reduceVideoDimension(R, S, int(S.shape[0]*dReductionRatio))
         
         
-    # filter out invalid tuple
-    R_filtered, D_filtered, S_filtered = filterInvalidRecords(mtR, mtD, mtS)
-        
     # get weight matrix
-    arrMaskR = (np.isnan(R))
+    if (R.dtype == np.uint8):
+        arrMaskR = (R == g_nMissingRatio)
+    else:
+        arrMaskR = (np.isnan(R))
     weightR = np.where(arrMaskR, 0.0, 1.0) 
     weightS = np.where(np.isnan(S), 0.0, 1.0)
     
     
     # fill missing value in R
-    R[np.isnan(R)] = 0.0
+    R[arrMaskR] = 0
+    
+    # apply dtype policy
+    D = D.astype(dtype, copy=False)
+    S = S.astype(dtype, copy=False)
+    if (R.dtype != np.uint8):
+        R = R.astype(dtype, copy=False)
+    if (isCompact(dtype)):
+        weightR = weightR.astype(bool)
+        weightD = weightD.astype(bool)
+        weightS = weightS.astype(bool)
     
     return R, D, S, weightR, weightD, weightS
 
+def createSnapshot(U, V, P, Q, Bu, Bv):
+    '''
+        This function preallocates a snapshot of low rank matrices, 
+        which is filled in place by saveSnapshot
+    '''
+    dcSnapshot = {}
+    dcSnapshot['U'] = np.empty_like(U)
+    dcSnapshot['V'] = np.empty_like(V)
+    dcSnapshot['P'] = np.empty_like(P)
+    dcSnapshot['Q'] = np.empty_like(Q)
+    dcSnapshot['Bu'] = np.empty_like(Bu)
+    dcSnapshot['Bv'] = np.empty_like(Bv)
+    return dcSnapshot
+
+def saveSnapshot(dcSnapshot, U, V, P, Q, Bu, Bv):
+    '''
+        This function copies low rank matrices into a preallocated snapshot
+    '''
+    np.copyto(dcSnapshot['U'], U)
+    np.copyto(dcSnapshot['V'], V)
+    np.copyto(dcSnapshot['P'], P)
+    np.copyto(dcSnapshot['Q'], Q)
+    np.copyto(dcSnapshot['Bu'], Bu)
+    np.copyto(dcSnapshot['Bv'], Bv)
+
 def fit(R, D, S, weightR_train, weightR_test, weightD_train, weightS_train, \
         f, arrAlphas, arrLambdas, nMaxStep, \
-        lsTrainingTrace, bDebugInfo=True):
+        lsTrainingTrace, bDebugInfo=True, bSparse=False, strLineSearch='backtracking', \
+        dtype=np.float64, nPatience=None, strMonitor='rmseR_test', \
+        strOptimizer=None, dLearningRate=None, strSchedule='constant', \
+        dcInitModel=None, bWorkspace=False, bFused=False, \
+        nEvalInterval=1, nLossSamples=None, nSampleSeed=None):
     '''
         This function train CMF based on given input and params
+
+        Note:
+            1. if bSparse=True, R is only accessed on its observed entries (i.e.,
+               non-zero entries of weightR_train/weightR_test), both R and the
+               weights of R can be either dense or scipy sparse matrices in this mode.
+               Otherwise, R is dense, and the weights of R can be either dense or
+               index-based masks (see maskError).
+            2. strLineSearch selects how the step size is searched:
+               'backtracking' - halve gamma from g_gamma0 and recompute the residual
+                                errors for each trial;
+               'polynomial'   - evaluate the loss of each trial by a quartic polynomial
+                                of gamma (see computeLossPolynomial), and warm-start
+                                gamma from the last accepted one.
+            3. the low rank matrices are computed in dtype, e.g., np.float32 
+               halves the memory and doubles the BLAS throughput.
+            4. if nPatience is given, training stops early once strMonitor (a key of
+               g_dcMonitorIndex, lower is better) has not improved for nPatience
+               steps, and the low rank matrices of the best step are returned.
+            5. if strOptimizer is given (see cmf_optimizer.g_lsOptimizers), the line
+               search is replaced by this optimizer with learning rate dLearningRate
+               (the optimizer's default if None, see cmf_optimizer.g_dcDefaultRates,
+               scheduled by strSchedule, see getLearningRate), the low rank matrices
+               are updated in place. A step which increases the loss is rejected 
+               (the matrices are restored) and the learning rate is halved.
+            6. if dcInitModel is given, training is warm-started from it (see
+               initLowRankMatrices).
+            7. if bWorkspace=True (dense engine only), the residual errors, gradients
+               and trial steps are preallocated once (see createWorkspace) and
+               updated in place in every step.
+            8. if bFused=True, the residual errors, loss and gradients of a step are
+               computed by one fused kernel (see cmf_kernel.computeLossAndGradient,
+               JIT-compiled if numba is available, otherwise a vectorized numpy
+               version which isn't fused), R is only accessed on its
+               observed entries as in bSparse=True. Trial steps of backtracking
+               only compute the loss, the gradients of the accepted step are
+               accumulated from its residuals (see cmf_kernel.computeGradient).
+            9. lsTrainingTrace can be a list (a dict is appended per step), a
+               compact trace (see cmf_trace.createTrace) or None.
+           10. the full metrics (rmses, test rmse and exact loss) are only computed,
+               recorded and monitored every nEvalInterval steps (and at the last
+               step). If nLossSamples is given, the loss compared by the 
+               backtracking line search, the optimizer and the convergence test
+               is estimated on a fixed sample of nLossSamples observed entries of
+               R and the same fraction of rows of D, S (see createLossSample,
+               its standard error is logged as 'loss_se'); the polynomial line
+               search uses its exact polynomial instead. nEvalInterval > 1
+               requires nLossSamples.
     '''
     #===========================================================================
     # init low rank matrices
     #===========================================================================
-    # D = U·P^T
-    U = np.random.rand(D.shape[0], f)
-    P = np.random.rand(D.shape[1], f)
-    
-    # S = V·Q^T
-    V = np.random.rand(S.shape[0], f)
-    Q = np.random.rand(S.shape[1], f)
-    
-    # bu, bv
-    Bu = np.random.rand(R.shape[0], 1)
-    Bv = np.random.rand(R.shape[1], 1)
-    
-    # Jm, Jn
-    Jm = np.ones((R.shape[0], 1), dtype=np.float64)
-    Jn = np.ones((R.shape[1], 1), dtype=np.float64)
+    U, P, V, Q, Bu, Bv, Jm, Jn = initLowRankMatrices(R, D, S, f, dtype, dcInitModel)
     
     # compute mu, must be calculated after masking test data
-    mu = ( (R*weightR_train).sum()*1.0) / weightR_train.sum()
-    
+    bSparse = bSparse or bFused
+    if (not bSparse and R.dtype == np.uint8):
+        R = (R*g_dRatioScale).astype(dtype) # dense mode needs R as ratios
+    if (bSparse):
+        R_train = getObservedEntries(R, weightR_train, dtype)
+        R_test = getObservedEntries(R, weightR_test, dtype)
+        mu = R_train.data.mean()
+        if (bFused):
+            dcTrain = cmf_kernel.sortObservedEntries(R_train)
+    elif (sparse.issparse(weightR_train)):
+        mu = getObservedEntries(R, weightR_train, dtype).data.mean()
+    else:
+        mu = np.dtype(dtype).type( (R*weightR_train).sum()*1.0 / weightR_train.sum() )
+
 #     # compute bu ( for mean normalization), must be calculated after masking test data
 #     # bu will only be computed if there are more than 2 tuples in the records of this user
 #     bu = np.where(weightR_train.sum(axis=1)>=3.0, ( ( (R-mu)*weightR_train).sum(axis=1)*1.0) / weightR_train.sum(axis=1), 0.0)
@@ -225,10 +932,71 @@ def fit(R, D, S, weightR_train, weightR_test, weightD_train, weightS_train, \
     
     print "arrAlphas_scaled = ", arrAlphas_scaled
     print "arrLambdas_scaled = ", arrLambdas_scaled
-    
+
+    # preallocated buffers
+    dcWorkspace = None
+    if (bWorkspace and not bSparse):
+        dcWorkspace = createWorkspace(R, D, S, U, V, P, Q, Bu, Bv, weightR_train, weightR_test, \
+                                      bPolynomial=(strOptimizer is None and strLineSearch == 'polynomial') )
+    lsNextBuffers = None
+    if (dcWorkspace is not None):
+        lsNextBuffers = [dcWorkspace['next'+strName] for strName in ['U', 'V', 'P', 'Q', 'Bu', 'Bv'] ]
+    
+    # sampled loss between full evaluations
+    dcSample = None
+    if (nLossSamples is not None):
+        dcSample = createLossSample(R, weightR_train, D, S, weightD_train, weightS_train, \
+                                    nLossSamples, dtype, nSampleSeed)
+    elif (nEvalInterval > 1):
+        raise ValueError("nEvalInterval > 1 requires nLossSamples")
+    
+    def computeError(U, V, P, Q, Bu, Bv, bMetrics=True, bGradient=True):
+        if (bFused):
+            # gradients are returned as well, unless bGradient=False (trial steps)
+            return cmf_kernel.computeLossAndGradient(dcTrain, R_test, D, S, U, V, P, Q, Bu, Bv, mu, \
+                                                     weightD_train, weightS_train, \
+                                                     arrAlphas_scaled, arrLambdas_scaled, bGradient)
+        if (dcWorkspace is not None):
+            return computeResidualError_inplace(R, D, S, U, V, P, Q, Bu, Bv, mu, \
+                                                weightR_train, weightR_test, weightD_train, weightS_train, \
+                                                arrAlphas_scaled, arrLambdas_scaled, dcWorkspace, bMetrics)
+        if (bSparse):
+            return computeResidualError_sparse(R_train, R_test, D, S, U, V, P, Q, Bu, Bv, mu, \
+                                               weightD_train, weightS_train, \
+                                               arrAlphas_scaled, arrLambdas_scaled, bMetrics)
+        return computeResidualError(R, D, S, U, V, P, Q, Bu, Bv, mu, Jm, Jn,\
+                                    weightR_train, weightR_test, weightD_train, weightS_train, \
+                                    arrAlphas_scaled, arrLambdas_scaled, bMetrics)
+    
+    def computeLoss(U, V, P, Q, Bu, Bv):
+        return estimateLoss(dcSample, U, V, P, Q, Bu, Bv, mu, arrAlphas_scaled, arrLambdas_scaled)
+
     #===========================================================================
     # iterate until converge or max steps
     #===========================================================================
+    tpNextError = None # residual errors of the accepted step
+    gammaLast = g_gamma0
+    
+    # best snapshot for early stopping
+    nMonitor = g_dcMonitorIndex[strMonitor]
+    dcBest = None
+    dBestMetric = None
+    nBestStep = None
+    if (nPatience is not None):
+        dcBest = createSnapshot(U, V, P, Q, Bu, Bv)
+    
+    # per-parameter state of adaptive optimizer
+    dcOptimizerState = None
+    if (strOptimizer is not None):
+        dcOptimizerState = cmf_optimizer.createOptimizerState(strOptimizer, [U, V, P, Q, Bu, Bv])
+        if (dLearningRate is None):
+            dLearningRate = cmf_optimizer.getDefaultRate(strOptimizer)
+        dRateScale = 1.0 # halved by each rejected step
+        dcPrevious = createSnapshot(U, V, P, Q, Bu, Bv)
+    
+    # progress is printed at a bounded rate
+    dcLogger = cmf_trace.createLogger()
+    
     for nStep in xrange(nMaxStep):
         currentU = U
         currentP = P
@@ -237,42 +1005,70 @@ def fit(R, D, S, weightR_train, weightR_test, weightD_train, weightS_train, \
         currentBu = Bu
         currentBv = Bv
         
-        # compute error
+        # full evaluation every nEvalInterval steps
+        bEvaluate = (nStep % nEvalInterval == 0 or nStep == nMaxStep-1)
+        
+        # compute error, reuse the one of last accepted step if available
+        if (tpNextError is None):
+            tpNextError = computeError(currentU, currentV, currentP, currentQ, \
+                                       currentBu, currentBv, bEvaluate)
         mtCurrentErrorR, mtCurrentErrorD, mtCurrentErrorS, \
         dCurrentRmseR_train, dCurrentRmseR_test, dCurrentRmseD, dCurrentRmseS, \
-        dCurrentLoss = computeResidualError(R, D, S, \
-                                            currentU, currentV, currentP, currentQ, \
-                                            currentBu, currentBv, mu, Jm, Jn,\
-                                            weightR_train, weightR_test, weightD_train, weightS_train, \
-                                            arrAlphas_scaled, arrLambdas_scaled)
+        dCurrentLoss = tpNextError[:8]
         
-        # save RMSE
-        if (lsTrainingTrace is not None):
+        bLogged = False
+        if (bEvaluate):
+            # save RMSE
             dcRMSE = {}
             dcRMSE['rmseR'] = dCurrentRmseR_train
             dcRMSE['rmseR_test'] = dCurrentRmseR_test
             dcRMSE['rmseD'] = dCurrentRmseD
             dcRMSE['rmseS'] = dCurrentRmseS
             dcRMSE['loss'] = dCurrentLoss
-            lsTrainingTrace.append(dcRMSE)
-        
-        # output
-        if (bDebugInfo):
-            print("------------------------------")
-            print("step %d" % (nStep) )
-            print("    RMSE(R) = %f" % dCurrentRmseR_train )
-            print("    RMSE(R)_test = %f" % dCurrentRmseR_test )
-            print("    RMSE(D) = %f" % dCurrentRmseD )
-            print("    RMSE(S) = %f" % dCurrentRmseS )
-            print("    loss = %f" % dCurrentLoss )
+            if (dcSample is not None):
+                dcRMSE['loss_sampled'], dcRMSE['loss_se'] = computeLoss(currentU, currentV, currentP, currentQ, \
+                                                                        currentBu, currentBv)
+            cmf_trace.recordTrace(lsTrainingTrace, nStep, dcRMSE)
             
+            # output, details of this step are only printed with its metrics
+            bLogged = bDebugInfo and cmf_trace.logProgress(dcLogger, "step %d" % nStep, dcRMSE)
+            
+            # early stopping
+            if (nPatience is not None):
+                if (dBestMetric is None or tpNextError[nMonitor] < dBestMetric):
+                    dBestMetric = tpNextError[nMonitor]
+                    nBestStep = nStep
+                    saveSnapshot(dcBest, currentU, currentV, currentP, currentQ, currentBu, currentBv)
+                elif (nStep - nBestStep >= nPatience):
+                    print("early stopped @ step %d: best step=%d, %s=%f" % (nStep, nBestStep, strMonitor, dBestMetric) )
+                    break
+        
+        # losses of line search and convergence test are compared on the sample
+        if (dcSample is not None):
+            dCurrentLoss = dcRMSE['loss_sampled'] if bEvaluate \
+                           else computeLoss(currentU, currentV, currentP, currentQ, currentBu, currentBv)[0]
             
         # compute partial gradient
-        gradU, gradV, gradP, gradQ, gradBu, gradBv = \
-            computeParitialGraident(mtCurrentErrorR, mtCurrentErrorD, mtCurrentErrorS, \
-                                    currentU, currentV, currentP, currentQ, \
-                                    currentBu, currentBv, Jm, Jn, \
-                                    arrAlphas_scaled, arrLambdas_scaled)
+        if (bFused and tpNextError[8] is None):
+            # accepted trial step of backtracking, only its loss was computed
+            gradU, gradV, gradP, gradQ, gradBu, gradBv = \
+                cmf_kernel.computeGradient(dcTrain, mtCurrentErrorR, mtCurrentErrorD, mtCurrentErrorS, \
+                                           currentU, currentV, currentP, currentQ, currentBu, currentBv, \
+                                           arrAlphas_scaled, arrLambdas_scaled)
+        elif (bFused):
+            gradU, gradV, gradP, gradQ, gradBu, gradBv = tpNextError[8:]
+        elif (dcWorkspace is not None):
+            gradU, gradV, gradP, gradQ, gradBu, gradBv = \
+                computeParitialGraident_inplace(mtCurrentErrorR, mtCurrentErrorD, mtCurrentErrorS, \
+                                                currentU, currentV, currentP, currentQ, \
+                                                currentBu, currentBv, \
+                                                arrAlphas_scaled, arrLambdas_scaled, dcWorkspace)
+        else:
+            gradU, gradV, gradP, gradQ, gradBu, gradBv = \
+                computeParitialGraident(mtCurrentErrorR, mtCurrentErrorD, mtCurrentErrorS, \
+                                        currentU, currentV, currentP, currentQ, \
+                                        currentBu, currentBv, Jm, Jn, \
+                                        arrAlphas_scaled, arrLambdas_scaled)
         
         #=======================================================================
         # search for max step
@@ -283,28 +1079,87 @@ def fit(R, D, S, weightR_train, weightR_test, weightD_train, weightS_train, \
         dNextRmseS = None
         dNextLoss = None
         gamma = g_gamma0
-        while(True):
+        if (strOptimizer is not None):
+            gamma = dRateScale * getLearningRate(dLearningRate, nStep, strSchedule)
+            if (gamma < g_dMinGamma):
+                print("learning rate is too small, loss can't decrease any more!")
+                break
+            saveSnapshot(dcPrevious, U, V, P, Q, Bu, Bv)
+            cmf_optimizer.updateParams(dcOptimizerState, [U, V, P, Q, Bu, Bv], \
+                                       [gradU, gradV, gradP, gradQ, gradBu, gradBv], gamma)
+            
+            if (dcSample is not None):
+                # residual errors are computed at the next step
+                tpNextError = None
+                dNextLoss = computeLoss(U, V, P, Q, Bu, Bv)[0]
+            else:
+                tpNextError = computeError(U, V, P, Q, Bu, Bv)
+                dNextRmseR_train, dNextRmseR_test, dNextRmseD, dNextRmseS, dNextLoss = tpNextError[3:8]
+            
+            if (dNextLoss > dCurrentLoss or np.isnan(dNextLoss)):
+                # reject the step, the residual errors are recomputed at the next step
+                if (bDebugInfo):
+                    print("loss increases (%f -> %f), step is rejected, gamma=%f is halved" % \
+                          (dCurrentLoss, dNextLoss, gamma) )
+                for strName, param in zip(['U', 'V', 'P', 'Q', 'Bu', 'Bv'], [U, V, P, Q, Bu, Bv]):
+                    np.copyto(param, dcPrevious[strName])
+                dRateScale /= 2.0
+                tpNextError = None
+                continue
+            
+        elif (strLineSearch == 'polynomial'):
+            arrLossCoef = computeLossPolynomial(mtCurrentErrorR, mtCurrentErrorD, mtCurrentErrorS, \
+                                                currentU, currentV, currentP, currentQ, \
+                                                currentBu, currentBv, \
+                                                gradU, gradV, gradP, gradQ, gradBu, gradBv, \
+                                                weightR_train, weightD_train, weightS_train, \
+                                                arrAlphas_scaled, arrLambdas_scaled, dcWorkspace)
+            if (dcSample is not None):
+                # the polynomial is exact, its constant term is the current loss
+                dCurrentLoss = arrLossCoef[-1]
+            
+            # allow gamma to grow back, otherwise it can only shrink over steps
+            gamma = min(g_gamma0, 2.0*gammaLast)
+            while (np.polyval(arrLossCoef, gamma) >= dCurrentLoss and gamma > g_dMinGamma):
+                gamma = gamma/2.0
+            
+            if (bLogged):
+                print('-->max gamma=%f' % gamma)
+            gammaLast = gamma
+            U, V, P, Q, Bu, Bv = computeNextStep([currentU, currentV, currentP, currentQ, currentBu, currentBv], \
+                                                 [gradU, gradV, gradP, gradQ, gradBu, gradBv], gamma, lsNextBuffers)
+            if (dcWorkspace is not None):
+                # the buffers of current step are free for the next trial
+                lsNextBuffers = [currentU, currentV, currentP, currentQ, currentBu, currentBv]
+            
+            if (dcSample is not None):
+                tpNextError = None
+                dNextLoss = np.polyval(arrLossCoef, gamma)
+            else:
+                tpNextError = computeError(U, V, P, Q, Bu, Bv)
+                dNextRmseR_train, dNextRmseR_test, dNextRmseD, dNextRmseS, dNextLoss = tpNextError[3:8]
+            
+        while(strOptimizer is None and strLineSearch == 'backtracking'):
             # try a possible step
-            nextU = currentU - gamma*gradU
-            nextP = currentP - gamma*gradP
-            nextV = currentV - gamma*gradV
-            nextQ = currentQ - gamma*gradQ
-            nextBu = currentBu - gamma*gradBu
-            nextBv = currentBv - gamma*gradBv
+            nextU, nextV, nextP, nextQ, nextBu, nextBv = \
+                computeNextStep([currentU, currentV, currentP, currentQ, currentBu, currentBv], \
+                                [gradU, gradV, gradP, gradQ, gradBu, gradBv], gamma, lsNextBuffers)
              
-            mtNextErrorR, mtNextErrorD, mtNextErrorS, \
-            dNextRmseR_train, dNextRmseR_test, dNextRmseD, dNextRmseS, \
-            dNextLoss = computeResidualError(R, D, S, nextU, nextV, nextP, nextQ, \
-                                             nextBu, nextBv, mu, Jm, Jn,\
-                                             weightR_train, weightR_test, weightD_train, weightS_train, \
-                                             arrAlphas_scaled, arrLambdas_scaled)
+            if (dcSample is not None):
+                # only the accepted step needs its residual errors
+                tpNextError = None
+                dNextLoss = computeLoss(nextU, nextV, nextP, nextQ, nextBu, nextBv)[0]
+            else:
+                # gradients of the fused kernel are only computed for the accepted step
+                tpNextError = computeError(nextU, nextV, nextP, nextQ, nextBu, nextBv, bGradient=False)
+                dNextRmseR_train, dNextRmseR_test, dNextRmseD, dNextRmseS, dNextLoss = tpNextError[3:8]
                  
             if (dNextLoss >= dCurrentLoss):
                 # search for max step size
                 gamma = gamma/2.0 
             else:
                 # save the best update
-                if (bDebugInfo):
+                if (bLogged):
                     print('-->max gamma=%f' % gamma)
                 U = nextU
                 V = nextV
@@ -312,6 +1167,9 @@ def fit(R, D, S, weightR_train, weightR_test, weightD_train, weightS_train, \
                 Q = nextQ
                 Bu = nextBu
                 Bv = nextBv
+                if (dcWorkspace is not None):
+                    # the buffers of current step are free for the next trial
+                    lsNextBuffers = [currentU, currentV, currentP, currentQ, currentBu, currentBv]
                 break     
         
         #=======================================================================
@@ -319,57 +1177,301 @@ def fit(R, D, S, weightR_train, weightR_test, weightD_train, weightS_train, \
         #=======================================================================
         dChange = dCurrentLoss-dNextLoss
         if( dChange>=0.0 and dChange<=g_dConvergenceThresold): 
+            if (tpNextError is None):
+                # full metrics of the final step
+                tpNextError = computeError(U, V, P, Q, Bu, Bv)
+                dNextRmseR_train, dNextRmseR_test, dNextRmseD, dNextRmseS, dNextLoss = tpNextError[3:8]
             print("converged @ step %d: change:%f, loss=%f, rmseR_test=%f" % (nStep, dChange, dNextLoss, dNextRmseR_test) )
             
             # save RMSE
-            if (lsTrainingTrace is not None):
-                dcRMSE = {}
-                dcRMSE['rmseR'] = dNextRmseR_train
-                dcRMSE['rmseR_test'] = dNextRmseR_test
-                dcRMSE['rmseD'] = dNextRmseD
-                dcRMSE['rmseS'] = dNextRmseS
-                dcRMSE['loss'] = dNextLoss
-                lsTrainingTrace.append(dcRMSE)
+            dcRMSE = {}
+            dcRMSE['rmseR'] = dNextRmseR_train
+            dcRMSE['rmseR_test'] = dNextRmseR_test
+            dcRMSE['rmseD'] = dNextRmseD
+            dcRMSE['rmseS'] = dNextRmseS
+            dcRMSE['loss'] = dNextLoss
+            cmf_trace.recordTrace(lsTrainingTrace, nStep+1, dcRMSE)
                 
             if (bDebugInfo):
-                print("------------------------------")
-                print("final step:")
-                print("    RMSE(R) = %f" % dNextRmseR_train )
-                print("    RMSE(R)_test = %f" % dNextRmseR_test )
-                print("    RMSE(normD) = %f" % dNextRmseD )
-                print("    RMSE(normS) = %f" % dNextRmseS )
-                print("    loss = %f" % dNextLoss )
+                cmf_trace.logProgress(dcLogger, "final step", dcRMSE, bForce=True)
             
             break
         
-        elif(dChange < 0.0): # loss increases
+        elif(dChange < 0.0 and strOptimizer is None): # loss increases
             print "learning rate is too large, loss increases!"
             break
         
         else: # loss decreases, but is not converged, do nothing
-            if(bDebugInfo):
+            if(bLogged):
                 print("-->change: %f" % dChange)
             pass 
         
     #END step
     
+    # tpNextError is the residual errors of the last U, V, P, Q, Bu, Bv, if available
+    if (nPatience is not None and dBestMetric is not None):
+        if (tpNextError is None or tpNextError[nMonitor] is None):
+            tpNextError = computeError(U, V, P, Q, Bu, Bv)
+        if (dBestMetric < tpNextError[nMonitor]):
+            return dcBest['U'], dcBest['V'], dcBest['P'], dcBest['Q'], dcBest['Bu'], dcBest['Bv'], mu, Jm, Jn
+    
+    return U, V, P, Q, Bu, Bv, mu, Jm, Jn
+
+def updateMiniBatch(arrRows, arrCols, arrValues, D, S, weightD_train, weightS_train, \
+                    U, V, P, Q, Bu, Bv, mu, arrUserCount, arrVideoCount, nEntries, \
+                    arrAlphas, arrLambdas, gamma, bUpdatePQ=True):
+    '''
+        This function takes one gradient step on a batch of observed entries of R,
+        U, V, P, Q, Bu, Bv are updated in place.
+        
+        params:
+            arrRows, arrCols, arrValues - (user, video, ratio) of entries in the batch
+            arrUserCount, arrVideoCount - #training entries of each user/video
+            nEntries                    - #training entries of R
+            bUpdatePQ                   - if False, P, Q are left to the caller 
+                                          (see cmf_parallel.fitHogwild)
+    '''
+    arrUsers, arrUserIndex = np.unique(arrRows, return_inverse=True)
+    arrVideos, arrVideoIndex = np.unique(arrCols, return_inverse=True)
+    
+    # weights of the matching rows in D, S
+    arrUserWeight = (np.bincount(arrUserIndex) / arrUserCount[arrUsers]).reshape(-1, 1)
+    arrVideoWeight = (np.bincount(arrVideoIndex) / arrVideoCount[arrVideos]).reshape(-1, 1)
+    dBatchWeight = len(arrRows) * 1.0 / nEntries
+    
+    batchU = U[arrUsers]
+    batchV = V[arrVideos]
+    
+    #===========================================================================
+    # compute error of batch
+    #===========================================================================
+    arrErrorR = arrValues - computeObservedPrediction(U, V, Bu, Bv, mu, arrRows, arrCols)
+    errorR = sparse.csr_matrix((arrErrorR, (arrUserIndex, arrVideoIndex)), \
+                               shape=(len(arrUsers), len(arrVideos)) )
+    errorD = arrUserWeight * np.multiply(weightD_train[arrUsers], D[arrUsers] - np.dot(batchU, P.T))
+    errorS = arrVideoWeight * np.multiply(weightS_train[arrVideos], S[arrVideos] - np.dot(batchV, Q.T))
+    
+    #===========================================================================
+    # compute partial gradient of batch
+    #===========================================================================
+    gradU = ( -1.0*arrAlphas[0]*errorR.dot(batchV) - arrAlphas[1]*np.dot(errorD, P) \
+              + arrLambdas[0]*arrUserWeight*batchU )
+    gradV = ( -1.0*arrAlphas[0]*errorR.T.dot(batchU) - arrAlphas[2]*np.dot(errorS, Q) \
+              + arrLambdas[0]*arrVideoWeight*batchV )
+    if (bUpdatePQ):
+        gradP = ( -1.0*arrAlphas[1]*np.dot(errorD.T, batchU) + arrLambdas[1]*dBatchWeight*P )
+        gradQ = ( -1.0*arrAlphas[2]*np.dot(errorS.T, batchV) + arrLambdas[2]*dBatchWeight*Q )
+    gradBu = ( -1.0*arrAlphas[0]*np.asarray(errorR.sum(axis=1)) + arrLambdas[3]*arrUserWeight*Bu[arrUsers] )
+    gradBv = ( -1.0*arrAlphas[0]*np.asarray(errorR.sum(axis=0)).T + arrLambdas[4]*arrVideoWeight*Bv[arrVideos] )
+    
+    #===========================================================================
+    # update
+    #===========================================================================
+    U[arrUsers] -= gamma*gradU
+    V[arrVideos] -= gamma*gradV
+    if (bUpdatePQ):
+        P -= gamma*gradP
+        Q -= gamma*gradQ
+    Bu[arrUsers] -= gamma*gradBu
+    Bv[arrVideos] -= gamma*gradBv
+
+def fitMiniBatch(R, D, S, weightR_train, weightR_test, weightD_train, weightS_train, \
+                 f, arrAlphas, arrLambdas, nMaxEpoch, \
+                 lsTrainingTrace, bDebugInfo=True, \
+                 nBatchSize=1024, dLearningRate=0.01, strSchedule='invscaling', \
+                 dtype=np.float64, dcInitModel=None):
+    '''
+        This function train CMF by mini-batch stochastic gradient descent.
+        
+        In each epoch, the observed entries of R are shuffled and cut into batches 
+        of nBatchSize entries. A batch also contains the rows of D (S) of the users 
+        (videos) which appear in it, each row is weighted by the fraction of the 
+        user's (video's) entries in this batch, so that the loss of all batches 
+        in an epoch sums up to the loss of fit().
+        
+        params:
+            nMaxEpoch     - max number of passes over the observed entries of R
+            nBatchSize    - number of observed entries of R in a batch
+            dLearningRate - initial learning rate, see getLearningRate
+            strSchedule   - learning rate schedule, see getLearningRate
+            dtype         - dtype of low rank matrices
+            dcInitModel   - warm start from this model, see initLowRankMatrices
+            
+        return:
+            same as fit()
+            
+        Note: 
+            1. users (videos) which don't have any training entry in R are not updated;
+            2. R and the weights of R can be either dense or scipy sparse matrices.
+    '''
+    #===========================================================================
+    # init low rank matrices
+    #===========================================================================
+    U, P, V, Q, Bu, Bv, Jm, Jn = initLowRankMatrices(R, D, S, f, dtype, dcInitModel)
+    
+    R_train = getObservedEntries(R, weightR_train, dtype)
+    R_test = getObservedEntries(R, weightR_test, dtype)
+    mu = R_train.data.mean()
+    
+    # #entries of each user/video, to weight rows of D, S and regularization in a batch
+    nEntries = R_train.nnz
+    arrUserCount = np.bincount(R_train.row, minlength=R.shape[0]).astype(np.float64)
+    arrVideoCount = np.bincount(R_train.col, minlength=R.shape[1]).astype(np.float64)
+    
+    #===========================================================================
+    # iterate over epochs
+    #===========================================================================
+    nIter = 0
+    dLastLoss = None
+    dcLogger = cmf_trace.createLogger()
+    for nEpoch in xrange(nMaxEpoch):
+        arrPermutation = np.random.permutation(nEntries)
+        for nStart in xrange(0, nEntries, nBatchSize):
+            gamma = getLearningRate(dLearningRate, nIter, strSchedule)
+            nIter += 1
+            
+            arrBatch = arrPermutation[nStart:nStart+nBatchSize]
+            updateMiniBatch(R_train.row[arrBatch], R_train.col[arrBatch], R_train.data[arrBatch], \
+                            D, S, weightD_train, weightS_train, U, V, P, Q, Bu, Bv, mu, \
+                            arrUserCount, arrVideoCount, nEntries, arrAlphas, arrLambdas, gamma)
+        #END batch
+        
+        #=======================================================================
+        # evaluate at the end of epoch
+        #=======================================================================
+        dummy, dummy, dummy, \
+        dRmseR_train, dRmseR_test, dRmseD, dRmseS, \
+        dLoss = computeResidualError_sparse(R_train, R_test, D, S, U, V, P, Q, Bu, Bv, mu, \
+                                            weightD_train, weightS_train, arrAlphas, arrLambdas)
+        
+        # save RMSE
+        dcRMSE = {}
+        dcRMSE['rmseR'] = dRmseR_train
+        dcRMSE['rmseR_test'] = dRmseR_test
+        dcRMSE['rmseD'] = dRmseD
+        dcRMSE['rmseS'] = dRmseS
+        dcRMSE['loss'] = dLoss
+        cmf_trace.recordTrace(lsTrainingTrace, nEpoch, dcRMSE)
+        
+        # output
+        if (bDebugInfo):
+            cmf_trace.logProgress(dcLogger, "epoch %d (%d iterations, gamma=%f)" % (nEpoch, nIter, gamma), dcRMSE)
+        
+        #=======================================================================
+        # check convergence, loss of SGD may fluctuate, so only stop on small change
+        #=======================================================================
+        if (dLastLoss is not None and abs(dLastLoss-dLoss) <= g_dConvergenceThresold):
+            print("converged @ epoch %d: change:%f, loss=%f, rmseR_test=%f" % \
+                  (nEpoch, dLastLoss-dLoss, dLoss, dRmseR_test) )
+            break
+        dLastLoss = dLoss
+    #END epoch
     
     return U, V, P, Q, Bu, Bv, mu, Jm, Jn
 
-def pred(R, D, S, U, V, P, Q, mu, weightR_test):
+def pred(R, D, S, U, V, P, Q, mu, weightR_test, Bu=None, Bv=None):
+    '''
+        This function returns the test RMSE of R, only the test entries are
+        predicted (see cmf_predict.predictPairs for scoring arbitrary pairs).
+        
+        Note: the biases are not added if Bu, Bv are not given.
+    '''
     #===========================================================================
     # test
     #===========================================================================
     print("start to test...")
-    predR_test =  np.dot(U, V.T) + mu
-    _errorR_test = np.subtract(R, predR_test)
-    errorR_test = np.multiply(weightR_test, _errorR_test)
-    rmseR_test = np.sqrt( np.power(errorR_test, 2.0).sum() / (weightR_test==1.0).sum() )
+    R_test = getObservedEntries(R, weightR_test, U.dtype)
+    Bu = Bu if Bu is not None else np.zeros((U.shape[0], 1), dtype=U.dtype)
+    Bv = Bv if Bv is not None else np.zeros((V.shape[0], 1), dtype=V.dtype)
+    arrErrorR_test = R_test.data - computeObservedPrediction(U, V, Bu, Bv, mu, R_test.row, R_test.col)
+    rmseR_test = np.sqrt( np.dot(arrErrorR_test, arrErrorR_test) / R_test.nnz )
     return rmseR_test
 
+def runFold(R, D, S, weightR_train, weightR_test, weightD, weightS, \
+            arrAlphas, arrLambdas, f, nMaxStep, bDebugInfo, bSparse=False, \
+            strLineSearch='backtracking', strEngine='gd', dcEngineParams=None, \
+            dtype=np.float64, dcInitModel=None, bKeepModel=False, nTraceInterval=1, nSeed=None):
+    '''
+        This function trains and tests one fold of crossValidate(), params are
+        the same as crossValidate(), except:
+            nSeed       - if not None, np.random is seeded by it before training,
+                          so that the fold gets the same initial model in any
+                          process (see crossValidate)
+        
+        return:
+            rmseR_train, rmseR_test, maeR_test,
+            training trace (a structured array, see cmf_trace.getTrace),
+            fitted model (see cmf_model.packModel) if bKeepModel else None
+    '''
+    #===========================================================================
+    # train
+    #===========================================================================
+    if (nSeed is not None):
+        np.random.seed(nSeed)
+    lsTrainingTrace = cmf_trace.createTrace(nMaxStep, nTraceInterval, \
+                                            ['updates_per_sec'] if strEngine == 'hogwild' else None)
+    if (strEngine == 'hogwild'):
+        import cmf_parallel
+        U, V, P, Q, \
+        Bu, Bv, mu, Jm, Jn = cmf_parallel.fitHogwild(R, D, S, weightR_train, weightR_test, weightD, weightS, \
+                                                     f, arrAlphas, arrLambdas, nMaxStep, \
+                                                     lsTrainingTrace, bDebugInfo, dtype=dtype, dcInitModel=dcInitModel, \
+                                                     **(dcEngineParams or {}) )
+    elif (strEngine == 'parallel'):
+        import cmf_parallel
+        U, V, P, Q, \
+        Bu, Bv, mu, Jm, Jn = cmf_parallel.fit(R, D, S, weightR_train, weightR_test, weightD, weightS, \
+                                              f, arrAlphas, arrLambdas, nMaxStep, \
+                                              lsTrainingTrace, bDebugInfo, dtype=dtype, dcInitModel=dcInitModel, \
+                                              **(dcEngineParams or {}) )
+    elif (strEngine == 'als'):
+        import cmf_als
+        U, V, P, Q, \
+        Bu, Bv, mu, Jm, Jn = cmf_als.fit(R, D, S, weightR_train, weightR_test, weightD, weightS, \
+                                         f, arrAlphas, arrLambdas, nMaxStep, \
+                                         lsTrainingTrace, bDebugInfo, dtype=dtype, dcInitModel=dcInitModel, \
+                                         **(dcEngineParams or {}) )
+    elif (strEngine == 'minibatch'):
+        U, V, P, Q, \
+        Bu, Bv, mu, Jm, Jn = fitMiniBatch(R, D, S, weightR_train, weightR_test, weightD, weightS, \
+                                          f, arrAlphas, arrLambdas, nMaxStep, \
+                                          lsTrainingTrace, bDebugInfo, dtype=dtype, dcInitModel=dcInitModel, \
+                                          **(dcEngineParams or {}) )
+    else:
+        U, V, P, Q, \
+        Bu, Bv, mu, Jm, Jn = fit(R, D, S, weightR_train, weightR_test, weightD, weightS, \
+                             f, arrAlphas, arrLambdas, nMaxStep, \
+                             lsTrainingTrace, bDebugInfo, bSparse, strLineSearch, dtype, \
+                             dcInitModel=dcInitModel, **(dcEngineParams or {}) )
+
+    #===========================================================================
+    # test
+    #===========================================================================
+    # only gather the train/test entries, errors are evaluated in float64 on the
+    # returned model, the trace (float32 rmses) is only kept for storage
+    R_train = getObservedEntries(R, weightR_train, np.float64)
+    arrErrorR_train = R_train.data - computeObservedPrediction(U, V, Bu, Bv, mu, R_train.row, R_train.col)
+    rmseR_train = np.sqrt( np.power(arrErrorR_train, 2.0).mean() )
+    
+    R_test = getObservedEntries(R, weightR_test, np.float64)
+    arrErrorR_test = R_test.data - computeObservedPrediction(U, V, Bu, Bv, mu, R_test.row, R_test.col)
+    rmseR_test = np.sqrt( np.power(arrErrorR_test, 2.0).mean() )
+    maeR_test = np.abs(arrErrorR_test).mean()
+    arrTrainingTrace = cmf_trace.getTrace(lsTrainingTrace)
+    
+    dcModel = None
+    if (bKeepModel):
+        import cmf_model
+        dcModel = cmf_model.packModel(U, V, P, Q, Bu, Bv, mu)
+    
+    return rmseR_train, rmseR_test, maeR_test, arrTrainingTrace, dcModel
+
 def crossValidate(R, D, S, weightR, weightD, weightS, \
                   arrAlphas, arrLambdas, f, nMaxStep, nFold, \
-                  bDebugInfo, bPlotTrace):
+                  bDebugInfo, bPlotTrace, bSparse=False, strLineSearch='backtracking', \
+                  strEngine='gd', dcEngineParams=None, dtype=np.float64, dcInitModel=None, \
+                  nFoldWorkers=None, nMaxFolds=None, nFoldSeed=None, bKeepModel=False, \
+                  nTraceInterval=1, lsUserOrder=None, lsVideoOrder=None):
     '''
         This function cross-validates collective matrix factorization model. 
         In particular, it perform:
@@ -387,10 +1489,48 @@ def crossValidate(R, D, S, weightR, weightD, weightS, \
             f           - number of latent factors
             nMaxStep    - max iteration steps
             nFold       - number of folds to validate
+            bSparse     - if True, R is held as a sparse matrix and the model
+                          is only trained/tested on the observed entries
+            strLineSearch - step size search of fit(), 'backtracking' or 'polynomial'
+            strEngine   - 'gd' for fit(), 'minibatch' for fitMiniBatch() (nMaxStep
+                          is used as #epochs), 'als' for cmf_als.fit() (nMaxStep
+                          is used as #sweeps), 'parallel' for cmf_parallel.fit()
+                          (parallel ALS, e.g., dcEngineParams={'nWorkers':32}),
+                          'hogwild' for cmf_parallel.fitHogwild() (nMaxStep is
+                          used as #epochs)
+            dcEngineParams - extra keyword params passed to the engine, e.g., 
+                          {'nBatchSize':512} for 'minibatch', {'nPatience':20} 
+                          for 'gd' (early stopping), {'strOptimizer':'adam'} for
+                          'gd' (adaptive optimizer, see cmf_optimizer), 
+                          {'bWorkspace':True} for 'gd' (preallocated buffers),
+                          {'bFused':True} for 'gd' (fused loss and gradient kernel),
+                          {'nEvalInterval':10, 'nLossSamples':10000} for 'gd' 
+                          (sampled loss between full evaluations)
+            dtype       - dtype of low rank matrices (see init for the dtype policy)
+            dcInitModel - warm start every fold from this model (see cmf_model), 
+                          rows must match R, D, S
+            nFoldWorkers - if > 1, folds are run in parallel by a pool of this many
+                          processes (see cmf_parallel.runFolds), R, D, S are shared 
+                          with them instead of pickled; the engine must be a single
+                          process one, i.e., not 'parallel' nor 'hogwild'
+            nMaxFolds   - if set, only the first nMaxFolds of the nFold folds are
+                          trained and tested, i.e., a cheaper (and noisier) estimate,
+                          used by the early rungs of cmf_search.searchSuccessiveHalving
+            nFoldSeed   - seed of shuffling the folds, so that the same folds are
+                          cut in every run (e.g., for cached results, see testCMF),
+                          the k-th fold is trained with seed nFoldSeed+k (see runFold)
+            bKeepModel  - if True, the fitted model of each fold is kept in dcResult
+                          as 'model' (see cmf_model.packModel)
+            nTraceInterval - record the training trace every nTraceInterval steps
+                          (see cmf_trace.createTrace), the last step is always recorded
+            lsUserOrder, lsVideoOrder - ids of rows/columns of R, kept in the models
+                          of bKeepModel (see cmf_model.packModel)
             
         return:
-            dcResult - train/test result for R of each fold
-            lsBestTrainingTrace - RMSE of each step in best fold
+            dcResult - train/test result for R of each fold, the training trace
+                          of each fold is kept as 'trace'
+            lsBestTrainingTrace - RMSE of each (recorded) step in best fold, a
+                          structured array (see cmf_trace)
         
         Note:
             1. this function might change the content of input matrices (depends on init() function);
@@ -404,60 +1544,91 @@ def crossValidate(R, D, S, weightR, weightD, weightS, \
     print('start cross validation...')
     
     # cut
-    arrNonzeroRows, arrNonzeroCols = np.nonzero(R) # Note, we have already filled missing value in R by 0
-    kf = cross_validation.KFold(len(arrNonzeroRows), nFold, shuffle=True)
-
-    dcResults = {}
-    nCount = 0
-    dBestRmseR_test = 9999999999.0
-    lsBestTrainingTrace = None
+    arrNonzeroRows, arrNonzeroCols = R.nonzero() # Note, we have already filled missing value in R by 0
     
-    for arrTrainIndex, arrTestIndex in kf:
-        print("%d-th of %d folds..." % (nCount, nFold) )
+    if (bSparse):
+        R = sparse.csr_matrix(R)
+        
+    # observed entries in linear index, used to mask out test entries of each fold
+    arrObservedRows, arrObservedCols = weightR.nonzero()
+    arrObservedIndex = arrObservedRows * R.shape[1] + arrObservedCols
         
+    kf = cross_validation.KFold(len(arrNonzeroRows), nFold, shuffle=True, random_state=nFoldSeed)
+
+    lsFolds = []
+    for arrTrainIndex, arrTestIndex in kf:
         #=======================================================================
         # prepare train/test data    
         #=======================================================================
-        weightR_train = np.copy(weightR)
-        
+        # index-based masks, no m-by-n copy of weightR for each fold
         # don't use these selected elements to train
-        weightR_train[arrNonzeroRows[arrTestIndex], arrNonzeroCols[arrTestIndex]] = 0.0
+        arrTestRows = arrNonzeroRows[arrTestIndex]
+        arrTestCols = arrNonzeroCols[arrTestIndex]
+        arrTrainMask = np.in1d(arrObservedIndex, arrTestRows * R.shape[1] + arrTestCols, invert=True)
+        weightR_train = sparse.coo_matrix((np.ones(arrTrainMask.sum(), dtype=bool), \
+                                           (arrObservedRows[arrTrainMask], arrObservedCols[arrTrainMask])), \
+                                          shape=R.shape)
         
         # set weight R for testing
-        weightR_test = np.zeros(weightR_train.shape)
-        weightR_test[arrNonzeroRows[arrTestIndex], arrNonzeroCols[arrTestIndex]] = 1.0
+        weightR_test = sparse.coo_matrix((np.ones(len(arrTestIndex), dtype=bool), (arrTestRows, arrTestCols)), \
+                                         shape=R.shape)
         
         # TODO: will it be a problem if I do not mask corresponding tuples in D and S?
+        lsFolds.append((weightR_train, weightR_test))
+    
+    if (nMaxFolds is not None):
+        lsFolds = lsFolds[:nMaxFolds]
+    
+    # a seed per fold, so that serial and parallel folds draw the same initial model
+    nBaseSeed = nFoldSeed if nFoldSeed is not None else np.random.randint(1 << 30)
+    lsSeeds = [nBaseSeed + i for i in xrange(len(lsFolds))]
+    
+    #===========================================================================
+    # train and test each fold
+    #===========================================================================
+    dcFoldParams = {'arrAlphas':arrAlphas, 'arrLambdas':arrLambdas, 'f':f, 'nMaxStep':nMaxStep, \
+                    'bDebugInfo':bDebugInfo, 'bSparse':bSparse, 'strLineSearch':strLineSearch, \
+                    'strEngine':strEngine, 'dcEngineParams':dcEngineParams, 'dtype':dtype, \
+                    'dcInitModel':dcInitModel, 'bKeepModel':bKeepModel, 'nTraceInterval':nTraceInterval}
+    if (nFoldWorkers is not None and nFoldWorkers > 1):
+        if (strEngine in ['parallel', 'hogwild']):
+            raise ValueError("engine %s can't run in parallel folds" % strEngine)
+        import cmf_parallel
+        lsFoldResults = cmf_parallel.runFolds(R, D, S, weightD, weightS, lsFolds, nFoldWorkers, dcFoldParams, \
+                                              lsSeeds)
+    else:
+        lsFoldResults = [runFold(R, D, S, weightR_train, weightR_test, weightD, weightS, nSeed=nSeed, \
+                                 **dcFoldParams) \
+                         for (weightR_train, weightR_test), nSeed in zip(lsFolds, lsSeeds)]
+    
+    #===========================================================================
+    # merge
+    #===========================================================================
+    dcResults = {}
+    nCount = 0
+    dBestRmseR_test = 9999999999.0
+    dBestRmseR_train = None
+    lsBestTrainingTrace = None
+    
+    for rmseR_train, rmseR_test, maeR_test, lsTrainingTrace, dcModel in lsFoldResults:
+        print("%d-th of %d folds..." % (nCount, len(lsFolds)) )
         
-        #=======================================================================
-        # train
-        #=======================================================================
-        lsTrainingTrace = []
-        U, V, P, Q, \
-        Bu, Bv, mu, Jm, Jn = fit(R, D, S, weightR_train, weightR_test, weightD, weightS, \
-                             f, arrAlphas, arrLambdas, nMaxStep, \
-                             lsTrainingTrace, bDebugInfo)
-        
-        #===========================================================================
-        # test
-        #===========================================================================
-        predR_test =  np.dot(U, V.T) + np.dot(Bu, Jn.T)  + np.dot(Jm, Bv.T) + mu
-        _errorR_test = np.subtract(R, predR_test)
-        errorR_test = np.multiply(weightR_test, _errorR_test)
-        rmseR_test = np.sqrt( np.power(errorR_test, 2.0).sum() / weightR_test.sum() )
-        maeR_test = (np.abs(errorR_test)).sum() / weightR_test.sum()
-        
-       
         # save fold result
-        dcResults[nCount] = {'train':lsTrainingTrace[-1]['rmseR'], 'test':rmseR_test, 'mae':maeR_test}
+        dcResults[nCount] = {'train':rmseR_train, 'test':rmseR_test, 'mae':maeR_test, \
+                             'trace':lsTrainingTrace}
+        if (bKeepModel):
+            import cmf_model
+            dcResults[nCount]['model'] = cmf_model.packModel(*([dcModel[strName] for strName in cmf_model.g_lsFactors] \
+                                                               + [dcModel['mu'], lsUserOrder, lsVideoOrder]) )
         
-        if (rmseR_test < dBestRmseR_test):
+        if (lsBestTrainingTrace is None or rmseR_test < dBestRmseR_test): # a diverged fold has nan rmse
             dBestRmseR_test = rmseR_test
+            dBestRmseR_train = rmseR_train
             lsBestTrainingTrace = lsTrainingTrace
         
         # print out 
         print("rmse_traning=%f, rmse_test=%f, mae_test=%f" % 
-              (lsTrainingTrace[-1]['rmseR'], rmseR_test, maeR_test))
+              (rmseR_train, rmseR_test, maeR_test))
         
         if(bPlotTrace is True):
             visualizeRMSETrend(lsTrainingTrace)
@@ -470,18 +1641,21 @@ def crossValidate(R, D, S, weightR, weightD, weightS, \
 
         nCount += 1
     
-    print("cross validation is finished: best train=%f, test=%f" % (lsBestTrainingTrace[-1]['rmseR'], dBestRmseR_test) )
+    print("cross validation is finished: best train=%f, test=%f" % (dBestRmseR_train, dBestRmseR_test) )
 
     return dcResults, lsBestTrainingTrace
 
 def visualizeRMSETrend(lsRMSE):
     '''
-        This function visualize the changing of RMSE
+        This function visualize the changing of RMSE, lsRMSE is a list of dicts
+        or a trace array (see cmf_trace.getTrace)
     '''
     import matplotlib.pyplot as plt
     
     fig, axes = plt.subplots(1, 2)
     df = pd.DataFrame(lsRMSE)
+    if ('step' in df.columns):
+        df.set_index('step', inplace=True)
     df = df[['rmseD', 'rmseS', 'rmseR', 'rmseR_test', 'loss']]
     df.columns = ['D', 'S', 'R', 'R_test', 'loss']
     ax0 = df[['D', 'S', 'R', 'R_test'] ].plot(ax=axes[0], style=['--','-.', '-', '-+' ], ylim=(0,1))
@@ -549,24 +1723,31 @@ def reduceVideoDimension(mtR, mtS, nTargetDimension):
     return mtR_merged, mtS_merged
 
 
-def filterInvalidRecords(mtR, mtD, mtS):
+def filterInvalidRecords(mtR, mtD, mtS, bReturnIndex=False):
     '''
         This function filter out invalid tuples in a cascade way
         
-        Note: Nan for missing value
+        return:
+            R, D, S, and the indices of kept users (rows of mtR) and videos
+            (columns of mtR) if bReturnIndex
+        
+        Note: Nan for missing value, or g_nMissingRatio if R is uint8 (ratio*100)
     '''
     R = mtR.copy()
     D = mtD.copy()
     S = mtS.copy()
     
-    # criteria of invalid tuples
-    mtInvalidMask = (R<0.1)
-    
-    # mark those tuples as invalid ones
-    R[mtInvalidMask] = np.nan
+    # criteria of invalid tuples, mark those tuples as invalid ones
+    if (R.dtype == np.uint8):
+        mtInvalidMask = (R < 0.1/g_dRatioScale)
+        R[mtInvalidMask] = g_nMissingRatio
+        mtValidMask = (R != g_nMissingRatio)
+    else:
+        mtInvalidMask = (R<0.1)
+        R[mtInvalidMask] = np.nan
+        mtValidMask = ~np.isnan(R)
     
     # reduce trivial rows & columns
-    mtValidMask = ~np.isnan(R)
     
     # find out users whose does not have any valid video record 
     arrValidCount_user = np.sum(mtValidMask, axis=1)
@@ -585,6 +1766,8 @@ def filterInvalidRecords(mtR, mtD, mtS):
     R = np.delete(R, lsTrivialVideos, axis=1)
     S = np.delete(S, lsTrivialVideos, axis=0)
     
+    if (bReturnIndex):
+        return R, D, S, np.where(arrValidCount_user > 0)[0], np.where(arrValidCount_video > 0)[0]
     return R, D, S
             
 
@@ -620,10 +1803,13 @@ def InvestigateError(matErrorR_test, R, predR_test, mu, Bu, Bv, U, V, weightR_te
     return dfErrorReason
 
 def testCMF(**kwargs):
-    # load data
-    mtR = np.load('d:\\playground\\personal_qoe\\data\\sh\\mtR_0discre_rand1000.npy')
-    mtD = np.load('d:\\playground\\personal_qoe\\data\\sh\\mtD_0discre_rand1000.npy')
-    mtS = np.load('d:\\playground\\personal_qoe\\data\\sh\\mtS_0discre_rand1000.npy')
+    # load data, R/D/S can also be given directly (e.g., uint8 R of data2matrix.transform2mt)
+    if ('R' in kwargs):
+        mtR, mtD, mtS = kwargs['R'], kwargs['D'], kwargs['S']
+    else:
+        mtR = np.load('d:\\playground\\personal_qoe\\data\\sh\\mtR_0discre_rand1000.npy')
+        mtD = np.load('d:\\playground\\personal_qoe\\data\\sh\\mtD_0discre_rand1000.npy')
+        mtS = np.load('d:\\playground\\personal_qoe\\data\\sh\\mtS_0discre_rand1000.npy')
     
     # setup parameter
     arrAlphas = kwargs['alphas'] # will be scaled in the core of CMF
@@ -634,28 +1820,92 @@ def testCMF(**kwargs):
     bDebugTrace = kwargs['debug_trace']
     dReductionRatio = kwargs['video_reduction_ratio']
     bVisualize = kwargs['visualize']
-     
-    # filter out invalid tuple
-    R_filtered, D_filtered, S_filtered = filterInvalidRecords(mtR, mtD, mtS)
-    
-    # init (prepare weight matrix, scale features and aggregate videos)
-    R_reduced, D_reduced, S_reduced, \
-    weightR_reduced, weightD_reduced, weightS_reduced = init(R_filtered, D_filtered, S_filtered, inplace=False,
-                                                             dReductionRatio=dReductionRatio)
-    if (bDebugTrace is True):
-        print "R_reduced.shape=", R_reduced.shape
-        print "D_reduced.shape=", D_reduced.shape
-        print "S_reduced.shape=", S_reduced.shape
-        print "weightR_reduced.sum=", weightR_reduced.sum()
-        print "weightD_reduced.sum=", weightD_reduced.sum()
-        print "weightS_reduced.sum=", weightS_reduced.sum()
+    bSparse = kwargs.get('sparse', False)
+    strLineSearch = kwargs.get('line_search', 'backtracking')
+    strEngine = kwargs.get('engine', 'gd')
+    dcEngineParams = kwargs.get('engine_params', None)
+    dtype = kwargs.get('dtype', np.float64)
+    dcInitModel = kwargs.get('init_model', None)
+    nFoldWorkers = kwargs.get('fold_workers', None)
+    nMaxFolds = kwargs.get('max_folds', None)
+    nFoldSeed = kwargs.get('fold_seed', None)
+    strCacheDir = kwargs.get('cache_dir', None)
+    nCacheSize = kwargs.get('cache_size', None)
+    bCacheModels = kwargs.get('cache_models', False)
+    nTraceInterval = kwargs.get('trace_interval', 1)
+    strModelPath = kwargs.get('model_path', None)
+    bReturnTraces = kwargs.get('return_traces', False) # also return the training trace of each fold
+    bKeepModel = bCacheModels or (strModelPath is not None)
+    lsUserOrder = kwargs.get('user_order', None) # ids of rows of R, e.g., lsUserOrder_R of data2matrix
+    lsVideoOrder = kwargs.get('video_order', None) # ids of columns of R, e.g., lsVideoOrder_R
+    if (strModelPath is not None and lsUserOrder is None):
+        raise ValueError("user_order is required to save a model, otherwise it can't be mapped to user ids")
     
-    # cross validation
-    dcResult, lsBestTrainingRMSEs = crossValidate(R_reduced, D_reduced, S_reduced, \
-                                                  weightR_reduced, weightD_reduced, weightS_reduced, \
-                                                  arrAlphas, arrLambdas, \
-                                                  f, nMaxStep, nFold, \
-                                                  bDebugTrace, bVisualize)
+    #===========================================================================
+    # look up result cache
+    #===========================================================================
+    dcResult = None
+    dcPreprocess = {}
+    if (strCacheDir is not None and nFoldSeed is None):
+        # random folds differ in every run, their result must not be replayed
+        print("result cache is skipped as fold_seed is None")
+        strCacheDir = None
+    if (strCacheDir is not None):
+        from tools import result_cache
+        # everything which affects the result, debug/visualize/fold_workers don't; the random draws
+        # of folds (init, loss samples) follow fold_seed, nSampleSeed is a part of engine_params
+        dcKeyParams = {'alphas':np.asarray(arrAlphas, dtype=np.float64), \
+                       'lambdas':np.asarray(arrLambdas, dtype=np.float64), \
+                       'f':f, 'max_step':nMaxStep, 'folds':nFold, 'max_folds':nMaxFolds, \
+                       'video_reduction_ratio':dReductionRatio, 'sparse':bSparse, \
+                       'line_search':strLineSearch, 'engine':strEngine, 'engine_params':dcEngineParams, \
+                       'dtype':np.dtype(dtype).str, 'init_model':dcInitModel, 'fold_seed':nFoldSeed, \
+                       'cache_models':bKeepModel, 'trace_interval':nTraceInterval, \
+                       'user_order':lsUserOrder, 'video_order':lsVideoOrder}
+        strCacheKey = result_cache.getCacheKey(mtR, mtD, mtS, dcKeyParams)
+        tpCached = result_cache.loadResult(strCacheDir, strCacheKey)
+        if (tpCached is not None):
+            print("cache hit: %s" % strCacheKey)
+            dcResult, lsBestTrainingRMSEs = tpCached[:2]
+            dcPreprocess = tpCached[2] if len(tpCached) > 2 else None
+     
+    if (dcResult is None):
+        # filter out invalid tuple
+        R_filtered, D_filtered, S_filtered, arrKeptUsers, arrKeptVideos = filterInvalidRecords(mtR, mtD, mtS, True)
+    
+        # init (prepare weight matrix, scale features and aggregate videos)
+        R_reduced, D_reduced, S_reduced, \
+        weightR_reduced, weightD_reduced, weightS_reduced = init(R_filtered, D_filtered, S_filtered, inplace=False,
+                                                                 dReductionRatio=dReductionRatio, dtype=dtype,
+                                                                 dcPreprocess=dcPreprocess)
+        if (bDebugTrace is True):
+            print "R_reduced.shape=", R_reduced.shape
+            print "D_reduced.shape=", D_reduced.shape
+            print "S_reduced.shape=", S_reduced.shape
+            print "weightR_reduced.sum=", weightR_reduced.sum()
+            print "weightD_reduced.sum=", weightD_reduced.sum()
+            print "weightS_reduced.sum=", weightS_reduced.sum()
+    
+        # ids of the kept rows/columns, videos are clusters (see reduceVideoDimension) if reduced
+        lsKeptUsers = [lsUserOrder[i] for i in arrKeptUsers] if lsUserOrder is not None else None
+        if (dReductionRatio < 1.0):
+            lsKeptVideos = range(R_reduced.shape[1])
+        else:
+            lsKeptVideos = [lsVideoOrder[j] for j in arrKeptVideos] if lsVideoOrder is not None else None
+    
+        # cross validation
+        dcResult, lsBestTrainingRMSEs = crossValidate(R_reduced, D_reduced, S_reduced, \
+                                                      weightR_reduced, weightD_reduced, weightS_reduced, \
+                                                      arrAlphas, arrLambdas, \
+                                                      f, nMaxStep, nFold, \
+                                                      bDebugTrace, bVisualize, bSparse, strLineSearch, \
+                                                      strEngine, dcEngineParams, dtype, dcInitModel, nFoldWorkers, \
+                                                      nMaxFolds, nFoldSeed, bKeepModel, nTraceInterval, \
+                                                      lsKeptUsers, lsKeptVideos)
+        
+        if (strCacheDir is not None):
+            result_cache.saveResult(strCacheDir, strCacheKey, (dcResult, lsBestTrainingRMSEs, dcPreprocess), \
+                                    nCacheSize if nCacheSize is not None else result_cache.g_nMaxCacheBytes)
 
     # output result
     for k, v in dcResult.items():
@@ -671,24 +1921,38 @@ def testCMF(**kwargs):
     dStd_mae = np.std(lsTestMAE)
     print('-->MAE: mean=%f, std=%f' % (dMean_mae, dStd_mae))
     
+    # save the model of the best fold
+    if (strModelPath is not None):
+        import cmf_model
+        nBestFold = min(dcResult.keys(), key=lambda k: dcResult[k]['test'])
+        strVersion = cmf_model.saveModel(dcResult[nBestFold]['model'], strModelPath, dcPreprocess, \
+                                         {'alphas':arrAlphas, 'lambdas':arrLambdas, 'f':f})
+        print("model of fold %d saved: %s (version=%s)" % (nBestFold, strModelPath, strVersion) )
+    
     # visualize
     if (bVisualize is True):
         visualizeRMSETrend(lsBestTrainingRMSEs)
     
     print('finished*********')
     
+    if (bReturnTraces is True):
+        # None for the results cached without traces
+        return dMean_rmse, dStd_rmse, dMean_mae, dStd_mae, \
+               [dcResult[k].get('trace') for k in sorted(dcResult.keys())]
     return dMean_rmse, dStd_rmse, dMean_mae, dStd_mae
 
-def investigateImpactOfParameters(strParamName, bPlot, strPath=None):
+def investigateImpactOfParameters(strParamName, bPlot, strPath=None, nWorkers=None):
     '''
         This function investigate the impact of parameter on model performance by
-        trying different combinations of parameters
+        trying different combinations of parameters (a grid search of cmf_search)
         
         Parameters:
             strParamName - parameter to examine
             bPlot        - visualize the result if it is true
             strPath      - save the result in csv format if it is true
+            nWorkers     - #trials run at the same time (see cmf_search.searchParameters)
     '''
+    import cmf_search
     
     # set default param
     dcTestParam = {}
@@ -706,54 +1970,31 @@ def investigateImpactOfParameters(strParamName, bPlot, strPath=None):
     # try different params
     #===========================================================================
     print("investigating impact of %s..." % (strParamName) )
-    lsResults = []
-    if (strParamName == 'c'):
-        for i in range(1,10,1):
-            dcTestParam['video_reduction_ratio'] = i * 0.1
-            dMean_rmse, dStd_rmse, dMean_mae, dStd_mae = testCMF(**dcTestParam)
-            lsResults.append({strParamName:i*0.1, 'rmse_mean':dMean_rmse, 'rmse_std':dStd_rmse, 'mae_mean':dMean_mae, 'mae_std':dStd_mae} )
-        
-    elif (strParamName == 'f'):
-        for i in range(5, 30, 5):
-            dcTestParam['f'] = i
-            dMean_rmse, dStd_rmse, dMean_mae, dStd_mae = testCMF(**dcTestParam)
-            lsResults.append({strParamName:i, 'rmse_mean':dMean_rmse, 'rmse_std':dStd_rmse, 'mae_mean':dMean_mae, 'mae_std':dStd_mae} )
-        
-    elif(strParamName == 'alpha_2'):
-        dVar = 0.001
-        for i in range(0, 5, 1):
-            dcTestParam['alphas'] = np.array([1.0, dVar, 0.12])
-            dMean_rmse, dStd_rmse, dMean_mae, dStd_mae = testCMF(**dcTestParam)
-            lsResults.append({strParamName:dVar, 'rmse_mean':dMean_rmse, 'rmse_std':dStd_rmse, 'mae_mean':dMean_mae, 'mae_std':dStd_mae} )
-            dVar = dVar * 10
-    
-    elif(strParamName == 'alpha_3'):
-        dVar = 0.0001
-        for i in range(0, 5, 1):
-            dcTestParam['alphas'] = np.array([1.0, 0.1, dVar])
-            dMean_rmse, dStd_rmse, dMean_mae, dStd_mae = testCMF(**dcTestParam)
-            lsResults.append({strParamName:dVar, 'rmse_mean':dMean_rmse, 'rmse_std':dStd_rmse, 'mae_mean':dMean_mae, 'mae_std':dStd_mae} )
-            dVar = dVar * 10.0
-    
-    elif(strParamName == 'lambda'):
-            dVar = 0.1
-            for i in range(0, 5, 1):
-                dcTestParam['lambdas'] = np.array([dVar] *5)
-                dMean_rmse, dStd_rmse, dMean_mae, dStd_mae = testCMF(**dcTestParam)
-                lsResults.append({strParamName:dVar, 'rmse_mean':dMean_rmse, 'rmse_std':dStd_rmse, 'mae_mean':dMean_mae, 'mae_std':dStd_mae} )
-                dVar = dVar * 3
-
-    else:
+    dcValues = {}
+    dcValues['c'] = [i * 0.1 for i in range(1, 10, 1)]
+    dcValues['f'] = range(5, 30, 5)
+    dcValues['alpha_2'] = [0.001 * 10**i for i in range(0, 5, 1)]
+    dcValues['alpha_3'] = [0.0001 * 10**i for i in range(0, 5, 1)]
+    dcValues['lambda'] = [0.1 * 3**i for i in range(0, 5, 1)]
+    
+    if (strParamName not in dcValues):
         print("Error: unknown parameter name %s." % strParamName)
         return
     
+    if (strParamName == 'alpha_3'):
+        dcTestParam['alphas'] = np.array([1.0, 0.1, 0.12])
+    
+    df = cmf_search.searchParameters({strParamName:dcValues[strParamName]}, dcTestParam, 'grid', \
+                                     nWorkers=nWorkers)
+    lsResults = df[[strParamName] + cmf_search.g_lsMetrics].to_dict('records')
+    
     #===========================================================================
     # save result
     #===========================================================================
     if(strPath is not None):
             # construct data frame
             df = pd.DataFrame(lsResults)
-            df.sort(strParamName, ascending=True, inplace=True)
+            df.sort_values(strParamName, ascending=True, inplace=True)
             df.set_index(strParamName, inplace=True)
             df.to_csv( "%s%s.csv" % (strPath, strParamName) )
             
@@ -772,7 +2013,7 @@ def investigateImpactOfParameters(strParamName, bPlot, strPath=None):
 def drawImapctOfParameter(lsResult, strParamName):
     # construct data frame
     df = pd.DataFrame(lsResult)
-    df.sort(strParamName, ascending=True, inplace=True)
+    df.sort_values(strParamName, inplace=True)
     df.set_index(strParamName, inplace=True)
     
     # plot
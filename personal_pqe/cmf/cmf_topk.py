@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+'''
+Brief Description:
+    This model answers top-k queries of a trained CMF model, i.e., for a user i,
+    the k videos (rows of V, i.e., rows of S, e.g., the video quality profiles
+    after reduceVideoDimension) of the highest predicted ratios
+
+        U[i]·V[j]^T + bu[i] + bv[j] + mu
+
+    As bu[i] + mu is the same for all videos of a user, the ranking only depends
+    on the inner product [U[i], 1]·[V[j], bv[j]]^T, so an index keeps the
+    augmented items [V, Bv], and
+        - the exact query scans the items block by block, and keeps a running
+          top-k of each user (a vectorized bounded heap), so that no #users-by-n
+          score matrix is allocated;
+        - the approximate query (if the index is built with nClusters) only
+          scans the members of the nProbe clusters whose centroids have the
+          highest inner products with the user. Items are clustered after the
+          standard transform of max inner product search into nearest neighbor
+          search, i.e., [v, sqrt(M^2-||v||^2)] with M the max norm of items.
+
+@author: jason
+'''
+
+import numpy as np
+from sklearn.cluster import KMeans
+
+g_nBlockSize = 4096 # #items scored at once by the exact scan
+g_nUserBatch = 256 # #users scanned together by the exact scan
+g_nProbe = 4 # #clusters scanned by the approximate query
+
+def createIndex(dcModel, nClusters=None, nSeed=None):
+    '''
+        This function builds a top-k index of a model.
+
+        params:
+            dcModel   - trained model (see cmf_model.packModel)
+            nClusters - if given, items are also clustered for approximate queries
+            nSeed     - seed of clustering
+
+        return:
+            dcIndex - {'U', 'Bu', 'mu', 'items', 'centroids', 'members'}, where
+                      members[c] are the items of cluster c
+    '''
+    dcIndex = {}
+    dcIndex['U'] = dcModel['U']
+    dcIndex['Bu'] = dcModel['Bu']
+    dcIndex['mu'] = dcModel['mu']
+    dcIndex['items'] = np.hstack([dcModel['V'], dcModel['Bv']])
+    dcIndex['centroids'] = None
+    dcIndex['members'] = None
+
+    if (nClusters is not None):
+        mtItems = dcIndex['items']
+        arrNorms = np.einsum('ij,ij->i', mtItems, mtItems)
+        mtTransformed = np.hstack([mtItems, np.sqrt(np.maximum(arrNorms.max() - arrNorms, 0.0)).reshape(-1, 1)])
+        kmeans = KMeans(n_clusters=min(nClusters, len(mtItems)), random_state=nSeed).fit(mtTransformed)
+        dcIndex['centroids'] = kmeans.cluster_centers_[:, :-1].astype(mtItems.dtype)
+        dcIndex['members'] = [np.where(kmeans.labels_ == c)[0] for c in xrange(len(dcIndex['centroids']))]
+    return dcIndex
+
+def getQueries(dcIndex, arrUsers):
+    '''
+        This function returns the augmented queries [U[i], 1] of users
+    '''
+    U = dcIndex['U'][arrUsers]
+    return np.hstack([U, np.ones((len(arrUsers), 1), dtype=U.dtype)])
+
+def mergeTopK(mtTopItems, mtTopScores, mtItems, mtScores, k):
+    '''
+        This function merges candidates into the running top-k of each row,
+        both are unsorted.
+    '''
+    mtItems = np.hstack([mtTopItems, mtItems])
+    mtScores = np.hstack([mtTopScores, mtScores])
+    if (mtScores.shape[1] > k):
+        mtKept = np.argpartition(-mtScores, k-1, axis=1)[:, :k]
+        arrRows = np.arange(mtScores.shape[0]).reshape(-1, 1)
+        mtItems = mtItems[arrRows, mtKept]
+        mtScores = mtScores[arrRows, mtKept]
+    return mtItems, mtScores
+
+def sortTopK(dcIndex, arrUsers, mtTopItems, mtTopScores):
+    '''
+        This function sorts the top-k of each user by descending score, and
+        turns the scores into predicted ratios.
+    '''
+    mtOrder = np.argsort(-mtTopScores, axis=1)
+    arrRows = np.arange(len(arrUsers)).reshape(-1, 1)
+    mtTopItems = mtTopItems[arrRows, mtOrder]
+    mtTopScores = mtTopScores[arrRows, mtOrder] + dcIndex['Bu'][arrUsers] + dcIndex['mu']
+    return mtTopItems, mtTopScores
+
+def queryTopK(dcIndex, arrUsers, k, nBlockSize=g_nBlockSize):
+    '''
+        This function finds the exact top-k items of users by a blocked scan.
+
+        params:
+            arrUsers   - row indices of users in U
+            k          - #items per user
+            nBlockSize - #items scored at once
+
+        return:
+            mtTopItems  - #users-by-k row indices of items in V, best first
+            mtTopScores - #users-by-k predicted ratios
+    '''
+    arrUsers = np.atleast_1d(np.asarray(arrUsers, dtype=np.int64))
+    mtItems = dcIndex['items']
+    k = min(k, len(mtItems))
+
+    lsTopItems = []
+    lsTopScores = []
+    for nUserStart in xrange(0, len(arrUsers), g_nUserBatch):
+        arrBatch = arrUsers[nUserStart:nUserStart+g_nUserBatch]
+        mtQueries = getQueries(dcIndex, arrBatch)
+
+        mtTopItems = np.empty((len(arrBatch), 0), dtype=np.int64)
+        mtTopScores = np.empty((len(arrBatch), 0), dtype=mtQueries.dtype)
+        for nStart in xrange(0, len(mtItems), nBlockSize):
+            nEnd = min(nStart + nBlockSize, len(mtItems))
+            mtBlockScores = np.dot(mtQueries, mtItems[nStart:nEnd].T)
+            mtBlockItems = np.tile(np.arange(nStart, nEnd), (len(arrBatch), 1))
+            mtTopItems, mtTopScores = mergeTopK(mtTopItems, mtTopScores, mtBlockItems, mtBlockScores, k)
+
+        mtTopItems, mtTopScores = sortTopK(dcIndex, arrBatch, mtTopItems, mtTopScores)
+        lsTopItems.append(mtTopItems)
+        lsTopScores.append(mtTopScores)
+
+    return np.vstack(lsTopItems), np.vstack(lsTopScores)
+
+def queryTopKApprox(dcIndex, arrUsers, k, nProbe=g_nProbe):
+    '''
+        This function finds the approximate top-k items of users, only the
+        members of the nProbe best clusters of each user are scored (see
+        createIndex). Returns are the same as queryTopK(), if fewer than k items
+        are scanned, the remaining slots are -1 with score -inf.
+    '''
+    if (dcIndex['centroids'] is None):
+        raise ValueError("index is built without clusters, see createIndex(nClusters)")
+
+    arrUsers = np.atleast_1d(np.asarray(arrUsers, dtype=np.int64))
+    mtItems = dcIndex['items']
+    k = min(k, len(mtItems))
+    mtQueries = getQueries(dcIndex, arrUsers)
+    nProbe = min(nProbe, len(dcIndex['centroids']))
+    mtProbes = np.argpartition(-np.dot(mtQueries, dcIndex['centroids'].T), nProbe-1, axis=1)[:, :nProbe]
+
+    mtTopItems = np.full((len(arrUsers), k), -1, dtype=np.int64)
+    mtTopScores = np.full((len(arrUsers), k), -np.inf, dtype=mtQueries.dtype)
+    for i in xrange(len(arrUsers)):
+        arrCandidates = np.concatenate([dcIndex['members'][c] for c in mtProbes[i]])
+        arrScores = np.dot(mtItems[arrCandidates], mtQueries[i])
+        arrItems, arrScores = mergeTopK(mtTopItems[i:i+1], mtTopScores[i:i+1], \
+                                        arrCandidates.reshape(1, -1), arrScores.reshape(1, -1), k)
+        mtTopItems[i], mtTopScores[i] = arrItems[0], arrScores[0]
+
+    return sortTopK(dcIndex, arrUsers, mtTopItems, mtTopScores)
+
+def queryUser(dcIndex, nUser, k, bApprox=False, nProbe=g_nProbe):
+    '''
+        This function answers the top-k query of one user.
+
+        return:
+            arrTopItems, arrTopScores - best first
+    '''
+    if (bApprox):
+        mtTopItems, mtTopScores = queryTopKApprox(dcIndex, [nUser], k, nProbe)
+    else:
+        mtTopItems, mtTopScores = queryTopK(dcIndex, [nUser], k)
+    return mtTopItems[0], mtTopScores[0]
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+'''
+Brief Description:
+    This model keeps the training trace of CMF (RMSEs and loss of each step) in
+    a preallocated structured array instead of a list of dicts, and prints the
+    progress of training at a bounded rate.
+
+    A trace is a dict {'data', 'size', 'interval', 'pending'}, where 'data' is a
+    structured array with a 'step' field and a field per metric. Only every
+    'interval'-th step is recorded, and the latest step is always kept in
+    'pending', so that the last state of training is never lost (see getTrace).
+    The recorded array can be pickled, saved as .npy and plotted by
+    cmf_sgd.visualizeRMSETrend directly.
+
+    All engines also accept a plain list as trace, to which a dict is appended
+    for every step.
+
+@author: jason
+'''
+
+import time
+import numpy as np
+
+g_lsTraceFields = ['rmseR', 'rmseR_test', 'rmseD', 'rmseS', 'loss']
+g_dLogInterval = 1.0 # min seconds between two progress lines
+
+def createTrace(nCapacity, nInterval=1, lsExtraFields=None):
+    '''
+        This function allocates a trace.
+
+        params:
+            nCapacity     - #records to preallocate, e.g., nMaxStep, the buffer
+                            grows if it is full
+            nInterval     - record every nInterval-th step
+            lsExtraFields - extra float fields of the engine, e.g., ['updates_per_sec']
+    '''
+    lsFields = [('step', np.int32)] + [(strField, np.float32) for strField in g_lsTraceFields[:-1]] \
+               + [('loss', np.float64)] + [(strField, np.float64) for strField in (lsExtraFields or [])]
+    dcTrace = {}
+    dcTrace['data'] = np.zeros(max(nCapacity/nInterval + 1, 1), dtype=lsFields)
+    dcTrace['size'] = 0
+    dcTrace['interval'] = nInterval
+    dcTrace['pending'] = None
+    return dcTrace
+
+def writeRecord(dcTrace, nStep, dcValues):
+    '''
+        This function writes a record at the end of the buffer, the buffer is
+        doubled if it is full.
+    '''
+    arrData = dcTrace['data']
+    nIndex = dcTrace['size']
+    if (nIndex == len(arrData)):
+        arrData = np.resize(arrData, 2*len(arrData))
+        dcTrace['data'] = arrData
+    arrData['step'][nIndex] = nStep
+    for strField in arrData.dtype.names[1:]:
+        arrData[strField][nIndex] = dcValues.get(strField, np.nan)
+    dcTrace['size'] += 1
+
+def recordTrace(trace, nStep, dcValues):
+    '''
+        This function records the metrics of a step into a trace (see
+        createTrace) or a list, it does nothing if trace is None.
+
+        params:
+            dcValues - metric name -> value, metrics not in the trace are ignored
+    '''
+    if (trace is None):
+        return
+    if (isinstance(trace, list)):
+        trace.append(dict(dcValues))
+        return
+
+    if (nStep % trace['interval'] == 0):
+        writeRecord(trace, nStep, dcValues)
+        trace['pending'] = None
+    else:
+        trace['pending'] = (nStep, dict(dcValues))
+
+def getTrace(dcTrace):
+    '''
+        This function returns the recorded steps of a trace as a structured
+        array, the latest step is always included.
+    '''
+    if (dcTrace['pending'] is not None):
+        writeRecord(dcTrace, *dcTrace['pending'])
+        dcTrace['pending'] = None
+    return dcTrace['data'][:dcTrace['size']]
+
+def createLogger(dInterval=None):
+    '''
+        This function creates a progress logger, which prints at most one line
+        per dInterval seconds (g_dLogInterval by default).
+    '''
+    return {'interval':g_dLogInterval if dInterval is None else dInterval, 'last':None}
+
+def logProgress(dcLogger, strHeader, dcValues, bForce=False):
+    '''
+        This function prints the metrics of a step in one line, unless the last
+        line was printed less than the interval of logger ago.
+
+        return:
+            True if printed
+    '''
+    dNow = time.time()
+    if (not bForce and dcLogger['last'] is not None and dNow - dcLogger['last'] < dcLogger['interval']):
+        return False
+    dcLogger['last'] = dNow
+
+    lsKeys = [strKey for strKey in g_lsTraceFields if strKey in dcValues] \
+             + sorted(strKey for strKey in dcValues if strKey not in g_lsTraceFields)
+    print("%s: %s" % (strHeader, ', '.join('%s=%f' % (strKey, dcValues[strKey]) for strKey in lsKeys)) )
+    return True
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+'''
+Description:
+    Tests of cmf_cache, run with
+        python -m unittest discover -s tests
+
+@author: jason
+'''
+
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cmf'))
+import cmf_cache
+
+class TestPredictionCache(unittest.TestCase):
+
+    def testLRUEviction(self):
+        dcCache = cmf_cache.createCache(nMaxEntries=3, dTTL=None)
+        cmf_cache.putCached(dcCache, ['a', 'b', 'c'], [1, 2, 3], 'v1')
+        self.assertEqual(cmf_cache.getCached(dcCache, ['a'], 'v1'), [1]) # b is the least recently used now
+        cmf_cache.putCached(dcCache, ['d'], [4], 'v1')
+        self.assertEqual(cmf_cache.getCached(dcCache, ['a', 'b', 'c', 'd'], 'v1'), [1, None, 3, 4])
+
+        dcStats = cmf_cache.getCacheStats(dcCache)
+        self.assertEqual(dcStats['size'], 3)
+        self.assertEqual(dcStats['evictions'], 1)
+        self.assertEqual((dcStats['hits'], dcStats['misses']), (4, 1))
+        self.assertAlmostEqual(dcStats['hit_ratio'], 0.8)
+
+    def testTTLExpiration(self):
+        dcCache = cmf_cache.createCache(nMaxEntries=10, dTTL=0.05)
+        cmf_cache.putCached(dcCache, ['a'], [1], 'v1')
+        self.assertEqual(cmf_cache.getCached(dcCache, ['a'], 'v1'), [1])
+        time.sleep(0.1)
+        self.assertEqual(cmf_cache.getCached(dcCache, ['a'], 'v1'), [None])
+
+        dcStats = cmf_cache.getCacheStats(dcCache)
+        self.assertEqual(dcStats['expirations'], 1)
+        self.assertEqual(dcStats['size'], 0)
+
+    def testVersionInvalidation(self):
+        dcCache = cmf_cache.createCache()
+        cmf_cache.putCached(dcCache, ['a', 'b'], [1, 2], 'v1')
+        self.assertEqual(cmf_cache.getCached(dcCache, ['a', 'b'], 'v2'), [None, None])
+        cmf_cache.putCached(dcCache, ['a'], [3], 'v2')
+        self.assertEqual(cmf_cache.getCached(dcCache, ['a'], 'v2'), [3])
+        cmf_cache.invalidateCache(dcCache, 'v2')
+        self.assertEqual(cmf_cache.getCached(dcCache, ['a'], 'v2'), [None])
+
+        dcStats = cmf_cache.getCacheStats(dcCache)
+        self.assertEqual(dcStats['invalidations'], 1)
+        self.assertEqual(dcStats['version'], 'v2')
+
+    def testDisabled(self):
+        dcCache = cmf_cache.createCache(nMaxEntries=0)
+        cmf_cache.putCached(dcCache, ['a'], [1], 'v1')
+        self.assertEqual(cmf_cache.getCached(dcCache, ['a'], 'v1'), [None])
+        self.assertEqual(cmf_cache.getCacheStats(dcCache)['size'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
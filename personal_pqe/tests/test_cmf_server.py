@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+'''
+Description:
+    Tests of cmf_server on localhost, run with
+        python -m unittest discover -s tests
+
+@author: jason
+'''
+
+import os
+import sys
+import json
+import urllib2
+import threading
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cmf'))
+import cmf_model
+import cmf_predict
+import cmf_server
+
+def createModel(m=20, n=10, l=4, h=3, f=3, nSeed=0):
+    '''
+        This function creates a random model with ids and params
+    '''
+    rs = np.random.RandomState(nSeed)
+    dcModel = cmf_model.packModel(rs.rand(m, f), rs.rand(n, f), rs.rand(l, f), rs.rand(h, f), \
+                                  rs.rand(m, 1), rs.rand(n, 1), 0.5, \
+                                  ['u%d' % i for i in xrange(m)], ['v%d' % j for j in xrange(n)])
+    dcModel['params'] = {'alphas':[1.0, 0.1, 0.1], 'lambdas':[0.1]*5}
+    dcModel['version'] = 'test'
+    return dcModel
+
+class TestScoringServer(unittest.TestCase):
+
+    def setUp(self):
+        self.dcModel = createModel()
+        self.server = cmf_server.createServer(cmf_server.createScorer(self.dcModel))
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.strUrl = 'http://%s:%d' % self.server.server_address
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def post(self, strPath, obj):
+        '''
+            This function posts a json body, returns (http code, json response)
+        '''
+        request = urllib2.Request(self.strUrl + strPath, json.dumps(obj), {'Content-Type':'application/json'})
+        try:
+            response = urllib2.urlopen(request, timeout=10)
+        except urllib2.HTTPError as e:
+            return e.code, json.loads(e.read())
+        return response.getcode(), json.loads(response.read())
+
+    def testScores(self):
+        arrUsers = np.array([0, 3, 19, 7, 3])
+        arrVideos = np.array([0, 9, 2, 2, 9])
+        lsRequests = [{'msisdn':'u%d' % i, 'video':'v%d' % j} for i, j in zip(arrUsers, arrVideos)]
+        lsRequests.append({'msisdn':'unknown', 'video':'v0'})
+        for i in xrange(2): # the second time from the cache
+            nCode, dcResponse = self.post('/score', {'requests':lsRequests})
+            self.assertEqual(nCode, 200)
+            self.assertEqual(dcResponse['version'], 'test')
+            np.testing.assert_allclose(dcResponse['scores'][:-1], \
+                                       cmf_predict.predictPairs(self.dcModel, arrUsers, arrVideos), rtol=1e-12)
+            self.assertIsNone(dcResponse['scores'][-1])
+
+    def testFoldIn(self):
+        nCode, dcResponse = self.post('/score', {'msisdn':'u1', 'features':[0.2, 0.3, 0.5]})
+        self.assertEqual(nCode, 200)
+        self.assertTrue(np.isfinite(dcResponse['scores'][0]))
+
+    def testBadRequests(self):
+        for obj in [[1, 2], {'requests':[]}, {'requests':'u1'}, {'video':'v1'}, \
+                    {'msisdn':'u1', 'features':[0.2, 'x', 0.5]}, {'msisdn':'u1', 'features':[0.2]}]:
+            nCode, dcResponse = self.post('/score', obj)
+            self.assertEqual(nCode, 400, obj)
+
+    def testFoldInWithoutParams(self):
+        del self.dcModel['params']
+        self.server.batcher['scorer'] = cmf_server.createScorer(self.dcModel)
+        nCode, dcResponse = self.post('/score', {'msisdn':'u1', 'features':[0.2, 0.1, 0.5]})
+        self.assertEqual(nCode, 400)
+        nCode, dcResponse = self.post('/score', {'msisdn':'u1', 'video':'v1'})
+        self.assertEqual(nCode, 200)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,533 @@
+# -*- coding: utf-8 -*-
+'''
+Description:
+    Tests of cmf_sgd on small synthetic data, run with
+        python -m unittest discover -s tests
+
+@author: jason
+'''
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from scipy import sparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cmf'))
+import cmf_sgd
+import cmf_model
+import cmf_als
+import cmf_kernel
+import cmf_parallel
+import cmf_predict
+import cmf_search
+
+def createData(m=120, n=60, l=8, h=6, dDensity=0.3, nSeed=0):
+    '''
+        This function creates low rank R (ratios in 0.1~1.0, Nan for missing),
+        and D, S correlated to it.
+    '''
+    rs = np.random.RandomState(nSeed)
+    mtUsers = rs.rand(m, 3)
+    mtVideos = rs.rand(n, 3)
+    R = np.clip(np.dot(mtUsers, mtVideos.T)/3.0 + 0.05*rs.randn(m, n), 0.1, 1.0)
+    R[rs.rand(m, n) >= dDensity] = np.nan
+    D = np.dot(mtUsers, rs.rand(3, l))
+    S = np.dot(mtVideos, rs.rand(3, h))
+    return R, D, S
+
+def toUint8(R):
+    '''
+        This function encodes R as data2matrix.transform2mt does
+    '''
+    return np.where(np.isnan(R), cmf_sgd.g_nMissingRatio, np.round(R*100.0)).astype(np.uint8)
+
+class TestUint8Ratios(unittest.TestCase):
+
+    def setUp(self):
+        self.dcParams = {'alphas':np.array([1.0, 0.1, 0.1]), 'lambdas':np.array([0.1]*5), 'f':5, \
+                         'max_step':30, 'folds':3, 'debug_trace':False, 'video_reduction_ratio':1.0, \
+                         'visualize':False, 'fold_seed':1}
+
+    def testFilterInvalidRecords(self):
+        R, D, S = createData()
+        R[0, :] = 0.05 # invalid user
+        R_filtered, D_filtered, S_filtered = cmf_sgd.filterInvalidRecords(R, D, S)
+        R_filtered8, D_filtered8, S_filtered8 = cmf_sgd.filterInvalidRecords(toUint8(R), D, S)
+        self.assertEqual(R_filtered8.dtype, np.uint8)
+        self.assertEqual(R_filtered8.shape, R_filtered.shape)
+        np.testing.assert_array_equal(R_filtered8 == cmf_sgd.g_nMissingRatio, np.isnan(R_filtered))
+        np.testing.assert_array_equal(D_filtered8, D_filtered)
+        np.testing.assert_array_equal(S_filtered8, S_filtered)
+
+    def testCMFWithUint8R(self):
+        R, D, S = createData()
+        R = np.round(R, 2) # exactly representable as uint8
+        for bSparse in [False, True]:
+            np.random.seed(0)
+            dRMSE, _, dMAE, _ = cmf_sgd.testCMF(R=R, D=D, S=S, sparse=bSparse, **self.dcParams)
+            np.random.seed(0)
+            dRMSE8, _, dMAE8, _ = cmf_sgd.testCMF(R=toUint8(R), D=D, S=S, sparse=bSparse, **self.dcParams)
+            self.assertLess(dRMSE8, 0.5) # trained on ratios, not on ratio*100
+            self.assertAlmostEqual(dRMSE8, dRMSE, places=6)
+            self.assertAlmostEqual(dMAE8, dMAE, places=6)
+
+class TestSavedModel(unittest.TestCase):
+
+    def setUp(self):
+        self.strDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.strDir)
+
+    def testIdsOfFilteredRows(self):
+        R, D, S = createData()
+        R[0, :] = np.nan # user without any record
+        R[:, 1] = np.nan # video without any record
+        lsUsers = ['u%d' % i for i in xrange(R.shape[0])]
+        lsVideos = ['v%d' % j for j in xrange(R.shape[1])]
+        strModelPath = os.path.join(self.strDir, 'model')
+        cmf_sgd.testCMF(R=R, D=D, S=S, alphas=np.array([1.0, 0.1, 0.1]), lambdas=np.array([0.1]*5), f=5, \
+                        max_step=10, folds=3, debug_trace=False, video_reduction_ratio=1.0, visualize=False, \
+                        user_order=lsUsers, video_order=lsVideos, model_path=strModelPath)
+
+        dcModel = cmf_model.loadModel(strModelPath)
+        self.assertEqual(dcModel['users'], lsUsers[1:])
+        self.assertEqual(dcModel['videos'], lsVideos[:1] + lsVideos[2:])
+        self.assertEqual(dcModel['U'].shape[0], len(dcModel['users']))
+        self.assertEqual(dcModel['V'].shape[0], len(dcModel['videos']))
+
+    def testModelPathRequiresIds(self):
+        R, D, S = createData()
+        self.assertRaises(ValueError, cmf_sgd.testCMF, R=R, D=D, S=S, alphas=np.array([1.0, 0.1, 0.1]), \
+                          lambdas=np.array([0.1]*5), f=5, max_step=10, folds=3, debug_trace=False, \
+                          video_reduction_ratio=1.0, visualize=False, \
+                          model_path=os.path.join(self.strDir, 'model'))
+
+    def testRoundTrip(self):
+        rs = np.random.RandomState(0)
+        lsFactors = [rs.rand(*tpShape).astype(np.float32) for tpShape in [(6, 3), (4, 3), (5, 3), (2, 3), (6, 1), (4, 1)]]
+        dcModel = cmf_model.packModel(*(lsFactors + [np.float32(0.5), ['u%d' % i for i in xrange(6)], \
+                                                     ['v%d' % j for j in xrange(4)]]))
+        strModelPath = os.path.join(self.strDir, 'model')
+        strVersion = cmf_model.saveModel(dcModel, strModelPath, dcPreprocess={'scale':np.array([1.0, 2.0])}, \
+                                         dcParams={'alphas':np.array([1.0, 0.1, 0.1]), 'f':3})
+        self.assertEqual(strVersion, cmf_model.getModelVersion(dcModel))
+        
+        for strMmapMode in ['r', None]:
+            dcLoaded = cmf_model.loadModel(strModelPath, strMmapMode)
+            for strName in cmf_model.g_lsFactors:
+                self.assertEqual(isinstance(dcLoaded[strName], np.memmap), strMmapMode is not None)
+                self.assertEqual(dcLoaded[strName].dtype, np.float32)
+                np.testing.assert_array_equal(dcLoaded[strName], dcModel[strName])
+            self.assertEqual(dcLoaded['mu'], dcModel['mu'])
+            self.assertEqual(dcLoaded['users'], dcModel['users'])
+            self.assertEqual(dcLoaded['videos'], dcModel['videos'])
+            self.assertEqual(dcLoaded['version'], strVersion)
+            self.assertEqual(cmf_model.getModelVersion(dcLoaded), strVersion)
+            np.testing.assert_array_equal(dcLoaded['preprocess']['scale'], [1.0, 2.0])
+            np.testing.assert_array_equal(dcLoaded['params']['alphas'], [1.0, 0.1, 0.1])
+            self.assertEqual(dcLoaded['params']['f'], 3)
+        
+        # a retrained model gets a new version, and replaces the old one
+        dcModel['U'] = dcModel['U'] + np.float32(1.0)
+        self.assertNotEqual(cmf_model.saveModel(dcModel, strModelPath), strVersion)
+        np.testing.assert_array_equal(cmf_model.loadModel(strModelPath)['U'], dcModel['U'])
+        self.assertEqual(os.listdir(self.strDir), ['model'])
+
+    def testUnsupportedFormat(self):
+        strModelPath = os.path.join(self.strDir, 'model')
+        cmf_model.saveModel(cmf_model.packModel(*[np.ones((2, 2))]*6 + [0.5]), strModelPath)
+        strManifest = os.path.join(strModelPath, cmf_model.g_strManifest)
+        with open(strManifest, 'r') as hFile:
+            dcManifest = json.load(hFile)
+        dcManifest['format_version'] = cmf_model.g_nFormatVersion + 1
+        with open(strManifest, 'w') as hFile:
+            json.dump(dcManifest, hFile)
+        self.assertRaises(ValueError, cmf_model.loadModel, strModelPath)
+
+class TestParallelFolds(unittest.TestCase):
+
+    def testSameAsSerial(self):
+        R, D, S = createData()
+        dcParams = {'R':R, 'D':D, 'S':S, 'alphas':np.array([1.0, 0.1, 0.1]), 'lambdas':np.array([0.1]*5), \
+                    'f':5, 'max_step':20, 'folds':3, 'debug_trace':False, 'video_reduction_ratio':1.0, \
+                    'visualize':False, 'fold_seed':1}
+        np.random.seed(0)
+        tpSerial = cmf_sgd.testCMF(**dcParams)
+        np.random.seed(1) # the initial models only depend on fold_seed
+        tpParallel = cmf_sgd.testCMF(fold_workers=2, **dcParams)
+        self.assertEqual(tpParallel, tpSerial)
+
+class TestLossSample(unittest.TestCase):
+
+    def testDeterministic(self):
+        R, D, S = createData()
+        dcParams = {'R':R, 'D':D, 'S':S, 'alphas':np.array([1.0, 0.1, 0.1]), 'lambdas':np.array([0.1]*5), \
+                    'f':5, 'max_step':30, 'folds':3, 'debug_trace':False, 'video_reduction_ratio':1.0, \
+                    'visualize':False, 'fold_seed':1, 'engine_params':{'nEvalInterval':5, 'nLossSamples':300}}
+        np.random.seed(0)
+        tpFirst = cmf_sgd.testCMF(**dcParams)
+        np.random.seed(1) # the sample follows the seed of the fold
+        self.assertEqual(cmf_sgd.testCMF(**dcParams), tpFirst)
+
+    def testFullSampleIsExact(self):
+        R, D, S, weightR_train, weightR_test, weightD, weightS = splitData()
+        U, P, V, Q, Bu, Bv, Jm, Jn, mu = initModel(R, D, S, weightR_train)
+        arrAlphas, arrLambdas = np.array([1.0, 0.1, 0.1]), np.array([0.1]*5)
+        dLoss = cmf_sgd.computeResidualError(R, D, S, U, V, P, Q, Bu, Bv, mu, Jm, Jn, weightR_train, weightR_test, \
+                                             weightD, weightS, arrAlphas, arrLambdas)[-1]
+        dcSample = cmf_sgd.createLossSample(R, weightR_train, D, S, weightD, weightS, R.size, nSeed=1)
+        dEstimate, dStdErr = cmf_sgd.estimateLoss(dcSample, U, V, P, Q, Bu, Bv, mu, arrAlphas, arrLambdas)
+        self.assertAlmostEqual(dEstimate / dLoss, 1.0, places=12)
+        self.assertAlmostEqual(dStdErr, 0.0, places=12)
+
+class TestHogwild(unittest.TestCase):
+
+    def testLowersLoss(self):
+        R, D, S = createData()
+        np.random.seed(0)
+        tpResult = cmf_sgd.testCMF(R=R, D=D, S=S, alphas=np.array([1.0, 0.1, 0.1]), lambdas=np.array([0.1]*5), \
+                                   f=5, max_step=20, folds=3, debug_trace=False, video_reduction_ratio=1.0, \
+                                   visualize=False, fold_seed=1, engine='hogwild', return_traces=True, \
+                                   engine_params={'nWorkers':2, 'nBatchSize':64, 'dLearningRate':0.05})
+        self.assertLess(tpResult[0], np.nanstd(R)) # better than predicting the mean
+        for arrTrace in tpResult[4]:
+            self.assertLess(arrTrace['loss'][-1], arrTrace['loss'][0])
+
+def initData(dtype=np.float64):
+    '''
+        This function returns the inputs of the engines: R, D, S, weightR, weightD,
+        weightS (see cmf_sgd.init) of createData()
+    '''
+    R, D, S = cmf_sgd.filterInvalidRecords(*createData())
+    return cmf_sgd.init(R, D, S, inplace=False, dReductionRatio=1.0, dtype=dtype)
+
+def splitData(dTestRatio=0.2, nSeed=1):
+    '''
+        This function returns R, D, S, weightR_train, weightR_test, weightD, weightS
+        of initData(), with a random dTestRatio of the observed ratios held out
+    '''
+    R, D, S, weightR, weightD, weightS = initData()
+    weightR_test = weightR * (np.random.RandomState(nSeed).rand(*weightR.shape) < dTestRatio)
+    return R, D, S, weightR - weightR_test, weightR_test, weightD, weightS
+
+def fitModel(R, D, S, weightR_train, weightR_test, weightD, weightS, nMaxStep=20, **kwargs):
+    '''
+        This function runs cmf_sgd.fit from the initial model of seed 0, and returns
+        the factors (U, V, P, Q, Bu, Bv, mu) and the training trace
+    '''
+    np.random.seed(0)
+    lsTrace = []
+    tpModel = cmf_sgd.fit(R, D, S, weightR_train, weightR_test, weightD, weightS, 5, np.array([1.0, 0.1, 0.1]), \
+                          np.array([0.1]*5), nMaxStep, lsTrace, False, **kwargs)
+    return tpModel[:7], lsTrace
+
+def assertSameModel(tpModel, tpExpected, dTolerance=1e-12):
+    '''
+        This function checks that two results of fitModel() are the same run
+    '''
+    assert len(tpModel[1]) == len(tpExpected[1]), 'different number of steps'
+    for arr, arrExpected in zip(tpModel[0], tpExpected[0]):
+        np.testing.assert_allclose(arr, arrExpected, rtol=0.0, atol=dTolerance)
+
+def initModel(R, D, S, weightR_train):
+    '''
+        This function returns the initial model of seed 0 as in fit():
+        U, P, V, Q, Bu, Bv, Jm, Jn, mu
+    '''
+    np.random.seed(0)
+    U, P, V, Q, Bu, Bv, Jm, Jn = cmf_sgd.initLowRankMatrices(R, D, S, 5)
+    mu = (R*weightR_train).sum() / weightR_train.sum()
+    return U, P, V, Q, Bu, Bv, Jm, Jn, mu
+
+class TestLineSearch(unittest.TestCase):
+
+    def testPolynomialIsExact(self):
+        R, D, S, weightR_train, weightR_test, weightD, weightS = splitData()
+        U, P, V, Q, Bu, Bv, Jm, Jn, mu = initModel(R, D, S, weightR_train)
+        arrAlphas, arrLambdas = np.array([1.0, 0.1, 0.1]), np.array([0.1]*5)
+        tpWeights = (weightR_train, weightR_test, weightD, weightS)
+        errorR, errorD, errorS = cmf_sgd.computeResidualError(R, D, S, U, V, P, Q, Bu, Bv, mu, Jm, Jn, \
+                                                              *(tpWeights + (arrAlphas, arrLambdas)))[:3]
+        lsGrads = cmf_sgd.computeParitialGraident(errorR, errorD, errorS, U, V, P, Q, Bu, Bv, Jm, Jn, \
+                                                  arrAlphas, arrLambdas)
+        arrCoef = cmf_sgd.computeLossPolynomial(errorR, errorD, errorS, U, V, P, Q, Bu, Bv, \
+                                                *(list(lsGrads) + [weightR_train, weightD, weightS, \
+                                                                   arrAlphas, arrLambdas]))
+        for gamma in [0.0, 1e-4, 1e-3, 1e-2]:
+            U1, V1, P1, Q1, Bu1, Bv1 = cmf_sgd.computeNextStep([U, V, P, Q, Bu, Bv], lsGrads, gamma)
+            dLoss = cmf_sgd.computeResidualError(R, D, S, U1, V1, P1, Q1, Bu1, Bv1, mu, Jm, Jn, \
+                                                 *(tpWeights + (arrAlphas, arrLambdas)))[-1]
+            self.assertAlmostEqual(np.polyval(arrCoef, gamma) / dLoss, 1.0, places=10)
+
+    def testPolynomialLowersLoss(self):
+        arrLosses = np.array([dcRecord['loss'] for dcRecord in \
+                              fitModel(*splitData(), strLineSearch='polynomial')[1]])
+        self.assertTrue((np.diff(arrLosses) <= 0.0).all())
+        self.assertLess(arrLosses[-1], arrLosses[0])
+
+class TestMiniBatch(unittest.TestCase):
+
+    def testFullBatchIsGradientStep(self):
+        R, D, S, weightR_train, weightR_test, weightD, weightS = splitData()
+        U, P, V, Q, Bu, Bv, Jm, Jn, mu = initModel(R, D, S, weightR_train)
+        arrAlphas, arrLambdas = np.array([1.0, 0.1, 0.1]), np.array([0.1]*5)
+        errorR, errorD, errorS = cmf_sgd.computeResidualError(R, D, S, U, V, P, Q, Bu, Bv, mu, Jm, Jn, \
+                                                              weightR_train, weightR_test, weightD, weightS, \
+                                                              arrAlphas, arrLambdas)[:3]
+        lsGrads = cmf_sgd.computeParitialGraident(errorR, errorD, errorS, U, V, P, Q, Bu, Bv, Jm, Jn, \
+                                                  arrAlphas, arrLambdas)
+        lsExpected = cmf_sgd.computeNextStep([U, V, P, Q, Bu, Bv], lsGrads, 1e-3)
+        
+        # one batch of all entries in one epoch
+        np.random.seed(0)
+        lsFactors = cmf_sgd.fitMiniBatch(R, D, S, weightR_train, weightR_test, weightD, weightS, 5, \
+                                         arrAlphas, arrLambdas, 1, [], False, nBatchSize=R.size, \
+                                         dLearningRate=1e-3, strSchedule='constant')[:6]
+        for arr, arrExpected in zip(lsFactors, lsExpected):
+            np.testing.assert_allclose(arr, arrExpected, rtol=0.0, atol=1e-12)
+
+    def testLowersLoss(self):
+        R, D, S, weightR_train, weightR_test, weightD, weightS = splitData()
+        np.random.seed(0)
+        lsTrace = []
+        cmf_sgd.fitMiniBatch(R, D, S, weightR_train, weightR_test, weightD, weightS, 5, np.array([1.0, 0.1, 0.1]), \
+                             np.array([0.1]*5), 30, lsTrace, False, nBatchSize=256)
+        self.assertLess(lsTrace[-1]['loss'], 0.1*lsTrace[0]['loss'])
+
+class TestEngines(unittest.TestCase):
+
+    def setUp(self):
+        self.tpData = splitData()
+        self.tpBaseline = fitModel(*self.tpData)
+
+    def testSparse(self):
+        assertSameModel(fitModel(*self.tpData, bSparse=True), self.tpBaseline)
+
+    def testIndexMasks(self):
+        R, D, S, weightR_train, weightR_test, weightD, weightS = self.tpData
+        tpIndexData = (R, D, S, sparse.coo_matrix(weightR_train), sparse.coo_matrix(weightR_test), weightD, weightS)
+        assertSameModel(fitModel(*tpIndexData), self.tpBaseline)
+        assertSameModel(fitModel(*tpIndexData, strLineSearch='polynomial'), \
+                        fitModel(*self.tpData, strLineSearch='polynomial'))
+
+    def testWorkspace(self):
+        R, D, S, weightR_train, weightR_test, weightD, weightS = self.tpData
+        tpIndexData = (R, D, S, sparse.coo_matrix(weightR_train), sparse.coo_matrix(weightR_test), weightD, weightS)
+        tpPolynomial = fitModel(*self.tpData, strLineSearch='polynomial')
+        for tpData in [self.tpData, tpIndexData]:
+            assertSameModel(fitModel(*tpData, bWorkspace=True), self.tpBaseline)
+            assertSameModel(fitModel(*tpData, bWorkspace=True, strLineSearch='polynomial'), tpPolynomial)
+
+    def testFloat32(self):
+        R, D, S, weightR_train, weightR_test, weightD, weightS = self.tpData
+        tpData = (R.astype(np.float32), D.astype(np.float32), S.astype(np.float32), \
+                  weightR_train.astype(np.float32), weightR_test.astype(np.float32), \
+                  weightD.astype(np.float32), weightS.astype(np.float32))
+        for dcKwargs in [{}, {'bSparse':True}, {'bWorkspace':True}, {'bFused':True}]:
+            lsFactors, lsTrace = fitModel(*tpData, dtype=np.float32, **dcKwargs)
+            for arr in lsFactors:
+                self.assertEqual(arr.dtype, np.float32, dcKwargs)
+            self.assertAlmostEqual(lsTrace[-1]['rmseR_test'], self.tpBaseline[1][-1]['rmseR_test'], 3, dcKwargs)
+
+    def testFused(self):
+        assertSameModel(fitModel(*self.tpData, bFused=True), self.tpBaseline)
+        if (cmf_kernel.g_bNumba):
+            # the numpy version as well
+            cmf_kernel.g_bNumba = False
+            try:
+                assertSameModel(fitModel(*self.tpData, bFused=True), self.tpBaseline)
+            finally:
+                cmf_kernel.g_bNumba = True
+
+class TestEarlyStopping(unittest.TestCase):
+
+    def testBestStepReturned(self):
+        tpData = splitData()
+        R, D, S, weightR_train, weightR_test, weightD, weightS = tpData
+        nSteps = len(fitModel(*tpData, nMaxStep=300)[1])
+        for nPatience in [1, 3]:
+            (U, V, P, Q, Bu, Bv, mu), lsTrace = fitModel(*tpData, nMaxStep=300, nPatience=nPatience)
+            arrRMSEs = np.array([dcRecord['rmseR_test'] for dcRecord in lsTrace])
+            self.assertGreater(arrRMSEs[-1], arrRMSEs.min()) # the last step isn't the best
+            self.assertAlmostEqual(cmf_sgd.pred(R, D, S, U, V, P, Q, mu, weightR_test, Bu, Bv), \
+                                   arrRMSEs.min(), places=12)
+            if (nPatience == 1):
+                self.assertLess(len(lsTrace), nSteps)
+
+class TestWarmStart(unittest.TestCase):
+
+    def testContinueTraining(self):
+        tpData = splitData()
+        lsFactors, lsTrace = fitModel(*tpData)
+        dcModel = cmf_model.packModel(*lsFactors)
+        lsCopies = [np.copy(arr) for arr in lsFactors[:6]]
+        lsWarmTrace = fitModel(*tpData, dcInitModel=dcModel)[1]
+        self.assertLessEqual(lsWarmTrace[0]['loss'], lsTrace[-1]['loss'])
+        for arr, arrCopy in zip(lsFactors[:6], lsCopies):
+            np.testing.assert_array_equal(arr, arrCopy) # not updated in place
+
+    def testModelMismatch(self):
+        R, D, S, weightR_train, weightR_test, weightD, weightS = splitData()
+        dcModel = cmf_model.packModel(*fitModel(R, D, S, weightR_train, weightR_test, weightD, weightS)[0])
+        self.assertRaises(ValueError, fitModel, R[1:], D[1:], S, weightR_train[1:], weightR_test[1:], \
+                          weightD[1:], weightS, dcInitModel=dcModel)
+
+    def testAlignModel(self):
+        R, D, S, weightR_train, weightR_test, weightD, weightS = splitData()
+        lsFactors = fitModel(R, D, S, weightR_train, weightR_test, weightD, weightS)[0]
+        lsUsers = ['u%d' % i for i in xrange(R.shape[0])]
+        lsVideos = ['v%d' % j for j in xrange(R.shape[1])]
+        dcModel = cmf_model.packModel(*(lsFactors + (lsUsers, lsVideos)))
+        
+        # u0 leaves, 'new' joins with the features of u0
+        lsNewUsers = lsUsers[1:] + ['new']
+        D_new = np.vstack([D[1:], D[:1]])
+        weightD_new = np.vstack([weightD[1:], weightD[:1]])
+        dcAligned = cmf_model.alignModel(dcModel, lsNewUsers, lsVideos, D_new, S, weightD_new, weightS, \
+                                         np.array([1.0, 0.1, 0.1]), np.array([0.1]*5))
+        self.assertEqual(dcAligned['users'], lsNewUsers)
+        np.testing.assert_array_equal(dcAligned['U'][:-1], dcModel['U'][1:])
+        np.testing.assert_array_equal(dcAligned['Bu'][:-1], dcModel['Bu'][1:])
+        np.testing.assert_array_equal(dcAligned['V'], dcModel['V'])
+        self.assertEqual(dcAligned['Bu'][-1, 0], 0.0)
+        np.testing.assert_allclose(dcAligned['U'][-1], \
+                                   cmf_model.solveNewRows(dcModel['P'], D[:1], weightD[:1], 0.1, 0.1)[0])
+
+class TestPredictPairs(unittest.TestCase):
+
+    def setUp(self):
+        rs = np.random.RandomState(0)
+        self.dcModel = cmf_model.packModel(rs.rand(30, 4), rs.rand(20, 4), None, None, rs.rand(30, 1), \
+                                           rs.rand(20, 1), 0.5)
+        self.arrUsers = rs.randint(30, size=100)
+        self.arrVideos = rs.randint(20, size=100)
+
+    def testSameAsDense(self):
+        dcModel = self.dcModel
+        mtPred = np.dot(dcModel['U'], dcModel['V'].T) + dcModel['Bu'] + dcModel['Bv'].T + dcModel['mu']
+        for nChunkSize in [1, 7, 1000]:
+            arrPred = cmf_predict.predictPairs(dcModel, self.arrUsers, self.arrVideos, nChunkSize)
+            np.testing.assert_allclose(arrPred, mtPred[self.arrUsers, self.arrVideos], rtol=0.0, atol=1e-12)
+
+    def testModelDtype(self):
+        dcModel = dict(self.dcModel)
+        for strName in ['U', 'V', 'Bu', 'Bv']:
+            dcModel[strName] = dcModel[strName].astype(np.float32)
+        self.assertEqual(cmf_predict.predictPairs(dcModel, self.arrUsers, self.arrVideos).dtype, np.float32)
+
+    def testLengthMismatch(self):
+        self.assertRaises(ValueError, cmf_predict.predictPairs, self.dcModel, self.arrUsers, self.arrVideos[1:])
+
+class TestFoldIn(unittest.TestCase):
+
+    def testStationary(self):
+        R, D, S, weightR_train, weightR_test, weightD, weightS = splitData()
+        arrAlphas, arrLambdas = np.array([1.0, 0.1, 0.1]), np.array([0.1]*5)
+        dcModel = cmf_model.packModel(*fitModel(R, D, S, weightR_train, weightR_test, weightD, weightS)[0])
+        R_train = np.where(weightR_train > 0, R, 0.0)
+        
+        # fold in all users (videos) again, their gradients vanish for the rest of the model
+        U_new, Bu_new = cmf_predict.foldInUsers(dcModel, D, weightD, arrAlphas, arrLambdas, R_train, weightR_train)
+        V_new, Bv_new = cmf_predict.foldInVideos(dcModel, S, weightS, arrAlphas, arrLambdas, R_train, weightR_train)
+        Jm, Jn = np.ones((R.shape[0], 1)), np.ones((R.shape[1], 1))
+        for U, V, Bu, Bv, lsFolded in [(U_new, dcModel['V'], Bu_new, dcModel['Bv'], [0, 4]), \
+                                       (dcModel['U'], V_new, dcModel['Bu'], Bv_new, [1, 5])]:
+            errorR, errorD, errorS = cmf_sgd.computeResidualError(R, D, S, U, V, dcModel['P'], dcModel['Q'], Bu, Bv, \
+                                                                  dcModel['mu'], Jm, Jn, weightR_train, weightR_test, \
+                                                                  weightD, weightS, arrAlphas, arrLambdas)[:3]
+            lsGrads = cmf_sgd.computeParitialGraident(errorR, errorD, errorS, U, V, dcModel['P'], dcModel['Q'], \
+                                                      Bu, Bv, Jm, Jn, arrAlphas, arrLambdas)
+            for i in lsFolded:
+                self.assertLess(np.abs(lsGrads[i]).max(), 1e-10)
+
+class TestALS(unittest.TestCase):
+
+    def testFloat32(self):
+        dcRMSEs = {}
+        for dtype in [np.float32, np.float64]:
+            R, D, S, weightR, weightD, weightS = initData(dtype)
+            np.random.seed(0)
+            lsTrace = []
+            lsFactors = cmf_als.fit(R, D, S, weightR, weightR, weightD, weightS, 5, np.array([1.0, 0.1, 0.1]), \
+                                    np.array([0.1]*5), 5, lsTrace, False, dtype=dtype)[:6]
+            for arr in lsFactors:
+                self.assertEqual(arr.dtype, dtype)
+            dcRMSEs[dtype] = lsTrace[-1]['rmseR']
+        self.assertAlmostEqual(dcRMSEs[np.float32], dcRMSEs[np.float64], places=4)
+
+    def testParallelSameAsSerial(self):
+        tpData = splitData()
+        lsResults = []
+        for fit, dcKwargs in [(cmf_als.fit, {}), (cmf_parallel.fit, {'nWorkers':2})]:
+            np.random.seed(0)
+            lsTrace = []
+            lsFactors = fit(*(tpData + (5, np.array([1.0, 0.1, 0.1]), np.array([0.1]*5), 5, lsTrace, False)), \
+                            **dcKwargs)[:7]
+            lsResults.append((lsFactors, lsTrace))
+        assertSameModel(lsResults[1], lsResults[0], dTolerance=1e-10)
+
+class TestOptimizers(unittest.TestCase):
+
+    def fitLosses(self, nMaxStep, **kwargs):
+        R, D, S, weightR, weightD, weightS = initData()
+        np.random.seed(0)
+        lsTrace = []
+        cmf_sgd.fit(R, D, S, weightR, weightR, weightD, weightS, 5, np.array([1.0, 0.1, 0.1]), \
+                    np.array([0.1]*5), nMaxStep, lsTrace, False, **kwargs)
+        return np.array([dcRecord['loss'] for dcRecord in lsTrace])
+
+    def testLowerLoss(self):
+        arrLosses_gd = self.fitLosses(50)
+        for strOptimizer in ['sgd', 'adagrad', 'rmsprop', 'adam']:
+            arrLosses = self.fitLosses(50, strOptimizer=strOptimizer) # default learning rate
+            self.assertTrue((np.diff(arrLosses) <= 0.0).all(), strOptimizer) # no accepted increase
+            self.assertLess(arrLosses[-1], arrLosses_gd[-1], strOptimizer)
+
+    def testRejectIncrease(self):
+        # far too large a rate, every increase is rejected until it is small enough
+        arrLosses = self.fitLosses(30, strOptimizer='sgd', dLearningRate=10.0)
+        self.assertTrue(np.isfinite(arrLosses).all())
+        self.assertTrue((np.diff(arrLosses) <= 0.0).all())
+        self.assertLess(arrLosses[-1], arrLosses[0])
+
+class TestSearch(unittest.TestCase):
+
+    def testRankDivergedLast(self):
+        lsRows = [{'trial':0, 'rmse_mean':np.nan, 'rmse_trace':np.nan}, {'trial':1, 'rmse_mean':0.2}, \
+                  {'trial':2, 'rmse_mean':0.3, 'rmse_trace':0.1}, {'trial':3, 'rmse_mean':np.nan}]
+        for lsOrder in [[0, 1, 2, 3], [3, 2, 1, 0], [1, 0, 3, 2]]:
+            lsSorted = sorted([lsRows[i] for i in lsOrder], key=cmf_search.getRankMetric)
+            self.assertEqual([dcRow['trial'] for dcRow in lsSorted[:2]], [2, 1])
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.strDir = tempfile.mkdtemp()
+        R, D, S = createData()
+        self.dcParams = {'R':R, 'D':D, 'S':S, 'alphas':np.array([1.0, 0.1, 0.1]), 'lambdas':np.array([0.1]*5), \
+                         'f':5, 'max_step':10, 'folds':3, 'debug_trace':False, 'video_reduction_ratio':1.0, \
+                         'visualize':False, 'cache_dir':self.strDir}
+
+    def tearDown(self):
+        shutil.rmtree(self.strDir)
+
+    def testRandomFoldsNotCached(self):
+        cmf_sgd.testCMF(fold_seed=None, **self.dcParams)
+        self.assertEqual(os.listdir(self.strDir), [])
+        cmf_sgd.testCMF(fold_seed=1, **self.dcParams)
+        self.assertEqual(len(os.listdir(self.strDir)), 1)
+
+    def testOverwriteKey(self):
+        from tools import result_cache
+        self.assertTrue(result_cache.saveResult(self.strDir, 'key', 1))
+        self.assertTrue(result_cache.saveResult(self.strDir, 'key', 2))
+        self.assertEqual(result_cache.loadResult(self.strDir, 'key'), 2)
+        self.assertEqual(os.listdir(self.strDir), ['key' + result_cache.g_strSuffix])
+
+if __name__ == '__main__':
+    unittest.main()
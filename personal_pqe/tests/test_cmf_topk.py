@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+'''
+Description:
+    Tests of cmf_topk on a random model, run with
+        python -m unittest discover -s tests
+
+@author: jason
+'''
+
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cmf'))
+import cmf_model
+import cmf_topk
+
+def createModel(m=50, n=500, f=8, nSeed=0):
+    '''
+        This function creates a random model of m users and n videos
+    '''
+    rs = np.random.RandomState(nSeed)
+    return cmf_model.packModel(rs.randn(m, f), rs.randn(n, f), None, None, rs.rand(m, 1), rs.rand(n, 1), 0.5)
+
+def getRecall(mtTopItems, mtExpected):
+    '''
+        This function returns the mean fraction of the expected items found per user
+    '''
+    return np.mean([len(set(arrItems) & set(arrExpected))*1.0 / len(arrExpected) \
+                    for arrItems, arrExpected in zip(mtTopItems, mtExpected)])
+
+class TestTopK(unittest.TestCase):
+
+    def setUp(self):
+        self.dcModel = createModel()
+        self.dcIndex = cmf_topk.createIndex(self.dcModel, nClusters=16, nSeed=0)
+        self.arrUsers = np.arange(len(self.dcModel['U']))
+
+    def testExact(self):
+        dcModel = self.dcModel
+        mtPred = np.dot(dcModel['U'], dcModel['V'].T) + dcModel['Bu'] + dcModel['Bv'].T + dcModel['mu']
+        mtExpected = np.argsort(-mtPred, axis=1)[:, :10]
+        mtTopItems, mtTopScores = cmf_topk.queryTopK(self.dcIndex, self.arrUsers, 10, nBlockSize=64)
+        np.testing.assert_array_equal(mtTopItems, mtExpected)
+        np.testing.assert_allclose(mtTopScores, mtPred[self.arrUsers.reshape(-1, 1), mtExpected], \
+                                   rtol=0.0, atol=1e-12)
+
+    def testApproxRecall(self):
+        mtExpected = cmf_topk.queryTopK(self.dcIndex, self.arrUsers, 10)[0]
+        lsRecalls = [getRecall(cmf_topk.queryTopKApprox(self.dcIndex, self.arrUsers, 10, nProbe)[0], mtExpected) \
+                     for nProbe in [2, 4, 8, 16]]
+        self.assertEqual(lsRecalls, sorted(lsRecalls))
+        self.assertGreaterEqual(lsRecalls[2], 0.9)
+        self.assertEqual(lsRecalls[3], 1.0) # all clusters are scanned
+
+    def testUnclustered(self):
+        dcIndex = cmf_topk.createIndex(self.dcModel)
+        self.assertRaises(ValueError, cmf_topk.queryTopKApprox, dcIndex, self.arrUsers, 10)
+
+if __name__ == '__main__':
+    unittest.main()
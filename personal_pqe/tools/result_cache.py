@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+'''
+Description:
+    This module provides a content-addressed result cache on disk: a result is
+    keyed by the hash of its inputs (matrices and params), so that a repeated
+    experiment is loaded instead of recomputed, no matter which script or
+    notebook computed it first.
+
+    Each result is a pickle file <key>.pkl in the cache directory. The mtime of
+    a file is refreshed when it is hit, and the least recently used files are
+    evicted when the directory grows beyond its size limit.
+
+@author: jason
+'''
+
+import os
+import hashlib
+import tempfile
+import cPickle as pickle
+import numpy as np
+from scipy import sparse
+
+g_strSuffix = '.pkl'
+g_nMaxCacheBytes = 1 << 30 # 1GB
+
+def updateHash(hasher, obj):
+    '''
+        This function feeds an object into hasher, arrays are hashed by their
+        dtype, shape and content, containers are hashed recursively.
+    '''
+    if (isinstance(obj, np.ndarray)):
+        hasher.update('nd%s%s' % (obj.dtype.str, obj.shape))
+        hasher.update(np.ascontiguousarray(obj).data)
+    elif (sparse.issparse(obj)):
+        obj = obj.tocsr()
+        hasher.update('sp%s' % (obj.shape,))
+        for arr in [obj.data, obj.indices, obj.indptr]:
+            updateHash(hasher, arr)
+    elif (isinstance(obj, dict)):
+        hasher.update('dc%d' % len(obj))
+        for key in sorted(obj.keys()):
+            updateHash(hasher, key)
+            updateHash(hasher, obj[key])
+    elif (isinstance(obj, (list, tuple))):
+        hasher.update('ls%d' % len(obj))
+        for item in obj:
+            updateHash(hasher, item)
+    else:
+        # scalars, strings, None, dtypes
+        hasher.update('%s:%r' % (type(obj).__name__, obj))
+
+def getCacheKey(*objs):
+    '''
+        This function returns the hex digest of objects as a cache key
+    '''
+    hasher = hashlib.sha1()
+    for obj in objs:
+        updateHash(hasher, obj)
+    return hasher.hexdigest()
+
+def getCachePath(strCacheDir, strKey):
+    return os.path.join(strCacheDir, strKey + g_strSuffix)
+
+def loadResult(strCacheDir, strKey):
+    '''
+        This function loads a cached result.
+
+        return:
+            the result, None if it is not cached
+    '''
+    strPath = getCachePath(strCacheDir, strKey)
+    try:
+        with open(strPath, 'rb') as hFile:
+            obj = pickle.load(hFile)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        return None
+
+    # mark as recently used
+    os.utime(strPath, None)
+    return obj
+
+def saveResult(strCacheDir, strKey, obj, nMaxBytes=g_nMaxCacheBytes):
+    '''
+        This function caches a result, then evicts old results if the cache is
+        larger than nMaxBytes. The result is written to a unique temp file and
+        renamed, so that a concurrent reader never sees a partial file.
+
+        return:
+            True if the result is cached
+    '''
+    if (not os.path.isdir(strCacheDir)):
+        os.makedirs(strCacheDir)
+
+    nFile, strTempPath = tempfile.mkstemp(suffix='.tmp', dir=strCacheDir)
+    with os.fdopen(nFile, 'wb') as hFile:
+        pickle.dump(obj, hFile, pickle.HIGHEST_PROTOCOL)
+
+    strPath = getCachePath(strCacheDir, strKey)
+    try:
+        os.rename(strTempPath, strPath)
+    except OSError:
+        # on Windows, rename fails if the key exists (e.g., cached by another process)
+        try:
+            if (os.path.exists(strPath)):
+                os.remove(strPath)
+            os.rename(strTempPath, strPath)
+        except OSError:
+            # the file is in use, keep the existing result
+            os.remove(strTempPath)
+            return False
+
+    evictResults(strCacheDir, nMaxBytes)
+    return True
+
+def evictResults(strCacheDir, nMaxBytes=g_nMaxCacheBytes):
+    '''
+        This function removes the least recently used results until the total
+        size of the cache is no larger than nMaxBytes.
+
+        return:
+            #removed results
+    '''
+    lsEntries = []
+    for strName in os.listdir(strCacheDir):
+        if (not strName.endswith(g_strSuffix)):
+            continue
+        strPath = os.path.join(strCacheDir, strName)
+        st = os.stat(strPath)
+        lsEntries.append((st.st_mtime, st.st_size, strPath))
+
+    nTotalBytes = sum(nSize for _, nSize, _ in lsEntries)
+    nRemoved = 0
+    for _, nSize, strPath in sorted(lsEntries):
+        if (nTotalBytes <= nMaxBytes):
+            break
+        try:
+            os.remove(strPath)
+        except OSError:
+            pass # removed by another process
+        nTotalBytes -= nSize
+        nRemoved += 1
+    return nRemoved